@@ -0,0 +1,172 @@
+"""
+Checks that the plugin survives an unhealthy backend.
+
+Failures are injected into the stub backend: a broken token count
+endpoint, a backend that is down when the plugin starts, a backend that
+goes down mid-run, and dropped connections. Each scenario checks that
+completions degrade instead of the process exiting, that requests fail
+fast while the backend is down, and that the plugin recovers without a
+restart. The run fails if any check fails.
+
+Usage:
+    python -m benchmarks.failures
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import yaml
+
+from benchmarks.run import PROFILE_PATH, load_corpus
+from benchmarks.stub_webui import StubWebUI
+
+HEALTH_INTERVAL = 0.1
+
+
+def create_client(stub:StubWebUI, model:str = 'stub-model'):
+    from auto_gpt_text_gen_plugin.client import Client
+
+    with open(PROFILE_PATH, 'r') as f:
+        prompt_profile = yaml.safe_load(f)
+
+    return Client(stub.base_url, prompt_profile, model)
+
+
+def is_error(response:str) -> bool:
+    """Whether a converted response is the engine's error response, which names no command."""
+
+    response = json.loads(response)
+
+    return response['thoughts']['text'].startswith('Error:') and response['command']['name'] == ''
+
+
+def generate_requests(stub:StubWebUI) -> int:
+    return sum(1 for path, _ in stub.requests if path.endswith('/generate'))
+
+
+def wait_for_recovery(client) -> bool:
+    """Wait for the health monitor to close the client's breaker."""
+
+    for _ in range(50):
+        if client.breaker.get_status()['state'] == 'closed':
+            return True
+        time.sleep(HEALTH_INTERVAL)
+
+    return False
+
+
+def token_count_errors(step:dict) -> list:
+    from auto_gpt_text_gen_plugin.telemetry import telemetry
+
+    stub = StubWebUI(responses=[step['output']]).start()
+    try:
+        client = create_client(stub)
+        stub.fail(1000, 500, ['/api/v1/token-count'])
+        estimated = telemetry.get_metrics()['counters'].get('estimated_token_counts', 0)
+        responses = [client.create_chat_completion(step['messages'], 0.7) for _ in range(5)]
+        token_counts = sum(1 for path, _ in stub.requests if path.endswith('/token-count'))
+
+        return [
+            ('completions still parse', not any(is_error(response) for response in responses)),
+            ('token counts are estimated', telemetry.get_metrics()['counters'].get('estimated_token_counts', 0) > estimated),
+            ('the broken endpoint stops being asked', token_counts < 5 * (client.MAX_RETRIES + 1)),
+        ]
+    finally:
+        stub.stop()
+
+
+def down_at_start(step:dict) -> list:
+    stub = StubWebUI(responses=[step['output']]).start()
+    try:
+        stub.down = True
+        client = create_client(stub, model=None)
+        started_degraded = not client.connected
+
+        response = client.create_chat_completion(step['messages'], 0.7)
+        failed_while_down = is_error(response)
+
+        stub.down = False
+        recovered = wait_for_recovery(client)
+        response = client.create_chat_completion(step['messages'], 0.7)
+
+        return [
+            ('the client starts without the backend', started_degraded),
+            ('completions fail while it is down', failed_while_down),
+            ('the monitor sees the backend return', recovered),
+            ('the model is loaded and completions work', client.connected and client.model == 'stub-model' and not is_error(response)),
+        ]
+    finally:
+        stub.stop()
+
+
+def down_mid_run(step:dict) -> list:
+    stub = StubWebUI(responses=[step['output']]).start()
+    try:
+        client = create_client(stub)
+        stub.down = True
+        client.create_chat_completion(step['messages'], 0.7)
+        tripped = client.breaker.get_status()['state'] != 'closed'
+
+        before = generate_requests(stub)
+        start = time.perf_counter()
+        response = client.create_chat_completion(step['messages'], 0.7)
+        failed_fast = is_error(response) and time.perf_counter() - start < 0.5 and generate_requests(stub) == before
+
+        stub.down = False
+        recovered = wait_for_recovery(client)
+        response = client.create_chat_completion(step['messages'], 0.7)
+
+        return [
+            ('the breaker opens', tripped),
+            ('completions fail fast while it is open', failed_fast),
+            ('the monitor sees the backend return', recovered),
+            ('completions work again', not is_error(response)),
+        ]
+    finally:
+        stub.stop()
+
+
+def dropped_connections(step:dict) -> list:
+    stub = StubWebUI(responses=[step['output']]).start()
+    try:
+        client = create_client(stub)
+        stub.fail(2, None, ['/api/v1/generate'])
+        response = client.create_chat_completion(step['messages'], 0.7)
+
+        return [
+            ('the completion is retried and parses', not is_error(response)),
+            ('the breaker stays closed', client.breaker.get_status()['state'] == 'closed'),
+        ]
+    finally:
+        stub.stop()
+
+
+SCENARIOS = [token_count_errors, down_at_start, down_mid_run, dropped_connections]
+
+
+def main(argv:list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args(argv)
+
+    os.environ['LOCAL_LLM_HEALTH_INTERVAL'] = str(HEALTH_INTERVAL)
+    os.environ['LOCAL_LLM_BREAKER_RESET'] = '60'
+    os.environ['LOCAL_LLM_RETRY_BACKOFF'] = '0.01'
+
+    step = load_corpus()[0]
+    failures = 0
+
+    for scenario in SCENARIOS:
+        for check, passed in scenario(step):
+            print(f"{'PASS' if passed else 'FAIL'}  {scenario.__name__}: {check}")
+            failures += 0 if passed else 1
+
+    return 1 if failures > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,340 @@
+"""
+Checks for behaviour that has broken before.
+
+Each scenario builds the part of the plugin it covers against the stub
+backend or on its own, and returns named checks. The run fails if any
+check fails.
+
+Usage:
+    python -m benchmarks.regressions
+"""
+import argparse
+import contextlib
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+
+def chat_template_middle_edit() -> list:
+    from auto_gpt_text_gen_plugin.chat_template_prompt import ChatTemplatePrompt
+
+    prompt_profile = {'template_type': 'chat_template', 'chat_template': 'chatml'}
+    engine = ChatTemplatePrompt(prompt_profile)
+    messages = [{'role': 'system', 'content': 'You are Researcher-GPT'}]
+    messages += [{'role': 'assistant' if index % 2 else 'user', 'content': f'h{index}'} for index in range(12)]
+    messages[6]['content'] = 'OLD h1'
+    engine.reshape_message(messages)
+
+    edited = [dict(message) for message in messages]
+    edited[6]['content'] = 'NEW h1'
+    prompt = engine.reshape_message(edited)
+    trimmed = edited[:1] + edited[3:]
+    collapsed = edited[:8] + edited[9:]
+    trimmed_prompt = engine.reshape_message(trimmed)
+    engine.reshape_message(edited)
+    collapsed_prompt = engine.reshape_message(collapsed)
+
+    return [
+        ('an edited middle message is rendered again', 'NEW h1' in prompt and 'OLD h1' not in prompt),
+        ('the prompt matches a fresh render', prompt == ChatTemplatePrompt(prompt_profile).reshape_message(edited)),
+        ('a trimmed history matches a fresh render', trimmed_prompt == ChatTemplatePrompt(prompt_profile).reshape_message(trimmed)),
+        ('a history missing a middle message matches a fresh render', collapsed_prompt == ChatTemplatePrompt(prompt_profile).reshape_message(collapsed)),
+    ]
+
+
+def default_history_output() -> list:
+    from auto_gpt_text_gen_plugin.engines import engines
+    from auto_gpt_text_gen_plugin.prompt_engine import normalise_message
+    from benchmarks.run import load_corpus, load_profile
+
+    prompt_profile = load_profile()
+    engine = engines.create(prompt_profile)
+    messages = [dict(message) for message in load_corpus()[0]['messages']]
+    messages[1:1] = [
+        {'role': 'system', 'content': 'Command read_file returned: ' + 'lorem ipsum dolor sit amet ' * 200},
+        {'role': 'assistant', 'content': 'I will read the file again.'},
+        {'role': 'assistant', 'content': 'I will read the file again.'},
+    ]
+
+    prompt = engine.reshape_message(messages)
+    start = prompt.index(prompt_profile['history_start']) + len(prompt_profile['history_start']) + 2
+    history = prompt[start:prompt.index(prompt_profile['history_end'], start)]
+    send_as_name = engine.get_send_as_name()
+    expected = ''.join(f"{send_as_name}{normalise_message(message['content'])}\n\n" for message in messages[1:])
+
+    # The shipped profile sends every message after the system message, whole and in order
+    return [
+        ('the default profile sends the history unchanged', history == expected),
+    ]
+
+
+def scheduler_deadline() -> list:
+    from auto_gpt_text_gen_plugin.deadline import deadline
+    from auto_gpt_text_gen_plugin.errors import DeadlineExceededError
+    from auto_gpt_text_gen_plugin.scheduler import RequestScheduler
+
+    scheduler = RequestScheduler(1)
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold_slot():
+        with scheduler.slot(RequestScheduler.PRIORITY_INTERACTIVE, 'busy'):
+            holding.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold_slot)
+    holder.start()
+    holding.wait(5)
+
+    start = time.monotonic()
+    try:
+        with deadline(0.5):
+            with scheduler.slot(RequestScheduler.PRIORITY_INTERACTIVE, 'waiting'):
+                granted = True
+    except DeadlineExceededError:
+        granted = False
+    waited = time.monotonic() - start
+    queue_depth = scheduler.get_metrics()['classes']['interactive']['queue_depth']
+
+    release.set()
+    holder.join()
+
+    with scheduler.slot(RequestScheduler.PRIORITY_INTERACTIVE, 'next'):
+        next_granted = True
+
+    return [
+        ('the wait ends with the deadline', not granted and waited < 1.0),
+        ('the expired request leaves the queue', queue_depth == 0),
+        ('later requests still get a turn', next_granted),
+    ]
+
+
+def gateway_deadline() -> list:
+    from auto_gpt_text_gen_plugin.gateway import Gateway
+    from benchmarks.stub_webui import StubWebUI
+
+    stub = StubWebUI().start()
+    try:
+        gateway = Gateway(stub.base_url, 1)
+        holding = threading.Event()
+        release = threading.Event()
+
+        def hold_slot():
+            with gateway.scheduler.slot(0, 'busy', gateway.base_url):
+                holding.set()
+                release.wait(5)
+
+        holder = threading.Thread(target=hold_slot)
+        holder.start()
+        holding.wait(5)
+
+        start = time.monotonic()
+        response = gateway.handle('/api/v1/generate', {'prompt': 'Hello', 'max_new_tokens': 5}, 0, 'waiting', 0.5)
+        waited = time.monotonic() - start
+
+        release.set()
+        holder.join()
+        forwarded = sum(1 for path, _ in stub.requests if path.endswith('/generate'))
+
+        return [
+            ('the wait ends with the client timeout', response.status_code == 504 and waited < 1.0),
+            ('the abandoned request is not forwarded', forwarded == 0),
+        ]
+    finally:
+        stub.stop()
+
+
+@contextlib.contextmanager
+def overridden_environment(environment:dict):
+    """Override some settings for the clients built inside the block."""
+
+    previous = {name: os.environ.get(name, None) for name in environment}
+    os.environ.update(environment)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def gateway_backend_endpoints() -> list:
+    from auto_gpt_text_gen_plugin.gateway import Gateway
+    from auto_gpt_text_gen_plugin.scheduler import RequestScheduler
+    from benchmarks.stub_webui import StubWebUI
+
+    checks = []
+    stub = StubWebUI(responses=['Hello there']).start()
+    try:
+        for backend in ['openai', 'llamacpp']:
+            gateway = Gateway(stub.base_url, 1, backend=backend)
+            completion_endpoint = gateway.generate_endpoint
+            completion = {'model': 'stub-model', 'prompt': 'Hello', 'temperature': 0.0, 'max_tokens': 5}
+            tokenize = {'model': 'stub-model', 'prompt': 'Hello'} if backend == 'openai' else {'content': 'Hello'}
+
+            for _ in range(2):
+                gateway.handle(completion_endpoint, completion)
+                gateway.handle('/tokenize', tokenize)
+            forwarded = [path for path, _ in stub.requests if path in [completion_endpoint, '/tokenize']]
+            stub.requests.clear()
+
+            checks.append((f'{backend}: greedy completions are cached', forwarded.count(completion_endpoint) == 1))
+            checks.append((f'{backend}: tokenizations are cached', forwarded.count('/tokenize') == 1))
+            checks.append((f'{backend}: completions are interactive', gateway.priorities.get(completion_endpoint) == RequestScheduler.PRIORITY_INTERACTIVE))
+            checks.append((f'{backend}: no Text Gen WebUI endpoints are assumed', not any(endpoint.startswith('/api/v1/') for endpoint in list(gateway.caches) + gateway.unscheduled)))
+    finally:
+        stub.stop()
+
+    return checks
+
+
+def create_controller(stub, environment:dict):
+    """Build a plugin controller against the stub with some settings overridden."""
+
+    from auto_gpt_text_gen_plugin.text_gen_plugin import TextGenPluginController
+    from benchmarks.run import PROFILE_PATH
+
+    with overridden_environment(environment):
+        return TextGenPluginController(None, stub.base_url, PROFILE_PATH, 'stub-model')
+
+
+def losing_candidates_stopped() -> list:
+    from auto_gpt_text_gen_plugin.telemetry import telemetry
+    from benchmarks.run import load_corpus
+    from benchmarks.stub_webui import StubWebUI
+
+    step = load_corpus()[0]
+    unparseable = 'I will think about it. ' * 400
+    checks = []
+
+    # Concurrent candidates: the one that parses wins and the others are stopped mid-generation
+    for backend in ['textgen', 'openai']:
+        stub = StubWebUI(responses=[step['output'], unparseable, unparseable], tokens_per_second=200).start()
+        try:
+            controller = create_controller(stub, {'LOCAL_LLM_BACKEND': backend, 'LOCAL_LLM_N_BEST': '3', 'LOCAL_LLM_MAX_CONCURRENCY': '3'})
+            cancelled = telemetry.get_metrics()['counters'].get('candidates_cancelled', 0)
+            start = time.monotonic()
+            controller.handle_chat_completion(step['messages'], 0.7, 300)
+            elapsed = time.monotonic() - start
+            time.sleep(0.5)
+            active = controller.scheduler.get_metrics()['active'].get(controller.api.base_url, 0)
+
+            checks.append((f'{backend}: the first candidate that parses is returned without waiting for the rest', elapsed < 3))
+            checks.append((f'{backend}: the connections of the losing candidates are closed', telemetry.get_metrics()['counters'].get('candidates_cancelled', 0) > cancelled))
+            checks.append((f'{backend}: the losing candidates give their slots back', active == 0))
+            if backend == 'textgen':
+                checks.append((f'{backend}: the backend is asked to stop the losing candidates', stub.stopped > 0))
+        finally:
+            stub.stop()
+
+    # One slot: candidates run one at a time, so none is sent after one parses
+    stub = StubWebUI(responses=[step['output'], unparseable, unparseable]).start()
+    try:
+        controller = create_controller(stub, {'LOCAL_LLM_N_BEST': '3', 'LOCAL_LLM_MAX_CONCURRENCY': '1'})
+        controller.handle_chat_completion(step['messages'], 0.7, 300)
+        generated = sum(1 for path, _ in stub.requests if path.endswith('/generate'))
+        checks.append(('one slot: candidates after the one that parses are not sent', generated == 1))
+    finally:
+        stub.stop()
+
+    return checks
+
+
+def telemetry_off_the_request_path() -> list:
+    import tempfile
+    from auto_gpt_text_gen_plugin.telemetry import Telemetry, telemetry
+    from benchmarks.run import load_corpus
+    from benchmarks.stub_webui import StubWebUI
+
+    step = load_corpus()[0]
+    checks = []
+
+    # Generated tokens come from the response or an estimate, not another token-count request
+    stub = StubWebUI(responses=[step['output']]).start()
+    try:
+        controller = create_controller(stub, {'LOCAL_LLM_N_BEST': '1'})
+        generated = telemetry.get_metrics()['counters'].get('generated_tokens', 0)
+        controller.handle_chat_completion(step['messages'], 0.7, 300)
+        counted = [body for path, body in stub.requests if path.endswith('/token-count')]
+        checks.append(('no token-count request is sent for the generated text', all(body.get('prompt') != step['output'] for body in counted)))
+        checks.append(('generated tokens are still counted', telemetry.get_metrics()['counters'].get('generated_tokens', 0) > generated))
+    finally:
+        stub.stop()
+
+    # Spans are buffered and written in batches by the background thread
+    with tempfile.TemporaryDirectory() as directory:
+        trace_path = os.path.join(directory, 'trace.jsonl')
+        traced = Telemetry(trace_path, os.path.join(directory, 'metrics.prom'))
+        for _ in range(10):
+            traced.record_span('phase', 0.001)
+        checks.append(('spans are not written on the request path', not os.path.exists(trace_path)))
+        traced.flush()
+        with open(trace_path) as f:
+            checks.append(('buffered spans are all written on flush', len(f.read().splitlines()) == 10))
+
+    return checks
+
+
+def route_model_from_its_server() -> list:
+    import socket
+    from benchmarks.stub_webui import StubWebUI
+
+    checks = []
+    main = StubWebUI().start()
+    other = StubWebUI(models=['other-model']).start()
+    try:
+        controller = create_controller(main, {})
+        prompt_config = {'template_type': 'monolithic'}
+
+        routes = controller.load_routes(prompt_config, {'summarisation': {'base_url': other.base_url}})
+        checks.append(('a route to another server uses the model it reports', routes['summarisation'][0].model == 'other-model'))
+
+        routes = controller.load_routes(prompt_config, {'summarisation': {'sampling': {'top_p': 0.1}}})
+        checks.append(('a route to the main server keeps the main model', routes['summarisation'][0].model == 'stub-model'))
+
+        # A port nothing listens on
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            unreachable = f'http://127.0.0.1:{sock.getsockname()[1]}'
+        try:
+            with overridden_environment({'LOCAL_LLM_MAX_RETRIES': '0'}):
+                controller.load_routes(prompt_config, {'summarisation': {'base_url': unreachable}})
+            raised = False
+        except ValueError:
+            raised = True
+        checks.append(('a route whose model is unknown fails to load', raised))
+    finally:
+        main.stop()
+        other.stop()
+
+    return checks
+
+
+SCENARIOS = [chat_template_middle_edit, default_history_output, scheduler_deadline, gateway_deadline, gateway_backend_endpoints, losing_candidates_stopped, telemetry_off_the_request_path, route_model_from_its_server]
+
+
+def main(argv:list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', help='Scenarios to run. Defaults to all.')
+    options = parser.parse_args(argv)
+
+    failures = 0
+
+    for scenario in SCENARIOS:
+        if len(options.names) > 0 and scenario.__name__ not in options.names:
+            continue
+        for check, passed in scenario():
+            print(f"{'PASS' if passed else 'FAIL'}  {scenario.__name__}: {check}")
+            failures += 0 if passed else 1
+
+    return 1 if failures > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
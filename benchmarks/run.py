@@ -0,0 +1,344 @@
+"""
+Benchmarks for the plugin's hot paths, run against a stub Text Gen WebUI.
+
+Results are compared with a stored baseline and the run fails when any
+benchmark is slower than the baseline by more than the tolerance.
+
+Usage:
+    python -m benchmarks.run [--save-baseline] [--tolerance 0.25] [--latency 0] [--token-rate 0]
+"""
+import argparse
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import yaml
+
+from benchmarks.stub_webui import StubWebUI
+
+BASELINE_PATH = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+CORPUS_PATH = os.path.join(ROOT, 'benchmarks', 'corpus', 'agent_steps.jsonl')
+PROFILE_PATH = os.path.join(ROOT, 'prompt_templates', 'monolithic.yaml')
+
+BENCHMARKS = {}
+
+# Seconds per operation that a benchmark must stay under, whatever the baseline
+TIME_LIMITS = {}
+
+
+def benchmark(name:str, time_limit:float = None):
+    """Register a benchmark. It receives the run's options and returns seconds per operation."""
+
+    def register(function):
+        BENCHMARKS[name] = function
+        if time_limit is not None:
+            TIME_LIMITS[name] = time_limit
+        return function
+
+    return register
+
+
+def measure(operation, iterations:int, repeats:int = 5) -> float:
+    """
+    Time an operation.
+
+    Args:
+        operation (callable): The operation to time.
+        iterations (int): How many times to run it per repeat.
+        repeats (int): How many repeats to take the median of.
+
+    Returns:
+        float: The median seconds per operation.
+    """
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            operation()
+        timings.append((time.perf_counter() - start) / iterations)
+
+    return statistics.median(timings)
+
+
+def load_corpus() -> list:
+    """
+    Load the recorded agent steps.
+
+    Returns:
+        list: Dictionaries of messages and the model output they produced.
+    """
+
+    with open(CORPUS_PATH, 'r') as f:
+        return [json.loads(line) for line in f if line.strip() != '']
+
+
+def load_profile() -> dict:
+    with open(PROFILE_PATH, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def start_stub(options) -> StubWebUI:
+    """Start a stub backend that replays the corpus outputs."""
+
+    return StubWebUI(
+        responses=[step['output'] for step in load_corpus()],
+        latency=options.latency,
+        tokens_per_second=options.token_rate,
+    ).start()
+
+
+@benchmark('reshape_message')
+def bench_reshape_message(options) -> float:
+    from auto_gpt_text_gen_plugin.monolithic_prompt import MonolithicPrompt
+
+    engine = MonolithicPrompt(load_profile())
+    corpus = load_corpus()
+
+    def operation():
+        for step in corpus:
+            engine.reshape_message(step['messages'])
+
+    return measure(operation, 20) / len(corpus)
+
+
+@benchmark('reshape_message_500')
+def bench_reshape_message_500(options) -> float:
+    from auto_gpt_text_gen_plugin.monolithic_prompt import MonolithicPrompt
+
+    engine = MonolithicPrompt(load_profile())
+    corpus = load_corpus()
+    history = [
+        {'role': 'assistant' if index % 2 else 'user', 'content': f'{step["output"]} ({index})'}
+        for index, step in zip(range(500), itertools.cycle(corpus))
+    ]
+    messages = [corpus[0]['messages'][0], *history, corpus[0]['messages'][-1]]
+
+    return measure(lambda: engine.reshape_message(messages), 20)
+
+
+@benchmark('reshape_response')
+def bench_reshape_response(options) -> float:
+    from auto_gpt_text_gen_plugin.monolithic_prompt import MonolithicPrompt
+
+    engine = MonolithicPrompt(load_profile())
+    outputs = [step['output'] for step in load_corpus()]
+
+    def operation():
+        for output in outputs:
+            engine.reshape_response(output)
+
+    return measure(operation, 20) / len(outputs)
+
+
+def bench_chat_template_render(history_length:int) -> float:
+    """
+    Time one agent step of the chat template engine: append a message to a
+    history of the given length and render the prompt.
+    """
+
+    from auto_gpt_text_gen_plugin.chat_template_prompt import ChatTemplatePrompt
+
+    engine = ChatTemplatePrompt({'template_type': 'chat_template', 'chat_template': 'chatml'})
+    corpus = load_corpus()
+    system_message = corpus[0]['messages'][0]
+    history = [
+        {'role': 'assistant' if index % 2 else 'user', 'content': f'{step["output"]} ({index})'}
+        for index, step in zip(range(history_length), itertools.cycle(corpus))
+    ]
+    messages = [system_message, *history]
+    engine.reshape_message(messages)
+    step = itertools.count()
+
+    def operation():
+        messages.append({'role': 'user', 'content': f'Command returned: step {next(step)}'})
+        engine.reshape_message(messages)
+        messages.pop()
+
+    return measure(operation, 50)
+
+
+for history_length in [10, 100, 500]:
+    benchmark(f'chat_template_render_{history_length}')(lambda options, history_length=history_length: bench_chat_template_render(history_length))
+
+
+@benchmark('select_history_2000')
+def bench_select_history_2000(options) -> float:
+    """Time one step of the history selector over 2000 messages, with the embeddings of earlier steps cached."""
+
+    from auto_gpt_text_gen_plugin.history import EmbeddingCache, HistorySelector
+    from benchmarks.stub_webui import embed
+
+    corpus = load_corpus()
+    messages = [
+        {'role': 'assistant' if index % 2 else 'user', 'content': f'{step["output"]} ({index})'}
+        for index, step in zip(range(2000), itertools.cycle(corpus))
+    ]
+    selector = HistorySelector(EmbeddingCache(lambda texts: [embed(text) for text in texts], 8192), 2000)
+    selector.select(messages, ['Find the best open source language models'])
+    step = itertools.count()
+
+    def operation():
+        selector.select(messages, ['Find the best open source language models', f'google query {next(step)}'])
+
+    return measure(operation, 5)
+
+
+def pathological_outputs(length:int = 100000) -> list:
+    """
+    Model outputs that made the old response parser backtrack: long whitespace
+    runs, unterminated quotes, repeated keys and runaway repetition.
+
+    Args:
+        length (int): The approximate length of each output.
+
+    Returns:
+        list: The outputs.
+    """
+
+    return [
+        'plan_summary: stalled' + ' ' * length + 'x',
+        '{"thoughts": {"text": "' + 'a' * length,
+        '{"text": "a \\"' * (length // 14),
+        'next_steps:\n1. repeat\n' * (length // 20),
+        'plan_summary: loop\nreasoning: again\n' * (length // 36),
+    ]
+
+
+@benchmark('parse_pathological', time_limit=2.0)
+def bench_parse_pathological(options) -> float:
+    """Time the response parsers on 100k-character pathological outputs, with the input cap disabled."""
+
+    from auto_gpt_text_gen_plugin.monolithic_prompt import MonolithicPrompt
+
+    engine = MonolithicPrompt(load_profile())
+    engine.MAX_RESPONSE_CHARS = 0
+    outputs = pathological_outputs()
+
+    def operation():
+        for output in outputs:
+            engine.reshape_response(output)
+            engine.recover_json_response(output)
+
+    return measure(operation, 1, 3)
+
+
+@benchmark('chat_completion')
+def bench_chat_completion(options) -> float:
+    from auto_gpt_text_gen_plugin.text_gen_plugin import TextGenPluginController
+
+    stub = start_stub(options)
+    try:
+        controller = TextGenPluginController(None, stub.base_url, PROFILE_PATH, 'stub-model')
+        corpus = load_corpus()
+
+        def operation():
+            for step in corpus:
+                controller.handle_chat_completion(step['messages'], 0.5, 300)
+
+        return measure(operation, 2) / len(corpus)
+    finally:
+        stub.stop()
+
+
+@benchmark('embedding')
+def bench_embedding(options) -> float:
+    from auto_gpt_text_gen_plugin.text_gen_plugin import TextGenPluginController
+
+    stub = start_stub(options)
+    try:
+        controller = TextGenPluginController(None, stub.base_url, PROFILE_PATH, 'stub-model')
+        texts = [message['content'] for step in load_corpus() for message in step['messages'][1:]]
+
+        def operation():
+            for text in texts:
+                controller.handle_get_embedding(text)
+
+        return measure(operation, 2) / len(texts)
+    finally:
+        stub.stop()
+
+
+def compare(results:dict, baseline:dict, tolerance:float) -> list:
+    """
+    Find the benchmarks that regressed against the baseline.
+
+    Args:
+        results (dict): Seconds per operation of this run.
+        baseline (dict): Seconds per operation of the baseline.
+        tolerance (float): The allowed slowdown, as a fraction of the baseline.
+
+    Returns:
+        list: Descriptions of the regressions.
+    """
+
+    regressions = []
+    for name, seconds in results.items():
+        if name in baseline and seconds > baseline[name] * (1 + tolerance):
+            regressions.append(f'{name}: {seconds * 1e6:.1f}us per op, baseline {baseline[name] * 1e6:.1f}us (+{(seconds / baseline[name] - 1) * 100:.0f}%)')
+
+    return regressions
+
+
+def main(argv:list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', help='Benchmarks to run. Defaults to all.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline.')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='The baseline file.')
+    parser.add_argument('--require-baseline', action='store_true', help='Fail if there is no baseline to compare against, as in CI.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown against the baseline.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the stub backend adds to every request.')
+    parser.add_argument('--token-rate', type=float, default=0.0, help='Stub generation speed in tokens per second, 0 for instant.')
+    options = parser.parse_args(argv)
+
+    results = {}
+    for name in options.names or BENCHMARKS:
+        results[name] = BENCHMARKS[name](options)
+        print(f'{name:32} {results[name] * 1e6:12.1f} us/op')
+
+    over_limit = [
+        f'{name}: {seconds:.3f}s per op, limit {TIME_LIMITS[name]:.3f}s'
+        for name, seconds in results.items() if name in TIME_LIMITS and seconds > TIME_LIMITS[name]
+    ]
+    if len(over_limit) > 0:
+        print('\nOVER TIME LIMIT:')
+        for line in over_limit:
+            print(f'  {line}')
+        return 1
+
+    if options.save_baseline:
+        baseline = {}
+        if os.path.exists(options.baseline):
+            with open(options.baseline, 'r') as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(options.baseline, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print(f'Saved baseline to {options.baseline}')
+        return 0
+
+    if not os.path.exists(options.baseline):
+        print(f'No baseline at {options.baseline}, run with --save-baseline to create one.')
+        return 1 if options.require_baseline else 0
+
+    with open(options.baseline, 'r') as f:
+        regressions = compare(results, json.load(f), options.tolerance)
+
+    if len(regressions) > 0:
+        print('\nREGRESSIONS:')
+        for regression in regressions:
+            print(f'  {regression}')
+        return 1
+
+    print('\nNo regressions against the baseline.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Stress test for concurrent use of one prompt engine.
+
+Several simulated agents, each with its own system message, share one
+engine instance. Thousands of reshapes and response conversions are
+interleaved across a thread pool, and every result is compared with the
+result of the same call made on its own. The run fails if any result
+differs, which means state leaked between requests.
+
+Usage:
+    python -m benchmarks.stress [--agents 8] [--calls 4000] [--threads 16] [--profile prompt_templates/monolithic.yaml]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import yaml
+
+from benchmarks.run import PROFILE_PATH, load_corpus
+
+
+def make_agents(count:int) -> list:
+    """
+    Build the requests of several agents from the corpus, giving each agent
+    its own operating system and command list so their prompts differ.
+
+    Args:
+        count (int): The number of agents.
+
+    Returns:
+        list: Per agent, a list of (messages, output) pairs.
+    """
+
+    corpus = load_corpus()
+    agents = []
+
+    for agent in range(count):
+        steps = []
+        for step in corpus:
+            messages = [dict(message) for message in step['messages']]
+            messages[0]['content'] = messages[0]['content'].replace(
+                'The OS you are running on is:', f'The OS you are running on is: agent-{agent}-os',
+            ).replace('Commands:\n', f'Commands:\n0. agent_{agent}_command: "agent_{agent}_command", args: \n')
+            output = step['output'].replace('command_name: ', f'command_name: agent_{agent}_')
+            steps.append((messages, output))
+        agents.append(steps)
+
+    return agents
+
+
+def main(argv:list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--agents', type=int, default=8, help='The number of simulated agents.')
+    parser.add_argument('--calls', type=int, default=4000, help='The number of interleaved calls.')
+    parser.add_argument('--threads', type=int, default=16, help='The size of the thread pool.')
+    parser.add_argument('--profile', default=PROFILE_PATH, help='The prompt profile to build the engine from.')
+    options = parser.parse_args(argv)
+
+    from auto_gpt_text_gen_plugin.engines import engines
+
+    with open(options.profile, 'r') as f:
+        prompt_profile = yaml.safe_load(f)
+
+    agents = make_agents(options.agents)
+
+    # The expected results, each computed on a fresh engine with nothing else running
+    expected = {}
+    for agent, steps in enumerate(agents):
+        for index, (messages, output) in enumerate(steps):
+            engine = engines.create(prompt_profile)
+            expected[(agent, index)] = (engine.reshape_message(messages), engine.reshape_response(output))
+
+    engine = engines.create(prompt_profile)
+    calls = [(random.randrange(len(agents)), random.randrange(len(agents[0]))) for _ in range(options.calls)]
+
+    def run(call:tuple) -> bool:
+        agent, index = call
+        messages, output = agents[agent][index]
+        return (engine.reshape_message(messages), engine.reshape_response(output)) == expected[call]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.threads) as executor:
+        results = list(executor.map(run, calls))
+    elapsed = time.perf_counter() - start
+
+    failures = results.count(False)
+    print(f'{len(calls)} calls from {len(agents)} agents on {options.threads} threads in {elapsed:.2f}s, {failures} mismatched')
+
+    return 1 if failures > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
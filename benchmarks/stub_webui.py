@@ -0,0 +1,308 @@
+"""
+A stand-in for Text Gen WebUI's API with configurable latency and token rate,
+so the plugin can be benchmarked without a model. It also serves the
+OpenAI-compatible API and llama.cpp's native endpoints, one stub for every
+backend adapter.
+"""
+import hashlib
+import itertools
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def count_tokens(text:str) -> int:
+    """
+    Approximate a tokenizer: roughly four characters per token.
+
+    Args:
+        text (str): The text to count.
+
+    Returns:
+        int: The number of tokens.
+    """
+
+    return max(1, len(text) // 4) if text else 0
+
+
+def tokenize(text:str, add_special:bool = True) -> list:
+    """
+    Approximate a tokenizer's IDs: every whitespace character is a token and
+    words are split into pieces of up to four characters. Texts split at
+    whitespace tokenize to the same IDs as the whole text.
+
+    Args:
+        text (str): The text to tokenize.
+        add_special (bool): Whether to start with a BOS token, ID 1.
+
+    Returns:
+        list: The token IDs.
+    """
+
+    ids = [int(hashlib.md5(piece.encode('utf-8')).hexdigest()[:4], 16) + 2 for piece in re.findall(r'\s|\S{1,4}', text)]
+
+    return [1] + ids if add_special else ids
+
+
+def embed(text:str, dimensions:int = 256) -> list:
+    """
+    A deterministic bag-of-words embedding, so texts that share words have
+    similar vectors.
+
+    Args:
+        text (str): The text to embed.
+        dimensions (int): The size of the vector.
+
+    Returns:
+        list: The unit-length embedding.
+    """
+
+    vector = [0.0] * dimensions
+    for word in re.findall(r'\w+', text.lower()):
+        bucket = int(hashlib.md5(word.encode('utf-8')).hexdigest(), 16) % dimensions
+        vector[bucket] += 1.0
+
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+
+    return [value / norm for value in vector]
+
+
+class StubWebUI:
+    """
+    Serves /api/v1/generate, /api/v1/token-count, /api/v1/model,
+    /api/v1/get-embeddings and /api/v1/stop-stream on a local port, along with the OpenAI-compatible
+    /v1/completions, /v1/embeddings, /v1/models and /tokenize, and llama.cpp's
+    /completion and /props.
+
+    Failures can be injected to test how the plugin copes with an unhealthy
+    backend: set `down` to fail every request, or call `fail` to fail the
+    next few.
+    """
+
+    def __init__(self, responses:list = None, latency:float = 0.0, tokens_per_second:float = 0.0,
+                 context_size:int = 2048, models:list = None) -> None:
+        """
+        Args:
+            responses (list): Generated texts, returned in turn. Defaults to an empty completion.
+            latency (float): Seconds added to every request.
+            tokens_per_second (float): Generation speed. 0 generates instantly.
+            context_size (int): The truncation length reported for the model.
+            models (list): The model names to list. Defaults to one stub model.
+        """
+
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.context_size = context_size
+        self.models = models or ['stub-model']
+        self.requests = []
+
+        self._responses = itertools.cycle(responses or [''])
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._server = None
+        self.stopped = 0
+
+        # Injected failures: the status to reply with, or None to drop the connection
+        self.down = False
+        self.down_status = 503
+        self._failures = []
+
+        self.routes = {
+            '/api/v1/generate': self.generate,
+            '/api/v1/token-count': self.token_count,
+            '/api/v1/model': self.model,
+            '/api/v1/get-embeddings': self.get_embeddings,
+            '/api/v1/stop-stream': self.stop_stream,
+            '/v1/completions': self.openai_completions,
+            '/v1/embeddings': self.openai_embeddings,
+            '/tokenize': self.tokenize,
+            '/completion': self.llamacpp_completion,
+        }
+        self.get_routes = {
+            '/v1/models': self.openai_models,
+            '/props': self.llamacpp_props,
+        }
+
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+
+    def start(self) -> 'StubWebUI':
+        """Start serving on a free port in a background thread."""
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                self.do_POST(stub.get_routes)
+
+            def do_POST(self, routes:dict = None) -> None:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                route = (routes or stub.routes).get(self.path.replace('//', '/'))
+                with stub._lock:
+                    stub.requests.append((self.path, body))
+
+                if stub.latency > 0:
+                    time.sleep(stub.latency)
+
+                failing, failure_status = stub.take_failure(self.path.replace('//', '/'))
+                if failing and failure_status is None:
+                    self.close_connection = True
+                    return
+
+                if failing:
+                    status, payload = failure_status, {'error': 'injected failure'}
+                else:
+                    status, payload = (404, {'error': 'not found'}) if route is None else route(body)
+                data = json.dumps(payload).encode('utf-8')
+                # Clients that hit their deadline hang up without reading the reply
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except OSError:
+                    pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+        return self
+
+
+    def stop(self) -> None:
+        """Stop serving."""
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+    def fail(self, count:int = 1, status:int|None = 503, paths:list = None) -> None:
+        """
+        Fail the next requests.
+
+        Args:
+            count (int): The number of requests to fail.
+            status (int|None): The status to reply with, or None to close the connection without replying.
+            paths (list): Only fail requests to these paths. Defaults to any path.
+        """
+
+        with self._lock:
+            self._failures.extend([(status, paths)] * count)
+
+
+    def take_failure(self, path:str) -> tuple:
+        """
+        Decide whether a request fails, using up an injected failure if it does.
+
+        Args:
+            path (str): The request's path.
+
+        Returns:
+            tuple: Whether the request fails, and the status to reply with or None to drop the connection.
+        """
+
+        with self._lock:
+            if self.down:
+                return True, self.down_status
+            for index, (status, paths) in enumerate(self._failures):
+                if paths is None or path in paths:
+                    del self._failures[index]
+                    return True, status
+
+        return False, None
+
+
+    def next_response(self, stopping_strings:list) -> str:
+        with self._lock:
+            text = next(self._responses)
+
+        for stopping_string in stopping_strings or []:
+            if stopping_string in text:
+                text = text[:text.find(stopping_string)]
+
+        # Generation ends early, with no text, if a stop request arrives
+        if self.tokens_per_second > 0:
+            self._stop.clear()
+            if self._stop.wait(count_tokens(text) / self.tokens_per_second):
+                with self._lock:
+                    self.stopped += 1
+                return ''
+
+        return text
+
+
+    def generate(self, body:dict) -> tuple:
+        return 200, {'results': [{'text': self.next_response(body.get('stopping_strings', None))}]}
+
+
+    def token_count(self, body:dict) -> tuple:
+        return 200, {'results': [{'tokens': count_tokens(body.get('prompt', ''))}]}
+
+
+    def model(self, body:dict) -> tuple:
+        if body.get('action') == 'list':
+            return 200, {'result': self.models}
+
+        return 200, {'result': {'model_name': body.get('model_name'), 'shared.settings': {'truncation_length': self.context_size}}}
+
+
+    def get_embeddings(self, body:dict) -> tuple:
+        texts = body.get('text')
+        texts = texts if isinstance(texts, list) else [texts]
+
+        return 200, {'results': [{'embeddings': embed(str(text))} for text in texts]}
+
+
+    def stop_stream(self, body:dict) -> tuple:
+        self._stop.set()
+
+        return 200, {'results': 'success'}
+
+
+    def openai_completions(self, body:dict) -> tuple:
+        stop = body.get('stop', None)
+        text = self.next_response([stop] if isinstance(stop, str) else stop)
+
+        return 200, {'object': 'text_completion', 'model': body.get('model'), 'choices': [{'index': 0, 'text': text, 'finish_reason': 'stop'}]}
+
+
+    def openai_embeddings(self, body:dict) -> tuple:
+        texts = body.get('input')
+        texts = texts if isinstance(texts, list) else [texts]
+
+        return 200, {'object': 'list', 'data': [{'index': index, 'embedding': embed(str(text))} for index, text in enumerate(texts)]}
+
+
+    def openai_models(self, body:dict) -> tuple:
+        return 200, {'object': 'list', 'data': [{'id': model, 'object': 'model', 'max_model_len': self.context_size} for model in self.models]}
+
+
+    def tokenize(self, body:dict) -> tuple:
+        # vLLM sends prompt and adds special tokens by default, llama.cpp sends content and does not
+        if 'prompt' in body:
+            tokens = tokenize(body['prompt'], body.get('add_special_tokens', True))
+        else:
+            tokens = tokenize(body.get('content', ''), body.get('add_special', False))
+
+        return 200, {'count': len(tokens), 'tokens': tokens}
+
+
+    def llamacpp_completion(self, body:dict) -> tuple:
+        return 200, {'content': self.next_response(body.get('stop', None)), 'stop': True}
+
+
+    def llamacpp_props(self, body:dict) -> tuple:
+        return 200, {'default_generation_settings': {'n_ctx': self.context_size, 'model': self.models[0]}}
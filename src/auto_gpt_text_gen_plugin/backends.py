@@ -0,0 +1,533 @@
+import abc
+from .log import log
+
+
+class Backend(abc.ABC):
+    """
+    Maps the client's requests onto a server's API.
+
+    Each request method returns the HTTP method, endpoint and JSON body to
+    send, and each parse method reads the result out of the JSON response.
+    The client keeps the transport, retries and telemetry, so an adapter
+    only describes the shape of the API. Model properties use Text Gen
+    WebUI's parameter names, and adapters rename or drop them. Adapters
+    for servers that take the prompt as a list of token IDs derive from
+    TokenizingBackend instead, which sets `supports_token_ids`.
+    """
+
+    name = None
+    supports_token_ids = False
+
+
+    @abc.abstractmethod
+    def generate_request(self, model:str, prompt:str|list, temperature:float, max_tokens:int, model_properties:dict = None) -> tuple:
+        """
+        Build a completion request.
+
+        Args:
+            model (str): The model to generate with.
+            prompt (str|list): The prompt to complete, as text or as token IDs.
+            temperature (float): The temperature to use for the completion.
+            max_tokens (int): The maximum number of tokens to generate.
+            model_properties (dict): The properties of the model to use on submission.
+
+        Returns:
+            tuple: The HTTP method, endpoint and body.
+        """
+
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def parse_generate(self, response_json:dict) -> str:
+        """
+        Read the generated text from a completion response.
+
+        Args:
+            response_json (dict): The response.
+
+        Returns:
+            str: The generated text.
+        """
+
+        raise NotImplementedError
+
+
+    def parse_generated_tokens(self, response_json:dict) -> int|None:
+        """
+        Read the number of generated tokens from a completion response.
+
+        Args:
+            response_json (dict): The response.
+
+        Returns:
+            int|None: The number of tokens, or None if the server does not report it.
+        """
+
+        return None
+
+
+    @abc.abstractmethod
+    def token_count_request(self, model:str, text:str) -> tuple:
+        """
+        Build a request to count the tokens of a text.
+
+        Args:
+            model (str): The model whose tokenizer to use.
+            text (str): The text.
+
+        Returns:
+            tuple: The HTTP method, endpoint and body.
+        """
+
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def parse_token_count(self, response_json:dict) -> int:
+        """
+        Read the token count from a response.
+
+        Args:
+            response_json (dict): The response.
+
+        Returns:
+            int: The number of tokens.
+        """
+
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def embeddings_request(self, model:str, texts:list) -> tuple:
+        """
+        Build a request for the embeddings of one or more texts.
+
+        Args:
+            model (str): The model to embed with.
+            texts (list): The texts.
+
+        Returns:
+            tuple: The HTTP method, endpoint and body.
+        """
+
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def parse_embeddings(self, response_json:dict) -> list:
+        """
+        Read the embeddings from a response.
+
+        Args:
+            response_json (dict): The response.
+
+        Returns:
+            list: One embedding per text, in the order they were sent.
+        """
+
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def list_models_request(self) -> tuple:
+        """
+        Build a request for the models the server offers.
+
+        Returns:
+            tuple: The HTTP method, endpoint and body.
+        """
+
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def parse_models(self, response_json:dict) -> list:
+        """
+        Read the model names from a response.
+
+        Args:
+            response_json (dict): The response.
+
+        Returns:
+            list: The model names.
+        """
+
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def load_model_request(self, model:str) -> tuple:
+        """
+        Build a request that loads a model, or describes it if the server
+        cannot switch models, so its context size can be read.
+
+        Args:
+            model (str): The model.
+
+        Returns:
+            tuple: The HTTP method, endpoint and body.
+        """
+
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def parse_context_size(self, response_json:dict, model:str) -> int|None:
+        """
+        Read a model's context size from a response.
+
+        Args:
+            response_json (dict): The response.
+            model (str): The model.
+
+        Returns:
+            int|None: The context size, or None if the server does not report it.
+        """
+
+        raise NotImplementedError
+
+
+    def parse_load_model_request(self, request:dict) -> str|None:
+        """
+        Read the model a request built by `load_model_request` loads, for
+        relays such as the gateway that need to know when the model changes.
+
+        Args:
+            request (dict): The JSON body.
+
+        Returns:
+            str|None: The model, or None if the request does not load one.
+        """
+
+        return None
+
+
+    def stop_request(self) -> tuple|None:
+        """
+        Build a request that stops the generation running on the server.
+
+        Returns:
+            tuple|None: The HTTP method, endpoint and body, or None if the server stops when the client disconnects.
+        """
+
+        return None
+
+
+    def map_properties(self, model_properties:dict, names:dict) -> dict:
+        """
+        Rename model properties for an API, dropping those it has no
+        equivalent for and those left at a "not set" value.
+
+        Args:
+            model_properties (dict): The properties, with Text Gen WebUI's names.
+            names (dict): The API's name for each supported property.
+
+        Returns:
+            dict: The renamed properties.
+        """
+
+        mapped = {}
+        for name, value in (model_properties or {}).items():
+            if name not in names:
+                log.debug("The %s backend does not support %s, leaving it out", self.name, name)
+                continue
+            if name == 'seed' and isinstance(value, int) and value < 0:
+                continue
+            if name == 'stopping_strings' and len(value) == 0:
+                continue
+            mapped[names[name]] = value
+
+        return mapped
+
+
+class TextGenWebUIBackend(Backend):
+    """Text Gen WebUI's legacy API, served under /api/v1."""
+
+    name = 'textgen'
+
+    API_ENDPOINT_GENERATE = '/api/v1/generate'
+    API_ENDPOINT_MODELS = '/api/v1/model'
+    API_ENDPOINT_TOKENCOUNT = '/api/v1/token-count'
+    API_ENDPOINT_EMBEDDINGS = '/api/v1/get-embeddings'
+    API_ENDPOINT_STOP = '/api/v1/stop-stream'
+
+
+    def generate_request(self, model:str, prompt:str|list, temperature:float, max_tokens:int, model_properties:dict = None) -> tuple:
+        request = {
+            'prompt': prompt,
+            'temperature': float(temperature),
+            'max_new_tokens': max(1, max_tokens)
+        }
+
+        # The API takes the properties under their own names
+        if model_properties is not None:
+            request.update(model_properties)
+
+        return 'POST', self.API_ENDPOINT_GENERATE, request
+
+
+    def parse_generate(self, response_json:dict) -> str:
+        return response_json['results'][0]['text']
+
+
+    def token_count_request(self, model:str, text:str) -> tuple:
+        return 'POST', self.API_ENDPOINT_TOKENCOUNT, {'prompt': text}
+
+
+    def parse_token_count(self, response_json:dict) -> int:
+        return response_json['results'][0]['tokens']
+
+
+    def embeddings_request(self, model:str, texts:list) -> tuple:
+        return 'POST', self.API_ENDPOINT_EMBEDDINGS, {'text': texts[0] if len(texts) == 1 else texts}
+
+
+    def parse_embeddings(self, response_json:dict) -> list:
+        return [result['embeddings'] for result in response_json['results']]
+
+
+    def list_models_request(self) -> tuple:
+        return 'POST', self.API_ENDPOINT_MODELS, {'action': 'list'}
+
+
+    def parse_models(self, response_json:dict) -> list:
+        models = response_json['result']
+
+        return [models] if isinstance(models, str) else models
+
+
+    def load_model_request(self, model:str) -> tuple:
+        return 'POST', self.API_ENDPOINT_MODELS, {'action': 'load', 'model_name': model}
+
+
+    def parse_load_model_request(self, request:dict) -> str|None:
+        return request.get('model_name', None) if request.get('action', None) == 'load' else None
+
+
+    def parse_context_size(self, response_json:dict, model:str) -> int|None:
+        return response_json['result']['shared.settings']['truncation_length']
+
+
+    def stop_request(self) -> tuple|None:
+        return 'POST', self.API_ENDPOINT_STOP, {}
+
+
+class TokenizingBackend(Backend):
+    """
+    A server that tokenizes text on request and accepts the prompt as a
+    list of token IDs.
+    """
+
+    supports_token_ids = True
+
+
+    @abc.abstractmethod
+    def tokenize_request(self, model:str, text:str, add_special:bool = True) -> tuple:
+        """
+        Build a request for the token IDs of a text.
+
+        Args:
+            model (str): The model whose tokenizer to use.
+            text (str): The text.
+            add_special (bool): Whether to add the tokens that start a sequence, such as BOS.
+
+        Returns:
+            tuple: The HTTP method, endpoint and body.
+        """
+
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def parse_tokens(self, response_json:dict) -> list:
+        """
+        Read the token IDs from a response.
+
+        Args:
+            response_json (dict): The response.
+
+        Returns:
+            list: The token IDs.
+        """
+
+        raise NotImplementedError
+
+
+class OpenAIBackend(TokenizingBackend):
+    """
+    OpenAI-compatible servers such as vLLM, served under /v1. Embeddings of
+    several texts are requested in one batch. Token counts use the
+    /tokenize endpoint vLLM adds to the API.
+    """
+
+    name = 'openai'
+
+    API_ENDPOINT_COMPLETIONS = '/v1/completions'
+    API_ENDPOINT_EMBEDDINGS = '/v1/embeddings'
+    API_ENDPOINT_MODELS = '/v1/models'
+    API_ENDPOINT_TOKENIZE = '/tokenize'
+
+    # Text Gen WebUI property: OpenAI-compatible name. top_k and repetition_penalty are server extensions.
+    PROPERTY_NAMES = {
+        'seed': 'seed',
+        'top_p': 'top_p',
+        'top_k': 'top_k',
+        'repetition_penalty': 'repetition_penalty',
+        'stopping_strings': 'stop',
+        'grammar_string': 'guided_grammar',
+    }
+
+
+    def generate_request(self, model:str, prompt:str|list, temperature:float, max_tokens:int, model_properties:dict = None) -> tuple:
+        request = {
+            'model': model,
+            'prompt': prompt,
+            'temperature': float(temperature),
+            'max_tokens': max(1, max_tokens),
+            **self.map_properties(model_properties, self.PROPERTY_NAMES),
+        }
+
+        return 'POST', self.API_ENDPOINT_COMPLETIONS, request
+
+
+    def parse_generate(self, response_json:dict) -> str:
+        return response_json['choices'][0]['text']
+
+
+    def parse_generated_tokens(self, response_json:dict) -> int|None:
+        return response_json.get('usage', {}).get('completion_tokens', None)
+
+
+    def token_count_request(self, model:str, text:str) -> tuple:
+        return 'POST', self.API_ENDPOINT_TOKENIZE, {'model': model, 'prompt': text}
+
+
+    def parse_token_count(self, response_json:dict) -> int:
+        if 'count' in response_json:
+            return response_json['count']
+
+        return len(response_json['tokens'])
+
+
+    def tokenize_request(self, model:str, text:str, add_special:bool = True) -> tuple:
+        return 'POST', self.API_ENDPOINT_TOKENIZE, {'model': model, 'prompt': text, 'add_special_tokens': add_special}
+
+
+    def parse_tokens(self, response_json:dict) -> list:
+        return response_json['tokens']
+
+
+    def embeddings_request(self, model:str, texts:list) -> tuple:
+        return 'POST', self.API_ENDPOINT_EMBEDDINGS, {'model': model, 'input': texts}
+
+
+    def parse_embeddings(self, response_json:dict) -> list:
+        data = sorted(response_json['data'], key=lambda item: item.get('index', 0))
+
+        return [item['embedding'] for item in data]
+
+
+    def list_models_request(self) -> tuple:
+        return 'GET', self.API_ENDPOINT_MODELS, None
+
+
+    def parse_models(self, response_json:dict) -> list:
+        return [item['id'] for item in response_json['data']]
+
+
+    def load_model_request(self, model:str) -> tuple:
+        # Models are chosen when the server starts, so only describe them
+        return 'GET', self.API_ENDPOINT_MODELS, None
+
+
+    def parse_context_size(self, response_json:dict, model:str) -> int|None:
+        for item in response_json['data']:
+            if item['id'] == model:
+                return item.get('max_model_len', None)
+
+        return None
+
+
+class LlamaCppBackend(OpenAIBackend):
+    """
+    llama.cpp's server. Completions use its native /completion endpoint,
+    which keeps the evaluated prompt between requests and takes GBNF
+    grammars. Embeddings and the model list use its OpenAI-compatible API.
+    """
+
+    name = 'llamacpp'
+
+    API_ENDPOINT_COMPLETION = '/completion'
+    API_ENDPOINT_PROPS = '/props'
+
+    PROPERTY_NAMES = {
+        'seed': 'seed',
+        'top_p': 'top_p',
+        'top_k': 'top_k',
+        'repetition_penalty': 'repeat_penalty',
+        'stopping_strings': 'stop',
+        'grammar_string': 'grammar',
+    }
+
+
+    def generate_request(self, model:str, prompt:str|list, temperature:float, max_tokens:int, model_properties:dict = None) -> tuple:
+        request = {
+            'prompt': prompt,
+            'temperature': float(temperature),
+            'n_predict': max(1, max_tokens),
+            'cache_prompt': True,
+            **self.map_properties(model_properties, self.PROPERTY_NAMES),
+        }
+
+        return 'POST', self.API_ENDPOINT_COMPLETION, request
+
+
+    def parse_generate(self, response_json:dict) -> str:
+        return response_json['content']
+
+
+    def parse_generated_tokens(self, response_json:dict) -> int|None:
+        return response_json.get('tokens_predicted', None)
+
+
+    def token_count_request(self, model:str, text:str) -> tuple:
+        return 'POST', self.API_ENDPOINT_TOKENIZE, {'content': text}
+
+
+    def tokenize_request(self, model:str, text:str, add_special:bool = True) -> tuple:
+        return 'POST', self.API_ENDPOINT_TOKENIZE, {'content': text, 'add_special': add_special}
+
+
+    def load_model_request(self, model:str) -> tuple:
+        return 'GET', self.API_ENDPOINT_PROPS, None
+
+
+    def parse_context_size(self, response_json:dict, model:str) -> int|None:
+        return response_json['default_generation_settings']['n_ctx']
+
+
+BACKENDS = {
+    'textgen': TextGenWebUIBackend,
+    'openai': OpenAIBackend,
+    'llamacpp': LlamaCppBackend,
+}
+
+
+def create_backend(name:str) -> Backend:
+    """
+    Create the adapter for a server API, falling back to Text Gen WebUI's
+    for unknown names.
+
+    Args:
+        name (str): The API: textgen, openai or llamacpp.
+
+    Returns:
+        Backend: The adapter.
+    """
+
+    if name not in BACKENDS:
+        log.error("Unknown backend %s, using textgen. Available: %s", name, ', '.join(BACKENDS.keys()))
+        name = 'textgen'
+
+    return BACKENDS[name]()
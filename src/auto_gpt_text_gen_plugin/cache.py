@@ -0,0 +1,100 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from .telemetry import telemetry
+
+
+class LRUCache:
+    """A thread-safe, size-bounded least-recently-used cache with hit counters."""
+
+    def __init__(self, max_size:int = 1024, name:str = None) -> None:
+        """
+        Args:
+            max_size (int): The number of entries to keep.
+            name (str): Reports hits and misses to telemetry as <name>_cache_hits and <name>_cache_misses. Defaults to not reporting them.
+        """
+
+        self.max_size = max_size
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key, default = None):
+        """
+        Get an entry and mark it as recently used.
+
+        Args:
+            key: The entry's key.
+            default: The value to return if the entry is not cached.
+
+        Returns:
+            The cached value, or default.
+        """
+
+        with self._lock:
+            found = key in self._entries
+            if found:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                value = self._entries[key]
+            else:
+                self.misses += 1
+                value = default
+
+        if self.name is not None:
+            telemetry.increment(f'{self.name}_cache_hits' if found else f'{self.name}_cache_misses')
+
+        return value
+
+
+    def put(self, key, value) -> None:
+        """
+        Add an entry, evicting the least recently used entry if the cache is full.
+
+        Args:
+            key: The entry's key.
+            value: The value to cache.
+        """
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+    def get_metrics(self) -> dict:
+        """
+        Get the cache's size and hit counters.
+
+        Returns:
+            dict: The metrics.
+        """
+
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+def content_hash(content) -> str:
+    """
+    Hash a string or JSON-serialisable object for use as a cache key.
+
+    Args:
+        content: The content to hash.
+
+    Returns:
+        str: The hex digest.
+    """
+
+    if not isinstance(content, str):
+        content = json.dumps(content, sort_keys=True)
+
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
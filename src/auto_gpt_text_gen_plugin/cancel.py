@@ -0,0 +1,173 @@
+import contextlib
+import contextvars
+import socket
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# The cancel scope of the requests made in the current context, or None if they cannot be cancelled
+_scope = contextvars.ContextVar('cancel_scope', default=None)
+
+
+class CancelScope:
+    """
+    Lets one thread abort the requests other threads make on its behalf,
+    such as the candidate completions that lost to another candidate.
+    Cancelling shuts down the sockets of the requests in flight, so they fail
+    at once and the server sees the client go, and requests started
+    afterwards fail before they connect.
+    """
+
+    def __init__(self) -> None:
+        self.cancelled = False
+        self._sockets = set()
+        self._lock = threading.Lock()
+
+
+    def register(self, sock:socket.socket) -> None:
+        """
+        Track the socket of a request in flight.
+
+        Args:
+            sock (socket.socket): The socket.
+
+        Raises:
+            requests.exceptions.ConnectionError: If the scope was cancelled already.
+        """
+
+        with self._lock:
+            if not self.cancelled:
+                self._sockets.add(sock)
+                return
+
+        sock.close()
+        raise requests.exceptions.ConnectionError('The request was cancelled')
+
+
+    def unregister(self, sock:socket.socket) -> None:
+        """
+        Stop tracking a socket once its request is done.
+
+        Args:
+            sock (socket.socket): The socket.
+        """
+
+        with self._lock:
+            self._sockets.discard(sock)
+
+
+    def cancel(self) -> int:
+        """
+        Cancel the requests in flight and any made later in the scope.
+
+        Returns:
+            int: The number of requests that were in flight.
+        """
+
+        with self._lock:
+            self.cancelled = True
+            sockets = list(self._sockets)
+            self._sockets.clear()
+
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        return len(sockets)
+
+
+@contextlib.contextmanager
+def cancel_scope(scope:CancelScope):
+    """
+    Make the requests sent inside the block cancellable through a scope.
+    The scope follows the context, so requests made by other threads with a
+    copied context are covered too.
+
+    Args:
+        scope (CancelScope): The scope.
+    """
+
+    token = _scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _scope.reset(token)
+
+
+def current_scope() -> CancelScope|None:
+    """
+    Returns:
+        CancelScope|None: The cancel scope of the current context, or None if its requests cannot be cancelled.
+    """
+
+    return _scope.get()
+
+
+def is_cancelled() -> bool:
+    """
+    Returns:
+        bool: True if the current context's requests were cancelled.
+    """
+
+    scope = _scope.get()
+
+    return scope is not None and scope.cancelled
+
+
+class CancellableConnectionMixin:
+    """Registers each connection's socket with the cancel scope of the context that opens it."""
+
+    def connect(self) -> None:
+        super().connect()
+        self.cancel_scope = _scope.get()
+        if self.cancel_scope is not None:
+            self.cancel_scope.register(self.sock)
+
+
+    def close(self) -> None:
+        scope = getattr(self, 'cancel_scope', None)
+        if scope is not None and self.sock is not None:
+            scope.unregister(self.sock)
+        super().close()
+
+
+class CancellableHTTPConnection(CancellableConnectionMixin, HTTPConnection):
+    pass
+
+
+class CancellableHTTPSConnection(CancellableConnectionMixin, HTTPSConnection):
+    pass
+
+
+class CancellableHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CancellableHTTPConnection
+
+
+class CancellableHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CancellableHTTPSConnection
+
+
+class CancellableAdapter(HTTPAdapter):
+    """An HTTP adapter whose connections can be shut down by a cancel scope."""
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': CancellableHTTPConnectionPool, 'https': CancellableHTTPSConnectionPool}
+
+
+def cancellable_session() -> requests.Session:
+    """
+    Returns:
+        requests.Session: A session whose requests are cancelled with the current cancel scope.
+    """
+
+    session = requests.Session()
+    adapter = CancellableAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
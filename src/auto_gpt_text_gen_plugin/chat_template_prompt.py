@@ -0,0 +1,235 @@
+import threading
+from functools import lru_cache
+from .cache import LRUCache
+from .default_prompt import DefaultPrompt
+from .log import log
+from .prompt_engine import PromptEngine
+
+# Built-in chat templates. Each role's Jinja snippet renders one message from
+# `content`. `generation_prompt` is appended to cue the model's turn, and
+# `stop` lists the strings that mark the end of the model's turn.
+CHAT_TEMPLATES = {
+    'chatml': {
+        'system': '<|im_start|>system\n{{ content }}<|im_end|>\n',
+        'user': '<|im_start|>user\n{{ content }}<|im_end|>\n',
+        'assistant': '<|im_start|>assistant\n{{ content }}<|im_end|>\n',
+        'generation_prompt': '<|im_start|>assistant\n',
+        'stop': ['<|im_end|>', '<|im_start|>'],
+    },
+    'alpaca': {
+        'system': '{{ content }}\n\n',
+        'user': '### Instruction:\n{{ content }}\n\n',
+        'assistant': '### Response:\n{{ content }}\n\n',
+        'generation_prompt': '### Response:\n',
+        'stop': ['### Instruction:', '### Response:'],
+    },
+    'vicuna': {
+        'system': '{{ content }}\n\n',
+        'user': 'USER: {{ content }}\n',
+        'assistant': 'ASSISTANT: {{ content }}</s>\n',
+        'generation_prompt': 'ASSISTANT:',
+        'stop': ['</s>', '\nUSER:'],
+    },
+}
+
+
+@lru_cache(maxsize=None)
+def compile_chat_snippet(source:str):
+    """
+    Compile a chat template snippet. Each distinct snippet is compiled once
+    per process.
+
+    Args:
+        source (str): The Jinja source.
+
+    Returns:
+        jinja2.Template: The compiled template.
+    """
+
+    try:
+        import jinja2
+    except ImportError as e:
+        raise ImportError('The chat_template prompt engine requires the jinja2 package') from e
+
+    environment = jinja2.Environment(keep_trailing_newline=True)
+
+    return environment.from_string(source)
+
+
+class ChatTemplatePrompt(DefaultPrompt):
+    """
+    Renders OpenAI-style messages through a model's chat template, keeping
+    the role of every message.
+
+    The profile's `chat_template` names a built-in template (chatml, alpaca,
+    vicuna) or gives the role snippets itself. Messages are rendered one at a
+    time. The last render is kept, so a step that appends to the previous
+    history only renders the new messages, and rendered messages are cached
+    for histories that do not extend the last one.
+    """
+
+    capabilities = frozenset([
+        PromptEngine.CAPABILITY_CACHEABLE_PREFIX,
+    ])
+
+    def __init__(self, prompt_profile) -> None:
+        """Initializes the ChatTemplatePrompt class."""
+
+        super().__init__(prompt_profile)
+
+        # Constants
+        self.MESSAGE_CACHE_SIZE = 4096
+
+        self.chat_template = self.load_chat_template(prompt_profile)
+        self.rendered_messages = LRUCache(self.MESSAGE_CACHE_SIZE)
+
+        # The messages of the last render, the rendered prompt and where each message ends in it
+        self.last_render = ([], '', [])
+        self._render_lock = threading.Lock()
+
+
+    def load_chat_template(self, prompt_profile:dict) -> dict:
+        """
+        Resolve the profile's chat template.
+
+        Args:
+            prompt_profile (dict): The loaded prompt profile.
+
+        Returns:
+            dict: The role snippets, generation prompt and stopping strings.
+        """
+
+        chat_template = 'chatml'
+        if isinstance(prompt_profile, dict) and 'chat_template' in prompt_profile:
+            chat_template = prompt_profile['chat_template']
+
+        if isinstance(chat_template, dict):
+            return {**CHAT_TEMPLATES['chatml'], **chat_template}
+
+        if chat_template not in CHAT_TEMPLATES:
+            log.error("Unknown chat template %s, using chatml. Available: %s", chat_template, ', '.join(CHAT_TEMPLATES.keys()))
+            chat_template = 'chatml'
+
+        return CHAT_TEMPLATES[chat_template]
+
+
+    def render_message(self, message:dict) -> str:
+        """
+        Render one message, from the cache if it was rendered before.
+
+        Args:
+            message (dict): The message, with a role and content.
+
+        Returns:
+            str: The rendered message.
+        """
+
+        role = message.get('role', 'user')
+        if role not in ['system', 'user', 'assistant']:
+            role = 'user'
+
+        source = self.chat_template[role]
+        key = (source, message['content'])
+
+        rendered = self.rendered_messages.get(key)
+        if rendered is None:
+            rendered = compile_chat_snippet(source).render(content=message['content'].strip())
+            self.rendered_messages.put(key, rendered)
+
+        return rendered
+
+
+    def count_reused_messages(self, messages:list, last_messages:list) -> int:
+        """
+        Count the messages at the start of a history that were rendered last
+        time. The histories are compared from the front, so a message edited,
+        trimmed or collapsed anywhere in the history is rendered again along
+        with everything after it.
+
+        Args:
+            messages (list): The messages to render.
+            last_messages (list): The messages of the last render.
+
+        Returns:
+            int: The number of messages whose render can be reused.
+        """
+
+        limit = min(len(last_messages), len(messages))
+
+        reused = 0
+        while reused < limit and messages[reused] == last_messages[reused]:
+            reused += 1
+
+        return reused
+
+
+    def reshape_message(self, messages:list) -> str:
+        """
+        Render the messages through the chat template and cue the model's turn.
+
+        Args:
+            messages (list): List of messages. Defaults to [].
+
+        Returns:
+            str: The rendered prompt.
+        """
+
+        messages = messages[:1] + self.compress_history(messages[1:])
+
+        with self._render_lock:
+            last_messages, last_text, last_ends = self.last_render
+            reused = self.count_reused_messages(messages, last_messages)
+
+            if 0 < reused == len(messages) == len(last_messages):
+                return last_text
+
+            # Keep the render of the shared messages and render the new ones after it
+            del last_messages[reused:]
+            del last_ends[reused:]
+            length = last_ends[-1] if reused > 0 else 0
+            parts = [last_text[:length]]
+            for message in messages[reused:]:
+                rendered = self.render_message(message)
+                parts.append(rendered)
+                length += len(rendered)
+                last_messages.append(dict(message))
+                last_ends.append(length)
+            parts.append(self.chat_template['generation_prompt'])
+
+            text = ''.join(parts)
+            self.last_render = (last_messages, text, last_ends)
+
+        return text
+
+
+    def get_prompt_prefix(self, messages:list) -> str|None:
+        """
+        Get the rendered system message, which stays the same from step to step.
+
+        Args:
+            messages (list): The messages the prompt is built from.
+
+        Returns:
+            str|None: The prefix, or None if the messages do not start with a system message.
+        """
+
+        if len(messages) == 0 or messages[0].get('role') != 'system':
+            return None
+
+        prefix = self.render_message(messages[0])
+
+        return prefix if prefix.endswith('\n') else None
+
+
+    def get_stopping_strings(self, messages:list) -> list:
+        """
+        Stop generating when the model ends its turn or starts another one.
+
+        Args:
+            messages (list): The messages the prompt is built from.
+
+        Returns:
+            list: The stopping strings.
+        """
+
+        return list(self.chat_template.get('stop', None) or [])
@@ -1,18 +1,39 @@
-import json
+import contextvars
 import os
-import re
+import queue
+import random
+import threading
+import time
 import requests
-from .default_prompt import DefaultPrompt
-from .monolithic_prompt import MonolithicPrompt
-from autogpt.logs import logger
-from colorama import Fore, Style
+from concurrent.futures import ThreadPoolExecutor
+from .backends import create_backend
+from .cache import LRUCache, content_hash
+from .cancel import CancelScope, cancel_scope, cancellable_session, current_scope, is_cancelled
+from .deadline import deadline, deadline_expired, time_remaining
+from .engines import engines
+from .errors import BackendUnavailableError, DeadlineExceededError, RequestCancelledError, TextGenAPIError
+from .gateway import GatewayTransport
+from .health import health
+from .log import log
+from .prompt_engine import PromptEngine, ResponseParseError
+from .recorder import TrafficRecorder
+from .scheduler import current_priority, current_slot
+from .telemetry import telemetry
+from colorama import Fore
 
 
 class Client:
-    """API support for Text Gen WebUI's vanilla API plugin"""
+    """API support for Text Gen WebUI's vanilla API plugin, and other servers through backend adapters"""
 
-    def __init__(self, base_url, prompt_profile, model = None):
-        """Constructor"""
+    def __init__(self, base_url, prompt_profile, model = None, context_size = None, backend = None):
+        """
+        Args:
+            base_url (str): The base url of the server.
+            prompt_profile (dict): The loaded prompt profile.
+            model (str): The model to load. Defaults to asking the user if the API lists several.
+            context_size (int): The context size to use. If given, the model is assumed to be loaded already.
+            backend (str): The server's API: textgen, openai or llamacpp. Defaults to LOCAL_LLM_BACKEND.
+        """
 
         # Initialize the prompt manager
         self.base_url = base_url
@@ -20,31 +41,116 @@ class Client:
 
         # Constants
         self.MAX_RESPONSE_TOKENS = 300
-        self.API_ENDPOINT_GENERATE = '/api/v1/generate'
-        self.API_ENDPOINT_MODELS = '/api/v1/model'
-        self.API_ENDPOINT_TOKENCOUNT = '/api/v1/token-count'
+        self.MIN_RESPONSE_TOKENS = int(os.environ.get('LOCAL_LLM_MIN_RESPONSE_TOKENS', '100'))
+        self.DEFAULT_CONTEXT_SIZE = int(os.environ.get('LOCAL_LLM_CONTEXT_SIZE', '2048'))
+        self.CHARS_PER_TOKEN = 4
+
+        # The API the server speaks
+        self.backend = create_backend(backend or os.environ.get('LOCAL_LLM_BACKEND', 'textgen'))
+
+        # Retry and repair policy
+        self.MAX_RETRIES = int(os.environ.get('LOCAL_LLM_MAX_RETRIES', '3'))
+        self.RETRY_BACKOFF = float(os.environ.get('LOCAL_LLM_RETRY_BACKOFF', '0.5'))
+        self.RETRY_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+        self.MAX_REPAIRS = int(os.environ.get('LOCAL_LLM_MAX_REPAIRS', '1'))
+        self.REPAIR_TOKENS_PER_FIELD = int(os.environ.get('LOCAL_LLM_REPAIR_TOKENS_PER_FIELD', '40'))
+        self.STOP_TIMEOUT = 5
+
+        # Fail fast while the backend is down, and probe it in the background until it answers
+        breaker_failures = int(os.environ.get('LOCAL_LLM_BREAKER_FAILURES', '3'))
+        breaker_reset = float(os.environ.get('LOCAL_LLM_BREAKER_RESET', '30'))
+        self.UNAVAILABLE_STATUS_CODES = [502, 503, 504]
+        self.breaker = health.get_breaker(base_url, breaker_failures, breaker_reset)
+        self.token_count_breaker = health.get_breaker(f'{base_url} token count', breaker_failures, breaker_reset)
+        self.PROBE_TIMEOUT = 5
+        self.health_monitor = health.get_monitor(self.breaker, self.probe, float(os.environ.get('LOCAL_LLM_HEALTH_INTERVAL', '2')))
+
+        # Generate several candidates at once and keep the first that parses, with a worker for every slot the scheduler can give
+        self.N_BEST = max(1, int(os.environ.get('LOCAL_LLM_N_BEST', '1')))
+        candidate_workers = self.N_BEST * max(1, int(os.environ.get('LOCAL_LLM_MAX_CONCURRENCY', '1')))
+        self.candidate_pool = ThreadPoolExecutor(max_workers=candidate_workers, thread_name_prefix='candidate') if self.N_BEST > 1 else None
+
+        # Talk to a shared local gateway instead of the API directly, if one is configured
+        gateway_socket = os.environ.get('LOCAL_LLM_GATEWAY_SOCKET', None)
+        self.gateway = GatewayTransport(gateway_socket) if gateway_socket not in ['', None] else None
 
         # Which prompt manager to use
-        if self.prompt_profile is not None and 'template_type' in self.prompt_profile and self.prompt_profile['template_type'] == "monolithic":
-            self.prompt_manager = MonolithicPrompt(self.prompt_profile)
-        else:
-            self.prompt_manager = DefaultPrompt(self.prompt_profile)
+        self.prompt_manager = engines.create(self.prompt_profile)
+        self.prompt_manager.set_embedding_function(self.get_embeddings)
 
-        if model is not None:
-            self.model = model
-        else:
-            self.model = self.select_model()
-        
-        self.context_size = self.get_context_size(self.model)
+        # Token counts of prompt prefixes, for engines whose prefix only changes with the system message
+        self.prefix_tokens = LRUCache(int(os.environ.get('LOCAL_LLM_PREFIX_CACHE_SIZE', '16')), 'prefix_tokens')
+
+        # Send prompts as token IDs to backends that accept them, reusing the IDs of cached prefixes
+        self.SEND_TOKEN_IDS = os.environ.get('LOCAL_LLM_SEND_TOKEN_IDS', 'true').lower() in ['true', '1', 'yes']
+        self.prefix_token_ids = LRUCache(int(os.environ.get('LOCAL_LLM_PREFIX_CACHE_SIZE', '16')), 'prefix_token_ids')
+
+        # Record completions for offline replay, if asked to
+        record_path = os.environ.get('LOCAL_LLM_RECORD_FILE', None)
+        self.recorder = TrafficRecorder(record_path) if record_path not in ['', None] else None
+
+        # Until the backend has answered, run with estimates and connect on a later request
+        self.model = model
+        self.context_size = context_size if context_size is not None else self.DEFAULT_CONTEXT_SIZE
+        self.connected = model is not None and context_size is not None
+        self._connect_lock = threading.Lock()
 
+        if not self.connect():
+            print(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Could not reach {self.base_url}, will keep trying while Auto-GPT runs.")
 
-        logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Using prompt manager {self.prompt_manager.__class__.__name__}\n")
-        logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Using base url {self.base_url}")
+
+        log.debug("Using prompt manager %s\n", self.prompt_manager.__class__.__name__)
+        log.debug("Using base url %s", self.base_url)
         # self.headers = {
         #     "api_key": self.api_key 
         # }
         
 
+    def connect(self) -> bool:
+        """
+        Select the model if none was given and load it to read its context
+        size. Safe to call on every request, it only contacts the backend
+        until it has succeeded once.
+
+        Returns:
+            bool: True if the model and its context size are known.
+        """
+
+        with self._connect_lock:
+            if self.connected:
+                return True
+
+            if self.model is None:
+                self.model = self.select_model()
+                if self.model is None:
+                    return False
+
+            context_size = self.get_context_size(self.model)
+            if context_size is None:
+                return False
+
+            self.context_size = context_size
+            self.connected = True
+
+            return True
+
+
+    def probe(self) -> bool:
+        """
+        Check whether the backend answers, bypassing the circuit breaker.
+        Used by the health monitor.
+
+        Returns:
+            bool: True if the backend listed its models.
+        """
+
+        method, endpoint, request = self.backend.list_models_request()
+        with deadline(self.PROBE_TIMEOUT):
+            response = self.send(endpoint, request, method)
+
+        return response.status_code == 200
+
+
     def create_chat_completion(self, messages:list, temperature:float, max_tokens:int = 300, model_properties:dict = None):
         """
         Create a chat completion API call to Text Gen WebUI
@@ -59,126 +165,705 @@ class Client:
             str: The resulting response.
         """
 
+        with telemetry.trace(), telemetry.span('chat_completion'):
+            try:
+                response = self.run_chat_completion(messages, temperature, max_tokens, model_properties)
+            except DeadlineExceededError as e:
+                log.debug("Error: %s", e)
+                telemetry.increment('deadlines_exceeded')
+                response = self.prompt_manager.error_response(str(e))
+
+        telemetry.increment('completions')
+
+        return response
+
+
+    def run_chat_completion(self, messages:list, temperature:float, max_tokens:int = 300, model_properties:dict = None):
+        """
+        Reshape the messages, generate a completion and convert it to the Auto-GPT format.
+
+        Args:
+            messages (list): The messages to be used as context.
+            temperature (float): The temperature to use for the completion.
+            max_tokens (int): The maximum number of tokens to generate.
+            model_properties (dict): The properties of the model to use on submission.
+
+        Returns:
+            str: The resulting response.
+        """
+
         # Preflight debug
-        logger.debug(
-            f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Creating chat completion with:\n{json.dumps(messages, indent=4)}\n"
-            f"... and temperature {temperature}\n\n"
-        )
-
-        # Reshape the messages
-        messages = self.prompt_manager.reshape_message(messages)
-        logger.debug(
-            f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Reshaped messages to:\n{messages}"
-        )
-
-        # Calculate tokens
-        logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Requested max tokens: {max_tokens}")
-        msg_size = self.calculate_token_length(messages)
+        log.debug_payload(f"Creating chat completion with temperature {temperature}", messages)
+
+        # Load the model if the backend was down when the plugin started
+        if not self.connected and not self.connect():
+            return self.prompt_manager.error_response(f'Could not reach {self.base_url}')
+
+        # Take the fast paths the prompt engine supports
+        model_properties = self.get_engine_properties(messages, model_properties)
+
+        # Reshape the messages and calculate tokens
+        log.debug("Requested max tokens: %s", max_tokens)
+        prompt, prompt_ids, msg_size = self.build_prompt(messages)
+
+        # Drop the oldest history until the prompt leaves room for a response
+        while msg_size + self.MIN_RESPONSE_TOKENS > self.context_size and len(messages) > 2:
+            messages = self.trim_history(messages, msg_size + self.MIN_RESPONSE_TOKENS - self.context_size)
+            telemetry.increment('history_trims')
+            prompt, prompt_ids, msg_size = self.build_prompt(messages)
+
+        telemetry.increment('prompt_tokens', msg_size)
+        if msg_size + self.MIN_RESPONSE_TOKENS > self.context_size:
+            log.error("The prompt is %s tokens, leaving less than %s of the %s token context for the response", msg_size, self.MIN_RESPONSE_TOKENS, self.context_size)
+            return self.prompt_manager.error_response(f'The prompt of {msg_size} tokens does not fit the {self.context_size} token context')
+
         if not isinstance(max_tokens, int) or max_tokens > self.context_size or max_tokens < 0:
             max_tokens = self.MAX_RESPONSE_TOKENS
         else:
             max_tokens = self.context_size - msg_size
+        max_tokens = max(self.MIN_RESPONSE_TOKENS, min(max_tokens, self.context_size - msg_size))
+
+        log.debug("Calculated tokens: %s", max_tokens)
+
+        converted_response = None
+        request_prompt = prompt_ids if prompt_ids is not None else prompt
+        try:
+            with telemetry.span('generate'):
+                if self.N_BEST > 1:
+                    text_response, converted_response = self.generate_candidates(request_prompt, temperature, max_tokens, model_properties)
+                else:
+                    text_response = self.generate(request_prompt, temperature, max_tokens, model_properties)
+        except DeadlineExceededError:
+            raise
+        except TextGenAPIError as e:
+            log.debug("Error: %s", e)
+            return self.prompt_manager.error_response(str(e))
+
+        # Convert the response, repairing it with a short continuation if it is incomplete
+        repairs = 0
+        parsed = True
+        while converted_response is None:
+            try:
+                with telemetry.span('reshape_response'):
+                    converted_response = self.prompt_manager.parse_response(text_response)
+                break
+            except ResponseParseError as e:
+                repaired_response = None
+                if repairs < self.MAX_REPAIRS:
+                    repairs += 1
+                    telemetry.increment('repairs')
+                    repaired_response = self.repair_response(prompt, text_response, temperature, model_properties)
+                if repaired_response is None:
+                    log.debug("Could not repair the response: %s\n\n", e)
+                    converted_response = self.prompt_manager.reshape_response(text_response)
+                    parsed = False
+                    break
+                text_response = repaired_response
+
+        if self.recorder is not None:
+            parameters = {'temperature': temperature, 'max_new_tokens': max_tokens, **(model_properties or {})}
+            self.recorder.record(messages, prompt, parameters, text_response, converted_response, parsed)
+
+        log.debug_payload("Returning response", converted_response)
+        return converted_response
+
+
+    def build_prompt(self, messages:list) -> tuple:
+        """
+        Reshape the messages into a prompt and measure it.
+
+        Args:
+            messages (list): The messages to be used as context.
 
-        logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Calculated tokens: {max_tokens}")
+        Returns:
+            tuple: The prompt, its token IDs if the backend takes them (else None), and its length in tokens.
+        """
 
-        # API call
-        request = {
-            'prompt': messages, 
-            'temperature': float(temperature), 
-            'max_new_tokens': max_tokens
-        }
+        with telemetry.span('reshape_message'):
+            prompt = self.prompt_manager.reshape_message(messages)
+        log.debug_payload("Reshaped messages to", prompt)
 
-        # Merge model_properties into request
-        if model_properties is not None:
-            request.update(model_properties)
+        prompt_ids = None
+        with telemetry.span('token_count'):
+            if self.SEND_TOKEN_IDS and self.backend.supports_token_ids:
+                prompt_ids = self.tokenize_prompt(messages, prompt)
+            msg_size = len(prompt_ids) if prompt_ids is not None else self.calculate_prompt_length(messages, prompt)
 
-        logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Sending request:\n{json.dumps(request, indent=4)}\n\n")
+        return prompt, prompt_ids, msg_size
 
-        response = requests.post(self.base_url + self.API_ENDPOINT_GENERATE, json=request)
-        
-        # Process the result
-        if response.status_code == 200:
 
-            # Make JSON
+    def trim_history(self, messages:list, excess_tokens:int) -> list:
+        """
+        Drop the oldest messages between the system message and the last
+        message, until about the given number of tokens are gone. At least
+        one message is dropped.
+
+        Args:
+            messages (list): The messages to be used as context.
+            excess_tokens (int): The tokens the prompt is over its budget, estimated from the message lengths.
+
+        Returns:
+            list: The messages without the oldest history.
+        """
+
+        index = 1
+        dropped = 0
+        while index < len(messages) - 1 and (index == 1 or dropped < excess_tokens):
+            dropped += len(str(messages[index]['content'])) // self.CHARS_PER_TOKEN + 1
+            index += 1
+
+        log.debug("Dropped %s history messages to fit the context", index - 1)
+
+        return [messages[0]] + messages[index:]
+
+
+    def get_engine_properties(self, messages:list, model_properties:dict = None) -> dict|None:
+        """
+        Add the request properties the prompt engine calls for: a grammar to
+        constrain the response if the engine has one, and stopping strings so
+        generation ends with the response.
+
+        Args:
+            messages (list): The messages the prompt is built from.
+            model_properties (dict): The properties of the model to use on submission.
+
+        Returns:
+            dict|None: The model properties.
+        """
+
+        if self.prompt_manager.supports(PromptEngine.CAPABILITY_GRAMMAR):
+            grammar = self.prompt_manager.get_grammar(messages)
+            if grammar is not None:
+                model_properties = {**(model_properties or {}), 'grammar_string': grammar}
+
+        stopping_strings = self.prompt_manager.get_stopping_strings(messages)
+        if len(stopping_strings) > 0:
+            existing = (model_properties or {}).get('stopping_strings', None) or []
+            model_properties = {**(model_properties or {}), 'stopping_strings': existing + [string for string in stopping_strings if string not in existing]}
+
+        return model_properties
+
+
+    def calculate_prompt_length(self, messages:list, prompt:str) -> int:
+        """
+        Calculate the length of a prompt in tokens. If the engine has a
+        cacheable prefix, only the part after it is sent to be counted.
+
+        Args:
+            messages (list): The messages the prompt is built from.
+            prompt (str): The reshaped prompt.
+
+        Returns:
+            int: The length of the prompt in tokens.
+        """
+
+        prefix = None
+        if self.prompt_manager.supports(PromptEngine.CAPABILITY_CACHEABLE_PREFIX):
+            prefix = self.prompt_manager.get_prompt_prefix(messages)
+
+        if prefix is None or not prompt.startswith(prefix):
+            return self.calculate_token_length(prompt)
+
+        key = content_hash(prefix)
+        prefix_length = self.prefix_tokens.get(key)
+        if prefix_length is None:
+            # Estimates are not cached, so the count is taken once the backend answers again
+            prefix_length = self.count_tokens(prefix)
+            if prefix_length is None:
+                return self.estimate_token_length(prompt)
+            self.prefix_tokens.put(key, prefix_length)
+
+        suffix = prompt[len(prefix):]
+
+        return prefix_length + (self.calculate_token_length(suffix) if suffix != '' else 0)
+
+
+    def tokenize_prompt(self, messages:list, prompt:str) -> list|None:
+        """
+        Get the token IDs of a prompt. If the engine has a cacheable prefix,
+        its IDs are reused and only the part after it is tokenized. The first
+        time a prefix is seen, the prompt is tokenized whole and in two parts,
+        and the prefix is only reused if both give the same IDs.
+
+        Args:
+            messages (list): The messages the prompt is built from.
+            prompt (str): The reshaped prompt.
+
+        Returns:
+            list|None: The token IDs, or None if the backend could not tokenize the prompt.
+        """
+
+        prefix = None
+        if self.prompt_manager.supports(PromptEngine.CAPABILITY_CACHEABLE_PREFIX):
+            prefix = self.prompt_manager.get_prompt_prefix(messages)
+
+        if prefix is None or not prompt.startswith(prefix) or len(prefix) == len(prompt):
+            return self.tokenize(prompt)
+
+        key = content_hash(prefix)
+        suffix = prompt[len(prefix):]
+        prefix_ids = self.prefix_token_ids.get(key)
+
+        if prefix_ids is None:
+            prompt_ids = self.tokenize(prompt)
+            prefix_ids = self.tokenize(prefix)
+            suffix_ids = self.tokenize(suffix, add_special=False)
+            if prompt_ids is None or prefix_ids is None or suffix_ids is None:
+                return prompt_ids
+
+            # False marks a prefix the tokenizer merges with what follows it
+            if prompt_ids != prefix_ids + suffix_ids:
+                log.debug("Tokens change across the end of the prompt prefix, tokenizing whole prompts")
+                prefix_ids = False
+            self.prefix_token_ids.put(key, prefix_ids)
+
+            return prompt_ids
+
+        if prefix_ids is False:
+            return self.tokenize(prompt)
+
+        suffix_ids = self.tokenize(suffix, add_special=False)
+
+        return prefix_ids + suffix_ids if suffix_ids is not None else None
+
+
+    def tokenize(self, text:str, add_special:bool = True) -> list|None:
+        """
+        Get the token IDs of a text from the backend's tokenizer.
+
+        Args:
+            text (str): The text.
+            add_special (bool): Whether to add the tokens that start a sequence, such as BOS.
+
+        Returns:
+            list|None: The token IDs, or None if the backend cannot tokenize or the request failed.
+        """
+
+        if not self.backend.supports_token_ids:
+            return None
+
+        method, endpoint, request = self.backend.tokenize_request(self.model, text, add_special)
+
+        try:
+            response = self.post(endpoint, request, method)
+            if response.status_code != 200:
+                log.debug("Error: Response status code %s", response.status_code)
+                return None
+            return self.backend.parse_tokens(response.json())
+        except (TextGenAPIError, ValueError, KeyError, TypeError) as e:
+            log.debug("Error trying to tokenize: %s", e)
+            return None
+
+
+    def generate(self, prompt:str|list, temperature:float, max_tokens:int, model_properties:dict = None) -> str:
+        """
+        Send a prompt to the generate endpoint and return the raw generated text.
+
+        Args:
+            prompt (str|list): The prompt to complete, as text or as token IDs.
+            temperature (float): The temperature to use for the completion.
+            max_tokens (int): The maximum number of tokens to generate.
+            model_properties (dict): The properties of the model to use on submission.
+
+        Returns:
+            str: The generated text.
+
+        Raises:
+            TextGenAPIError: If the API cannot produce a completion.
+        """
+
+        method, endpoint, request = self.backend.generate_request(self.model, prompt, temperature, max_tokens, model_properties)
+
+        log.debug_payload("Sending request", request)
+
+        start = time.perf_counter()
+        try:
+            response = self.post(endpoint, request, method)
+        except (DeadlineExceededError, KeyboardInterrupt):
+            self.stop_generation()
+            raise
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            raise TextGenAPIError(f'Response status code {response.status_code}: {response.text}')
+
+        # Make JSON
+        try:
+            response_json = response.json()
+        except:
+            response_json = None
+
+        # Debug
+        log.debug_payload("Got API response", response_json)
+
+        text_response = ''
+        if response_json is not None:
             try:
-                response_json = response.json()
-            except:
-                response_json = {'results': [{'text': ''}]}
-
-            # Debug
-            logger.debug(
-                f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Got API response:\n{response_json}\n\n"
-            )
-
-            # Return
-            text_response = response_json['results'][0]['text']
-            text_response = self.prompt_manager.reshape_response(text_response)
-            logger.debug(
-                f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Returning response:\n {text_response}\n"
-                f"(as JSON: \n{response_json}\n\n"
-            )
-            return text_response
+                text_response = self.backend.parse_generate(response_json)
+            except (KeyError, IndexError, TypeError) as e:
+                raise TextGenAPIError(f'Unexpected response from {endpoint}: {e}')
+
+        # Use the server's count of generated tokens, estimating it when the server does not report one
+        generated_tokens = self.backend.parse_generated_tokens(response_json) if response_json is not None else None
+        if generated_tokens is None:
+            generated_tokens = len(text_response) // self.CHARS_PER_TOKEN + 1
+        telemetry.increment('generated_tokens', generated_tokens)
+        telemetry.set_gauge('tokens_per_second', generated_tokens / max(elapsed, 1e-6))
+
+        return text_response
+
+
+    def generate_candidates(self, prompt:str|list, temperature:float, max_tokens:int, model_properties:dict = None) -> tuple:
+        """
+        Generate N_BEST candidate responses and keep the first one that
+        parses. Candidates run as many at a time as the scheduler has slots:
+        the slot the request holds, and any spare slots on the backend. Once
+        one parses, the candidates still generating are cancelled, so their
+        connections close and the backend is asked to stop, and the rest are
+        never sent. With a fixed seed, each candidate gets its own seed so
+        they differ.
+
+        Args:
+            prompt (str|list): The prompt to complete, as text or as token IDs.
+            temperature (float): The temperature to use for the completion.
+            max_tokens (int): The maximum number of tokens to generate.
+            model_properties (dict): The properties of the model to use on submission.
+
+        Returns:
+            tuple: The generated text and its converted response, or the first candidate's text and None if no candidate parses.
+
+        Raises:
+            TextGenAPIError: If every candidate request failed.
+        """
+
+        seed = (model_properties or {}).get('seed', -1)
+        candidates = queue.SimpleQueue()
+        for index in range(self.N_BEST):
+            candidate_properties = model_properties
+            if isinstance(seed, int) and seed >= 0:
+                candidate_properties = {**model_properties, 'seed': seed + index}
+            candidates.put((index, candidate_properties))
+
+        # Outside a scheduler slot nothing limits the candidates, inside one they share its backend's slots
+        slot = current_slot()
+        workers = self.N_BEST
+        spare_slots = 0
+        if slot is not None:
+            scheduler, _, _, backend = slot
+            while spare_slots < self.N_BEST - 1 and scheduler.acquire_spare(backend):
+                spare_slots += 1
+            workers = 1 + spare_slots
+
+        scope = CancelScope()
+        results = queue.SimpleQueue()
+
+        def run_candidates(spare:bool):
+            try:
+                while not scope.cancelled:
+                    try:
+                        index, candidate_properties = candidates.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        results.put((index, self.generate(prompt, temperature, max_tokens, candidate_properties), None))
+                    except BaseException as e:
+                        results.put((index, None, e))
+            finally:
+                if spare:
+                    scheduler.release(backend)
+
+        with cancel_scope(scope):
+            context = contextvars.copy_context()
+        for worker in range(workers):
+            self.candidate_pool.submit(context.copy().run, run_candidates, worker < spare_slots)
+
+        telemetry.increment('candidates', self.N_BEST)
+
+        responses = {}
+        last_error = None
+        try:
+            for _ in range(self.N_BEST):
+                index, text_response, error = results.get()
+                if error is not None and not isinstance(error, TextGenAPIError):
+                    raise error
+                if error is not None:
+                    log.debug("Candidate %s failed: %s", index, error)
+                    last_error = error
+                    continue
+
+                responses[index] = text_response
+                try:
+                    with telemetry.span('reshape_response'):
+                        converted_response = self.prompt_manager.parse_response(text_response)
+                except ResponseParseError as e:
+                    log.debug("Candidate %s did not parse: %s", index, e)
+                    continue
+
+                log.debug("Candidate %s parsed, cancelling the rest", index)
+                return text_response, converted_response
+        finally:
+            self.cancel_candidates(scope)
+
+        if len(responses) == 0:
+            raise last_error
+
+        return responses[min(responses)], None
+
+
+    def cancel_candidates(self, scope:CancelScope) -> None:
+        """
+        Cancel the candidates that are still generating or waiting to be sent.
+        Their connections are closed, which stops backends that stop when the
+        client goes, and backends with a stop request are sent one.
+
+        Args:
+            scope (CancelScope): The cancel scope the candidates run in.
+        """
+
+        running = scope.cancel()
+        if running == 0:
+            return
+
+        log.debug("Cancelled %s running candidates", running)
+        telemetry.increment('candidates_cancelled', running)
+        self.stop_generation()
+
+
+    def stop_generation(self) -> None:
+        """
+        Ask the backend to stop generating, so a completion that was given up
+        on does not keep the GPU busy. Backends that stop when the client
+        disconnects need no request. The stop request is not bound by the
+        completion's deadline, which has usually passed already.
+        """
+
+        stop = self.backend.stop_request()
+        if stop is None:
+            return
+
+        method, endpoint, request = stop
+
+        def send_stop():
+            with deadline(self.STOP_TIMEOUT):
+                return self.send(endpoint, request, method)
+
+        try:
+            contextvars.Context().run(send_stop)
+            telemetry.increment('generations_stopped')
+        except (requests.exceptions.RequestException, OSError) as e:
+            log.debug("Could not stop the generation: %s", e)
+
+
+    def repair_response(self, prompt:str, message:str, temperature:float, model_properties:dict = None) -> str|None:
+        """
+        Ask the model to finish only the fields missing from a malformed response,
+        with a token budget sized to those fields rather than a full agent step.
+
+        Args:
+            prompt (str): The prompt that produced the response.
+            message (str): The malformed response.
+            temperature (float): The temperature to use for the completion.
+            model_properties (dict): The properties of the model to use on submission.
+
+        Returns:
+            str|None: The repaired response, or None if it cannot be repaired.
+        """
+
+        repair_prompt = self.prompt_manager.get_repair_prompt(prompt, message)
+        if repair_prompt is None:
+            return None
+
+        # Everything after the original prompt is the partial response plus the re-opened field
+        partial_response = repair_prompt[len(prompt):]
+        missing_fields = self.prompt_manager.get_missing_fields(message)
+        max_tokens = self.REPAIR_TOKENS_PER_FIELD * max(1, len(missing_fields))
+
+        log.debug("Repairing response with up to %s tokens\n\n", max_tokens)
+
+        # The continuation starts mid-response, so it cannot follow the full response grammar
+        if model_properties is not None and 'grammar_string' in model_properties:
+            model_properties = {key: value for key, value in model_properties.items() if key != 'grammar_string'}
+
+        try:
+            continuation = self.generate(repair_prompt, temperature, max_tokens, model_properties)
+        except TextGenAPIError as e:
+            log.debug("Repair request failed: %s\n\n", e)
+            return None
+
+        return partial_response + continuation
+
+
+    def post(self, endpoint:str, request:dict, method:str = 'POST') -> requests.Response:
+        """
+        POST to the API, retrying transport errors and transient status codes
+        with exponential backoff.
+
+        Args:
+            endpoint (str): The API endpoint, relative to the base url.
+            request (dict): The JSON body to send.
+            method (str): The HTTP method, for backends that read with GET.
+
+        Returns:
+            requests.Response: The last response received.
+
+        Raises:
+            TextGenAPIError: If the API could not be reached after all retries.
+            DeadlineExceededError: If the completion's deadline passes first.
+            RequestCancelledError: If the request's cancel scope is cancelled.
+            BackendUnavailableError: If the backend's circuit breaker is open.
+        """
+
+        uri = f'{self.base_url}{endpoint}'
+        last_error = None
+
+        for attempt in range(self.MAX_RETRIES + 1):
+            if attempt > 0:
+                delay = self.RETRY_BACKOFF * (2 ** (attempt - 1))
+                delay = delay + random.uniform(0, delay / 2)
+                remaining = time_remaining()
+                time.sleep(delay if remaining is None else min(delay, remaining))
+            if deadline_expired():
+                raise DeadlineExceededError(f'The deadline passed before {uri} replied')
+            if is_cancelled():
+                raise RequestCancelledError(f'The request to {uri} was cancelled')
+            if not self.breaker.allow_request():
+                telemetry.increment('breaker_rejections')
+                raise BackendUnavailableError(f'{self.base_url} is not answering, skipped the request to {endpoint}')
+            try:
+                response = self.send(endpoint, request, method)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if deadline_expired():
+                    raise DeadlineExceededError(f'The deadline passed before {uri} replied') from e
+                if is_cancelled():
+                    raise RequestCancelledError(f'The request to {uri} was cancelled') from e
+                self.breaker.record_failure()
+                last_error = e
+                log.debug("Request to %s failed (attempt %s): %s", uri, attempt + 1, e)
+                telemetry.increment('retries')
+                continue
+
+            # Gateway errors mean the backend is down, anything else shows it is up
+            if response.status_code in self.UNAVAILABLE_STATUS_CODES:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+            if response.status_code not in self.RETRY_STATUS_CODES or attempt == self.MAX_RETRIES:
+                return response
+
+            telemetry.increment('retries')
+            log.debug("Request to %s returned %s (attempt %s)", uri, response.status_code, attempt + 1)
+
+        raise TextGenAPIError(f'Could not reach {uri} after {self.MAX_RETRIES + 1} attempts: {last_error}')
+
+
+    def send(self, endpoint:str, request:dict, method:str = 'POST'):
+        """
+        POST to the API once, through the gateway if one is configured.
+        The gateway only relays POST requests, so GET requests go direct, and
+        it queues the request in the priority class of the caller's scheduler
+        slot. The transport times out when the completion's deadline passes.
+
+        Args:
+            endpoint (str): The API endpoint, relative to the base url.
+            request (dict): The JSON body to send.
+            method (str): The HTTP method.
+
+        Returns:
+            requests.Response|GatewayResponse: The response.
+        """
+
+        start = time.perf_counter()
+        timeout = time_remaining()
+        if timeout == 0.0:
+            raise requests.exceptions.Timeout(f'The deadline passed before {endpoint} was sent')
+
+        if self.gateway is not None and method == 'POST':
+            response = self.gateway.post(endpoint, request, current_priority(), timeout)
+            headers_received = time.perf_counter()
+        elif current_scope() is not None:
+            # A session of its own, so cancelling closes this request's connection and no other
+            with cancellable_session() as session:
+                response = session.request(method, f'{self.base_url}{endpoint}', json=request, stream=True, timeout=timeout)
+                headers_received = time.perf_counter()
+                _ = response.content
         else:
-            logger.debug(
-                f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET}\n"
-                f"{Fore.RED}Error: Response status code {response.status_code}{Fore.RESET}"
-            )
-            return "Error: " + response.text
+            # Stream the body so the wait for the server and the transfer are timed apart
+            response = requests.request(method, f'{self.base_url}{endpoint}', json=request, stream=True, timeout=timeout)
+            headers_received = time.perf_counter()
+            _ = response.content
+
+        done = time.perf_counter()
+        telemetry.record_span('http_wait', headers_received - start, endpoint=endpoint)
+        telemetry.record_span('http_transfer', done - headers_received, endpoint=endpoint)
+
+        return response
 
 
     def get_embedding(self,text):
-        logger.debug(
-            f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Getting embedding for text {text}"
-        )
-        request = {'text':str(text)}
+        log.debug_payload("Getting embedding for text", text)
 
-        response = requests.post(self.base_url+'/api/v1/get-embeddings', json=request)
-        
-        if response.status_code == 200:
-            logger.debug(
-                f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Got response {response.json()}"
-            )
-            return response.json()['results'][0]['embeddings']
-        else:
-            logger.debug(
-                f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET}\n"
-                f"{Fore.RED}Error: Response status code {response.status_code}{Fore.RESET}"
-            )
+        embeddings = self.get_embeddings([text])
+        if embeddings is None or len(embeddings) == 0:
             return ["Error"]
+
+        return embeddings[0]
+
+
+    def get_embeddings(self, texts:list) -> list|None:
+        """
+        Get the embeddings of several texts, in one request if the backend batches them.
+
+        Args:
+            texts (list): The texts.
+
+        Returns:
+            list|None: One embedding per text, or None if the request failed.
+        """
+
+        method, endpoint, request = self.backend.embeddings_request(self.model, [str(text) for text in texts])
+
+        try:
+            response = self.post(endpoint, request, method)
+        except TextGenAPIError as e:
+            log.debug("Error: %s", e)
+            return None
+
+        if response.status_code != 200:
+            log.debug("Error: Response status code %s", response.status_code)
+            return None
+
+        try:
+            response_json = response.json()
+            log.debug_payload("Got response", response_json)
+            return self.backend.parse_embeddings(response_json)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            log.debug("Error: Unexpected embeddings response: %s", e)
+            return None
+
+
         
-        
-    def select_model(self) -> str:
+    def select_model(self) -> str|None:
         """
         Present the user with a list of models to choose from, and return the ID of the selected model.
         
         Returns:
-            str: The ID of the selected model.
+            str|None: The ID of the selected model, or None if the backend could not list its models.
         """
 
         selected_model = ''
 
-        request = {
-            'action': 'list'
-        }
+        method, endpoint, request = self.backend.list_models_request()
 
         model_list = ''
 
         try:
-            endpoint = f'{self.base_url}{self.API_ENDPOINT_MODELS}'
-            logger.debug(f'{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET}: Getting models from {endpoint}')
-            response = requests.post(endpoint, json=request)
-            model_list = response.json()['result']
-            if isinstance(model_list, str):
-                model_list = [model_list]
-                
+            log.debug("Getting models from %s%s", self.base_url, endpoint)
+            response = self.post(endpoint, request, method)
+            model_list = self.backend.parse_models(response.json())
+
         except Exception as e:
-            logger.debug(
-                f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET}\n"
-                f"{Fore.RED}Error trying to get model to select: {e}{Fore.RESET}"
-            )
-            
-            # Terminate the application
-            os._exit(1)
+            log.error("Error trying to get model to select: %s", e)
+            return None
 
         if len(model_list) == 0:
             raise Exception('No models found. Aborting.')
@@ -228,7 +913,7 @@ class Client:
         return model_id
 
 
-    def get_context_size(self, model:str) -> int:
+    def get_context_size(self, model:str) -> int|None:
         """
         Get the context size of a model.
         
@@ -236,37 +921,33 @@ class Client:
             model (str): The ID of the model to get the context size of.
             
         Returns:
-            int: The context size of the model.
+            int|None: The context size of the model, or None if the backend could not load it.
         """
 
         context_size = 0
 
-        request = {
-            'action': 'load',
-            'model_name': model
-        }
+        method, endpoint, request = self.backend.load_model_request(model)
 
         try:
-            endpoint = f'{self.base_url}{self.API_ENDPOINT_MODELS}'
-            logger.debug(f'{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET}: Getting context size from {endpoint}')
+            log.debug("Getting context size from %s%s", self.base_url, endpoint)
             print(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Loading your model. This may take a few moments...")
-            response = requests.post(endpoint, json=request)
-            model_info = response.json()['result']
-            context_size = model_info['shared.settings']['truncation_length']
-            logger.debug(f'{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET}: Context size is {context_size}')
+            response = self.post(endpoint, request, method)
+            context_size = self.backend.parse_context_size(response.json(), model)
+            if context_size is None:
+                log.debug("The backend does not report a context size, using %s", self.DEFAULT_CONTEXT_SIZE)
+                context_size = self.DEFAULT_CONTEXT_SIZE
+            log.debug("Context size is %s", context_size)
         except Exception as e:
-            logger.debug(
-                f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET}\n"
-                f"{Fore.RED}Error trying to get context size: {e}{Fore.RESET}"
-            )
-            os._exit(1)
+            log.error("Error trying to get context size: %s", e)
+            return None
         
         return context_size
     
 
     def calculate_token_length(self, message:str) -> int:
         """
-        Calculate the length of a message in tokens.
+        Calculate the length of a message in tokens, estimating it from the
+        length of the message if the backend cannot count it.
         
         Args:
             message (str): The message to calculate the length of.
@@ -275,27 +956,63 @@ class Client:
             int: The length of the message in tokens.
         """
 
-        result = 0
+        result = self.count_tokens(message)
+        if result is None:
+            result = self.estimate_token_length(message)
+
+        return result
 
-        uri = f'{self.base_url}{self.API_ENDPOINT_TOKENCOUNT}'
+
+    def count_tokens(self, message:str) -> int|None:
+        """
+        Ask the backend for the length of a message in tokens. The token
+        count endpoint has its own breaker, so while it keeps failing counts
+        are estimated without asking.
+
+        Args:
+            message (str): The message to count.
+
+        Returns:
+            int|None: The length of the message in tokens, or None if the backend could not count it.
+        """
+
+        if not self.token_count_breaker.allow_request():
+            return None
 
         try:
-            post = {
-                'prompt': message
-            }
-            reply = requests.post(uri, json=post)
+            method, endpoint, post = self.backend.token_count_request(self.model, message)
+            reply = self.post(endpoint, post, method)
 
             if reply.status_code == 200:
-                api_response = reply.json()
-                try:
-                    result = api_response['results'][0]['tokens']
-                except:
-                    pass
+                result = self.backend.parse_token_count(reply.json())
+                self.token_count_breaker.record_success()
+                return result
+            log.debug("Error: Response status code %s", reply.status_code)
+        except DeadlineExceededError:
+            raise
+        except BackendUnavailableError:
+            # The whole backend is down, which says nothing about the token count endpoint
+            return None
         except Exception as e:
-            logger.debug(
-                f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET}\n"
-                f"{Fore.RED}Error trying to calculate token length: {e}{Fore.RESET}"
-            )
-            os._exit(1)
+            log.debug("Error trying to calculate token length: %s", e)
+
+        self.token_count_breaker.record_failure()
+
+        return None
+
+
+    def estimate_token_length(self, message:str) -> int:
+        """
+        Estimate the length of a message in tokens from its length in
+        characters, for when the backend cannot count it.
+
+        Args:
+            message (str): The message to estimate.
+
+        Returns:
+            int: The estimated length in tokens.
+        """
+
+        telemetry.increment('estimated_token_counts')
 
-        return result
\ No newline at end of file
+        return len(message) // self.CHARS_PER_TOKEN + 1
\ No newline at end of file
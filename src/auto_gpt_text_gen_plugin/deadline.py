@@ -0,0 +1,56 @@
+import contextlib
+import contextvars
+import time
+
+# The monotonic time by which the current completion must finish, or None for no limit
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+@contextlib.contextmanager
+def deadline(timeout:float = None):
+    """
+    Bound how long the requests made inside the block may take. Nested
+    deadlines can only shorten the one already set. The deadline follows
+    the context, so work handed to other threads with a copied context is
+    bound by it too.
+
+    Args:
+        timeout (float): The time allowed in seconds. None or 0 adds no limit.
+    """
+
+    current = _deadline.get()
+    if timeout is not None and timeout > 0:
+        limit = time.monotonic() + timeout
+        current = limit if current is None else min(current, limit)
+
+    token = _deadline.set(current)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_remaining() -> float|None:
+    """
+    Get the time left before the current deadline.
+
+    Returns:
+        float|None: The seconds left, 0 once the deadline has passed, or None if there is no deadline.
+    """
+
+    current = _deadline.get()
+    if current is None:
+        return None
+
+    return max(0.0, current - time.monotonic())
+
+
+def deadline_expired() -> bool:
+    """
+    Check whether the current deadline has passed.
+
+    Returns:
+        bool: True if there is a deadline and it has passed.
+    """
+
+    return time_remaining() == 0.0
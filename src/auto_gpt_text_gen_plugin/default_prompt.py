@@ -21,7 +21,7 @@ class DefaultPrompt(PromptEngine):
             str: String representation of the messages.
         """
 
-        return self.messages_to_conversation(messages, 'User: ')
+        return self.messages_to_conversation(messages[:1] + self.compress_history(messages[1:]), 'User: ')
     
 
     def reshape_response(self, message):
@@ -35,4 +35,18 @@ class DefaultPrompt(PromptEngine):
             dict: The message as a dictionary.
         """
 
-        return message
\ No newline at end of file
+        return message
+
+
+    def error_response(self, error:str) -> str:
+        """
+        Pass-back the error as plain text, matching the pass-through responses.
+
+        Args:
+            error (str): The error to report.
+
+        Returns:
+            str: The error message.
+        """
+
+        return f'Error: {error}'
@@ -0,0 +1,120 @@
+import threading
+from importlib import metadata
+from .chat_template_prompt import ChatTemplatePrompt
+from .default_prompt import DefaultPrompt
+from .log import log
+from .monolithic_prompt import MonolithicPrompt
+
+
+class PromptEngineRegistry:
+    """
+    The prompt engines a profile's `template_type` can name.
+
+    The built-in engines are registered up front. Other packages add engines
+    by declaring an entry point in the `auto_gpt_text_gen_plugin.prompt_engines`
+    group, named after the template type and pointing at a PromptEngine
+    subclass. Entry points are loaded the first time an engine is looked up.
+    """
+
+    ENTRY_POINT_GROUP = 'auto_gpt_text_gen_plugin.prompt_engines'
+    DEFAULT_ENGINE = 'default'
+
+    def __init__(self) -> None:
+        self._engines = {}
+        self._entry_points_loaded = False
+        self._lock = threading.Lock()
+
+
+    def register(self, name:str, engine_class:type) -> None:
+        """
+        Register a prompt engine.
+
+        Args:
+            name (str): The template type that selects the engine.
+            engine_class (type): The PromptEngine subclass, constructed with the prompt profile.
+        """
+
+        with self._lock:
+            self._engines[name] = engine_class
+
+
+    def load_entry_points(self) -> None:
+        """Register the engines other packages declare as entry points. Engines that fail to load are skipped."""
+
+        with self._lock:
+            if self._entry_points_loaded:
+                return
+            self._entry_points_loaded = True
+
+        entry_points = metadata.entry_points()
+        if hasattr(entry_points, 'select'):
+            entry_points = entry_points.select(group=self.ENTRY_POINT_GROUP)
+        else:
+            entry_points = entry_points.get(self.ENTRY_POINT_GROUP, [])
+
+        for entry_point in entry_points:
+            try:
+                self.register(entry_point.name, entry_point.load())
+            except Exception as e:
+                log.error("Could not load the prompt engine %s: %s", entry_point.name, e)
+
+
+    def get(self, name:str) -> type|None:
+        """
+        Look up a prompt engine.
+
+        Args:
+            name (str): The template type.
+
+        Returns:
+            type|None: The engine class, or None if no engine is registered under the name.
+        """
+
+        self.load_entry_points()
+
+        with self._lock:
+            return self._engines.get(name, None)
+
+
+    def names(self) -> list:
+        """
+        List the registered template types.
+
+        Returns:
+            list: The names, sorted.
+        """
+
+        self.load_entry_points()
+
+        with self._lock:
+            return sorted(self._engines.keys())
+
+
+    def create(self, prompt_profile:dict):
+        """
+        Create the prompt engine a prompt profile asks for, falling back to
+        the default engine for unknown or missing template types.
+
+        Args:
+            prompt_profile (dict): The loaded prompt profile.
+
+        Returns:
+            PromptEngine: The prompt engine.
+        """
+
+        name = self.DEFAULT_ENGINE
+        if prompt_profile is not None and 'template_type' in prompt_profile:
+            name = prompt_profile['template_type']
+
+        engine_class = self.get(name)
+        if engine_class is None:
+            log.error("Unknown template_type %s, using the default prompt engine. Available: %s", name, ', '.join(self.names()))
+            engine_class = self.get(self.DEFAULT_ENGINE)
+
+        return engine_class(prompt_profile)
+
+
+engines = PromptEngineRegistry()
+engines.register('chat_template', ChatTemplatePrompt)
+engines.register('default', DefaultPrompt)
+engines.register('monolithic', MonolithicPrompt)
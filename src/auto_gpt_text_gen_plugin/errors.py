@@ -0,0 +1,14 @@
+class TextGenAPIError(Exception):
+    """Raised when the Text Gen WebUI API cannot be reached or keeps failing."""
+
+
+class DeadlineExceededError(TextGenAPIError):
+    """Raised when a request cannot finish before the completion's deadline."""
+
+
+class BackendUnavailableError(TextGenAPIError):
+    """Raised without sending a request while the backend's circuit breaker is open."""
+
+
+class RequestCancelledError(TextGenAPIError):
+    """Raised when a request is cancelled because its result is no longer needed."""
@@ -0,0 +1,433 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import requests
+from .backends import BACKENDS, create_backend
+from .cache import LRUCache, content_hash
+from .cancel import current_scope
+from .deadline import deadline, deadline_expired, time_remaining
+from .errors import DeadlineExceededError
+from .scheduler import RequestScheduler
+from .telemetry import telemetry
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayResponse:
+    """A response relayed by the gateway, shaped like the parts of requests.Response the client uses."""
+
+    def __init__(self, status_code:int, text:str) -> None:
+        self.status_code = status_code
+        self.text = text
+
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class GatewayTransport:
+    """
+    Sends API requests to a local gateway over a Unix socket instead of to
+    Text Gen WebUI directly. Each thread keeps its own connection open.
+    """
+
+    def __init__(self, socket_path:str) -> None:
+        """
+        Args:
+            socket_path (str): The path of the gateway's Unix socket.
+        """
+
+        self.socket_path = socket_path
+        self._local = threading.local()
+
+
+    def connect(self):
+        """
+        Get this thread's connection to the gateway, opening it if needed.
+
+        Returns:
+            file: A read/write stream over the connection.
+        """
+
+        stream = getattr(self._local, 'stream', None)
+        if stream is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(self.socket_path)
+            stream = connection.makefile('rwb')
+            self._local.connection = connection
+            self._local.stream = stream
+
+        return stream
+
+
+    def close(self) -> None:
+        """Close this thread's connection to the gateway."""
+
+        stream = getattr(self._local, 'stream', None)
+        if stream is not None:
+            try:
+                stream.close()
+                self._local.connection.close()
+            except OSError:
+                pass
+        self._local.stream = None
+        self._local.connection = None
+
+
+    def post(self, endpoint:str, request:dict, priority:int = None, timeout:float = None) -> GatewayResponse:
+        """
+        Relay a POST through the gateway.
+
+        Args:
+            endpoint (str): The API endpoint.
+            request (dict): The JSON body to send.
+            priority (int): The scheduler priority class. Defaults to one chosen by endpoint.
+            timeout (float): Seconds to wait for the response. None waits indefinitely.
+
+        Returns:
+            GatewayResponse: The backend's response.
+
+        Raises:
+            requests.exceptions.ConnectionError: If the gateway cannot be reached.
+            requests.exceptions.Timeout: If the response does not arrive in time.
+        """
+
+        message = {
+            'endpoint': endpoint,
+            'request': request,
+            'priority': priority,
+            'agent_id': f'{os.getpid()}-{threading.get_ident()}',
+            'timeout': timeout,
+        }
+
+        # Cancelling the request shuts the connection down, and the gateway drops the reply
+        scope = current_scope()
+        connection = None
+
+        try:
+            stream = self.connect()
+            connection = self._local.connection
+            if scope is not None:
+                scope.register(connection)
+            connection.settimeout(timeout)
+            stream.write(json.dumps(message).encode('utf-8') + b'\n')
+            stream.flush()
+            line = stream.readline()
+        except TimeoutError as e:
+            # A late reply would be read as the answer to the next request, so start over
+            self.close()
+            raise requests.exceptions.Timeout(f'The gateway at {self.socket_path} did not reply in {timeout} seconds') from e
+        except OSError as e:
+            self.close()
+            raise requests.exceptions.ConnectionError(f'Could not reach the gateway at {self.socket_path}: {e}') from e
+        finally:
+            if scope is not None and connection is not None:
+                scope.unregister(connection)
+
+        if not line:
+            self.close()
+            raise requests.exceptions.ConnectionError(f'The gateway at {self.socket_path} closed the connection')
+
+        reply = json.loads(line)
+
+        return GatewayResponse(reply['status_code'], reply['text'])
+
+
+class Gateway:
+    """
+    Shares one view of the backend between every Auto-GPT process on a host:
+    pooled connections, caches of token counts, embeddings, loaded models and
+    deterministic completions, and a single request scheduler. The endpoints
+    it caches and schedules come from the backend's adapter, so the gateway
+    must be started with the same backend as its clients.
+    """
+
+    def __init__(self, base_url:str, max_concurrency:int = 1, cache_size:int = 4096, backend:str = 'textgen') -> None:
+        """
+        Args:
+            base_url (str): The base url of the server.
+            max_concurrency (int): The number of requests allowed to run against the backend at once.
+            cache_size (int): The number of entries to keep in each cache.
+            backend (str): The server's API: textgen, openai or llamacpp.
+        """
+
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+        self.scheduler = RequestScheduler(max_concurrency)
+        self.backend = create_backend(backend)
+
+        # Build a request of each kind to learn the endpoints the backend's clients use
+        _, self.generate_endpoint, _ = self.backend.generate_request(None, '', 0, 1)
+        _, token_count_endpoint, _ = self.backend.token_count_request(None, '')
+        _, embeddings_endpoint, _ = self.backend.embeddings_request(None, [''])
+        load_method, load_endpoint, _ = self.backend.load_model_request(None)
+
+        self.caches = {
+            token_count_endpoint: LRUCache(cache_size),
+            embeddings_endpoint: LRUCache(cache_size),
+            self.generate_endpoint: LRUCache(cache_size),
+        }
+        self.priorities = {
+            self.generate_endpoint: RequestScheduler.PRIORITY_INTERACTIVE,
+            token_count_endpoint: RequestScheduler.PRIORITY_INTERACTIVE,
+            embeddings_endpoint: RequestScheduler.PRIORITY_EMBEDDING,
+        }
+
+        if self.backend.supports_token_ids:
+            _, tokenize_endpoint, _ = self.backend.tokenize_request(None, '')
+            self.caches[tokenize_endpoint] = LRUCache(cache_size)
+            self.priorities[tokenize_endpoint] = RequestScheduler.PRIORITY_INTERACTIVE
+
+        # Only loads sent as POST pass through the gateway
+        self.model_endpoint = load_endpoint if load_method == 'POST' else None
+        if self.model_endpoint is not None:
+            self.caches[self.model_endpoint] = LRUCache(16)
+
+        # Requests that must not wait behind the generation they are meant to stop
+        stop = self.backend.stop_request()
+        self.unscheduled = [stop[1]] if stop is not None else []
+
+        # The model the last load through the gateway put on the backend, part of every cache key
+        self.loaded_model = None
+
+
+    def is_cacheable(self, endpoint:str, request:dict) -> bool:
+        """
+        Check whether the response to a request can be served from the cache.
+
+        Args:
+            endpoint (str): The API endpoint.
+            request (dict): The JSON body.
+
+        Returns:
+            bool: True if the response only depends on the request.
+        """
+
+        if endpoint == self.generate_endpoint:
+            # Only seeded or greedy completions are repeatable
+            return int(request.get('seed', -1)) >= 0 or float(request.get('temperature', 1)) == 0
+
+        if endpoint == self.model_endpoint:
+            # Every process loads the model on start-up, only the first load of the loaded model needs to reach the backend
+            return self.is_model_load(endpoint, request) and self.loaded_model is not None and self.backend.parse_load_model_request(request) == self.loaded_model
+
+        return endpoint in self.caches
+
+
+    def is_model_load(self, endpoint:str, request:dict) -> bool:
+        """
+        Args:
+            endpoint (str): The API endpoint.
+            request (dict): The JSON body.
+
+        Returns:
+            bool: True if the request loads a model.
+        """
+
+        return endpoint == self.model_endpoint and self.backend.parse_load_model_request(request) is not None
+
+
+    def get_cache_key(self, request:dict) -> str:
+        """
+        Args:
+            request (dict): The JSON body.
+
+        Returns:
+            str: The cache key of the request under the loaded model, since token counts, embeddings and completions change with the model.
+        """
+
+        return content_hash({'model': self.loaded_model, 'request': request})
+
+
+    def handle(self, endpoint:str, request:dict, priority:int = None, agent_id = None, timeout:float = None) -> GatewayResponse:
+        """
+        Serve a request from the cache or forward it to the backend. The
+        client's timeout counts from when the request arrives, so the wait
+        for a turn uses it up, and a request whose client has given up is
+        dropped instead of being forwarded.
+
+        Args:
+            endpoint (str): The API endpoint.
+            request (dict): The JSON body.
+            priority (int): The scheduler priority class the client's request runs in. Defaults to one chosen by endpoint.
+            agent_id: The agent making the request.
+            timeout (float): Seconds the client will wait for the backend. None waits indefinitely.
+
+        Returns:
+            GatewayResponse: The response, or a 504 response if the timeout passed before it was forwarded.
+        """
+
+        with deadline(timeout):
+            return self.serve(endpoint, request, priority, agent_id)
+
+
+    def serve(self, endpoint:str, request:dict, priority:int = None, agent_id = None) -> GatewayResponse:
+        """
+        Serve a request within the current deadline.
+
+        Args:
+            endpoint (str): The API endpoint.
+            request (dict): The JSON body.
+            priority (int): The scheduler priority class the client's request runs in. Defaults to one chosen by endpoint.
+            agent_id: The agent making the request.
+
+        Returns:
+            GatewayResponse: The response.
+        """
+
+        if endpoint == '/gateway/metrics':
+            if request.get('format') == 'prometheus':
+                return GatewayResponse(200, telemetry.to_prometheus())
+            return GatewayResponse(200, json.dumps(self.get_metrics()))
+
+        cacheable = self.is_cacheable(endpoint, request)
+        key = self.get_cache_key(request)
+        if cacheable:
+            cached = self.caches[endpoint].get(key)
+            if cached is not None:
+                telemetry.increment('cache_hits')
+                return cached
+            telemetry.increment('cache_misses')
+
+        if endpoint in self.unscheduled:
+            response = self.forward(endpoint, request, time_remaining())
+        else:
+            if priority not in RequestScheduler.PRIORITY_NAMES:
+                priority = self.priorities.get(endpoint, RequestScheduler.PRIORITY_BACKGROUND)
+
+            try:
+                with self.scheduler.slot(priority, agent_id, self.base_url):
+                    if deadline_expired():
+                        raise DeadlineExceededError(f'The deadline passed before {endpoint} was forwarded')
+                    response = self.forward(endpoint, request, time_remaining())
+            except DeadlineExceededError as e:
+                telemetry.increment('deadlines_exceeded')
+                logger.info('Dropped a request to %s: %s', endpoint, e)
+                return GatewayResponse(504, str(e))
+
+        if self.is_model_load(endpoint, request) and response.status_code == 200:
+            # Repeated loads of this model are answered from the cache until another model is loaded
+            self.loaded_model = self.backend.parse_load_model_request(request)
+            key = self.get_cache_key(request)
+            cacheable = True
+
+        if cacheable and response.status_code == 200:
+            self.caches[endpoint].put(key, response)
+
+        return response
+
+
+    def forward(self, endpoint:str, request:dict, timeout:float = None) -> GatewayResponse:
+        """
+        Send a request to the backend.
+
+        Args:
+            endpoint (str): The API endpoint.
+            request (dict): The JSON body.
+            timeout (float): Seconds to wait for the backend. None waits indefinitely.
+
+        Returns:
+            GatewayResponse: The response, or a 502 response if the backend could not be reached in time.
+        """
+
+        try:
+            reply = self.session.post(self.base_url + endpoint, json=request, timeout=timeout)
+            return GatewayResponse(reply.status_code, reply.text)
+        except requests.exceptions.RequestException as e:
+            logger.warning('Request to %s failed: %s', endpoint, e)
+            return GatewayResponse(502, str(e))
+
+
+    def get_metrics(self) -> dict:
+        """
+        Get the scheduler and cache metrics.
+
+        Returns:
+            dict: The metrics.
+        """
+
+        return {
+            'scheduler': self.scheduler.get_metrics(),
+            'caches': {endpoint: cache.get_metrics() for endpoint, cache in self.caches.items()},
+            'telemetry': telemetry.get_metrics(),
+        }
+
+
+class GatewayRequestHandler(socketserver.StreamRequestHandler):
+    """Serves newline-delimited JSON requests on one connection until it closes."""
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                response = self.server.gateway.handle(
+                    message['endpoint'], message.get('request') or {}, message.get('priority'), message.get('agent_id'), message.get('timeout')
+                )
+            except Exception as e:
+                logger.exception('Could not handle gateway request')
+                response = GatewayResponse(500, str(e))
+
+            # Clients that hit their deadline close the connection without waiting for the reply
+            try:
+                self.wfile.write(json.dumps({'status_code': response.status_code, 'text': response.text}).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except OSError:
+                return
+
+
+class GatewayServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Listens for plugin clients on a Unix socket."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path:str, gateway:Gateway) -> None:
+        """
+        Args:
+            socket_path (str): The path of the Unix socket to listen on.
+            gateway (Gateway): The gateway that serves requests.
+        """
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        self.gateway = gateway
+
+        # Only the user running the gateway may connect to it
+        previous_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, GatewayRequestHandler)
+        finally:
+            os.umask(previous_umask)
+        os.chmod(socket_path, 0o600)
+
+
+def main(argv:list = None) -> None:
+    """Run the gateway daemon."""
+
+    parser = argparse.ArgumentParser(description='Shared backend gateway for Auto-GPT-Text-Gen-Plugin clients.')
+    parser.add_argument('--socket', default=os.environ.get('LOCAL_LLM_GATEWAY_SOCKET', '/tmp/auto-gpt-text-gen.sock'))
+    parser.add_argument('--base-url', default=os.environ.get('LOCAL_LLM_BASE_URL', 'http://127.0.0.1:5000/'))
+    parser.add_argument('--backend', choices=list(BACKENDS), default=os.environ.get('LOCAL_LLM_BACKEND', 'textgen'), help='The server\'s API. Must match the clients\'.')
+    parser.add_argument('--max-concurrency', type=int, default=int(os.environ.get('LOCAL_LLM_MAX_CONCURRENCY', '1')))
+    parser.add_argument('--cache-size', type=int, default=4096)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = GatewayServer(args.socket, Gateway(args.base_url, args.max_concurrency, args.cache_size, args.backend))
+    logger.info('Gateway for the %s API at %s listening on %s', args.backend, args.base_url, args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import functools
+import re
+
+
+class ResponseGrammar:
+    """
+    Compiles the simplified response format of a prompt profile into a grammar
+    for backends that support constrained decoding, and validates responses
+    against it.
+
+    The response format is read as a template: top-level `key: <str>` lines are
+    scalar fields, a `key:` line followed by `- <str-item>` lines is a list, and
+    a `key:` line followed by `- name: <str-item>` / `value: <str-item>` lines is
+    a list of mappings. All values are generated as double-quoted strings
+    without control characters, so the response is always valid YAML.
+    """
+
+    def __init__(self, response_format:str) -> None:
+        """
+        Args:
+            response_format (str): The profile's response format template.
+        """
+
+        self.fields = self.parse_format(response_format)
+        self.regex = re.compile(self.to_regex())
+
+
+    def parse_format(self, response_format:str) -> list:
+        """
+        Parse the response format template into field definitions.
+
+        Args:
+            response_format (str): The profile's response format template.
+
+        Returns:
+            list: Tuples of (name, kind, item_keys, indent) where kind is
+                'scalar', 'list' or 'mapping_list'.
+        """
+
+        fields = []
+        lines = [line.rstrip() for line in response_format.replace('\\n', '\n').split('\n') if line.strip() != '']
+
+        i = 0
+        while i < len(lines):
+            match = re.match(r'^(\w+):\s*(.*)$', lines[i])
+            i += 1
+            if match is None:
+                continue
+
+            name, value = match.group(1), match.group(2)
+            if value != '':
+                fields.append((name, 'scalar', [], ''))
+                continue
+
+            # Collect the indented lines that belong to this field
+            item_lines = []
+            while i < len(lines) and lines[i].startswith(' '):
+                item_lines.append(lines[i])
+                i += 1
+
+            first_item = re.match(r'^(\s*)-\s*(\w+):', item_lines[0]) if len(item_lines) > 0 else None
+            if first_item is None:
+                indent = re.match(r'^(\s*)', item_lines[0]).group(1) if len(item_lines) > 0 else ' '
+                fields.append((name, 'list', [], indent))
+                continue
+
+            # A list of mappings, the keys are taken from the first item
+            indent = first_item.group(1)
+            item_keys = [first_item.group(2)]
+            for line in item_lines[1:]:
+                key_match = re.match(r'^\s+(\w+):', line)
+                if line.lstrip().startswith('-') or key_match is None:
+                    break
+                item_keys.append(key_match.group(1))
+            fields.append((name, 'mapping_list', item_keys, indent))
+
+        return fields
+
+
+    def to_gbnf(self) -> str:
+        """
+        Build a GBNF grammar, as accepted by llama.cpp based backends.
+
+        Returns:
+            str: The grammar.
+        """
+
+        rules = []
+        root = []
+
+        for name, kind, item_keys, indent in self.fields:
+            rule_name = name.replace('_', '-')
+            root.append(rule_name)
+
+            if kind == 'scalar':
+                rules.append(f'{rule_name} ::= "{name}: " value "\\n"')
+            elif kind == 'list':
+                rules.append(f'{rule_name} ::= "{name}:\\n" {rule_name}-item+')
+                rules.append(f'{rule_name}-item ::= "{indent}- " value "\\n"')
+            else:
+                # Command arguments may be empty, so mapping lists may have no items
+                item_indent = indent + '  '
+                item = f'"{indent}- {item_keys[0]}: " value "\\n"'
+                for key in item_keys[1:]:
+                    item += f' "{item_indent}{key}: " value "\\n"'
+                rules.append(f'{rule_name} ::= "{name}:\\n" {rule_name}-item*')
+                rules.append(f'{rule_name}-item ::= {item}')
+
+        rules.insert(0, 'root ::= ' + ' '.join(root))
+        rules.append(r'value ::= "\"" ( [^"\\\x00-\x1f\x7f-\x9f] | "\\" ["\\nt] )* "\""')
+
+        return '\n'.join(rules) + '\n'
+
+
+    def to_regex(self) -> str:
+        """
+        Build an anchored regular expression equivalent to the grammar. Every
+        repetition is over disjoint alternatives, so matching is linear in the
+        length of the response.
+
+        Returns:
+            str: The regular expression.
+        """
+
+        # Control characters are left out of values, since YAML rejects them
+        value = r'"(?:[^"\\\x00-\x1f\x7f-\x9f]|\\["\\nt])*"'
+        pattern = ''
+
+        for name, kind, item_keys, indent in self.fields:
+            if kind == 'scalar':
+                pattern += f'{re.escape(name)}: {value}\\n'
+            elif kind == 'list':
+                pattern += f'{re.escape(name)}:\\n(?:{re.escape(indent)}- {value}\\n)+'
+            else:
+                item_indent = indent + '  '
+                item = f'{re.escape(indent)}- {re.escape(item_keys[0])}: {value}\\n'
+                for key in item_keys[1:]:
+                    item += f'{re.escape(item_indent)}{re.escape(key)}: {value}\\n'
+                pattern += f'{re.escape(name)}:\\n(?:{item})*'
+
+        return pattern
+
+
+    def validate(self, text:str) -> bool:
+        """
+        Check whether a response conforms to the grammar.
+
+        Args:
+            text (str): The response to check.
+
+        Returns:
+            bool: True if the response conforms.
+        """
+
+        text = text.strip() + '\n'
+
+        return self.regex.fullmatch(text) is not None
+
+
+@functools.lru_cache(maxsize=16)
+def compile_response_format(response_format:str) -> ResponseGrammar:
+    """
+    Compile a response format once and reuse it for every request.
+
+    Args:
+        response_format (str): The profile's response format template.
+
+    Returns:
+        ResponseGrammar: The compiled grammar.
+    """
+
+    return ResponseGrammar(response_format)
@@ -0,0 +1,224 @@
+import threading
+import time
+from .log import log
+from .telemetry import telemetry
+
+
+class CircuitBreaker:
+    """
+    Tracks whether a backend is answering, so requests fail fast while it
+    is down instead of each waiting through its own retries.
+
+    The breaker opens after a run of consecutive failures. While it is open
+    requests are refused, until the reset timeout has passed or the health
+    monitor sees the backend answer again. After the reset timeout one
+    request is let through as a trial: success closes the breaker, failure
+    opens it again. A trial that never reports back is replaced by another
+    after the same timeout.
+    """
+
+    STATE_CLOSED = 'closed'
+    STATE_OPEN = 'open'
+    STATE_HALF_OPEN = 'half_open'
+
+    def __init__(self, name:str, failure_threshold:int = 3, reset_timeout:float = 10.0) -> None:
+        """
+        Args:
+            name (str): The backend, for logs and metrics.
+            failure_threshold (int): The consecutive failures that open the breaker.
+            reset_timeout (float): Seconds to wait before letting a trial request through.
+        """
+
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.STATE_CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+        self._trial_started = None
+        self._lock = threading.Lock()
+
+
+    def allow_request(self) -> bool:
+        """
+        Check whether a request may be sent to the backend.
+
+        Returns:
+            bool: True if the breaker is closed, or this request is the trial after the reset timeout.
+        """
+
+        with self._lock:
+            if self.state == self.STATE_CLOSED:
+                return True
+
+            now = time.monotonic()
+            if self.state == self.STATE_OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = self.STATE_HALF_OPEN
+                self._trial_started = None
+
+            if self.state == self.STATE_HALF_OPEN and (self._trial_started is None or now - self._trial_started >= self.reset_timeout):
+                self._trial_started = now
+                return True
+
+            return False
+
+
+    def record_success(self) -> None:
+        """Record that the backend answered, closing the breaker."""
+
+        with self._lock:
+            if self.state != self.STATE_CLOSED:
+                log.debug("Backend %s is answering again", self.name)
+            self.state = self.STATE_CLOSED
+            self.failures = 0
+            self._trial_started = None
+
+
+    def record_failure(self) -> None:
+        """Record that the backend failed, opening the breaker after enough failures in a row."""
+
+        with self._lock:
+            self.failures += 1
+            self._trial_started = None
+
+            if self.state == self.STATE_HALF_OPEN or (self.state == self.STATE_CLOSED and self.failures >= self.failure_threshold):
+                if self.state == self.STATE_CLOSED:
+                    log.error("Backend %s failed %s times in a row, pausing requests to it", self.name, self.failures)
+                    self.trips += 1
+                    telemetry.increment('breaker_trips')
+                self.state = self.STATE_OPEN
+                self.opened_at = time.monotonic()
+
+
+    def get_status(self) -> dict:
+        """
+        Get the state of the breaker.
+
+        Returns:
+            dict: The state, consecutive failures and the number of times the breaker opened.
+        """
+
+        with self._lock:
+            return {'state': self.state, 'consecutive_failures': self.failures, 'trips': self.trips}
+
+
+class HealthMonitor:
+    """
+    Probes a backend in the background while its breaker is open, and
+    closes the breaker as soon as the backend answers, so requests resume
+    without waiting out the reset timeout. Probes are only sent while the
+    backend is down.
+    """
+
+    def __init__(self, breaker:CircuitBreaker, probe, interval:float = 2.0) -> None:
+        """
+        Args:
+            breaker (CircuitBreaker): The breaker of the backend.
+            probe (callable): Returns True if the backend answers.
+            interval (float): Seconds between probes.
+        """
+
+        self.breaker = breaker
+        self.probe = probe
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name=f'health-{breaker.name}', daemon=True)
+        self._thread.start()
+
+
+    def run(self) -> None:
+        """Probe the backend every interval while its breaker is not closed."""
+
+        while not self._stop.wait(self.interval):
+            if self.breaker.get_status()['state'] == CircuitBreaker.STATE_CLOSED:
+                continue
+
+            try:
+                healthy = self.probe()
+            except Exception as e:
+                log.debug("Health probe of %s failed: %s", self.breaker.name, e)
+                healthy = False
+
+            if healthy:
+                self.breaker.record_success()
+                telemetry.increment('backend_recoveries')
+
+
+    def stop(self) -> None:
+        """Stop probing."""
+
+        self._stop.set()
+
+
+class HealthRegistry:
+    """
+    One breaker and monitor per backend, shared by every client of the
+    backend in the process, such as the main client and its routes.
+    """
+
+    def __init__(self) -> None:
+        self._breakers = {}
+        self._monitors = {}
+        self._lock = threading.Lock()
+
+
+    def get_breaker(self, name:str, failure_threshold:int = 3, reset_timeout:float = 10.0) -> CircuitBreaker:
+        """
+        Get the breaker of a backend, creating it on first use.
+
+        Args:
+            name (str): The backend's base url.
+            failure_threshold (int): The consecutive failures that open the breaker.
+            reset_timeout (float): Seconds to wait before letting a trial request through.
+
+        Returns:
+            CircuitBreaker: The breaker.
+        """
+
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(name, failure_threshold, reset_timeout)
+            return self._breakers[name]
+
+
+    def get_monitor(self, breaker:CircuitBreaker, probe, interval:float) -> HealthMonitor|None:
+        """
+        Get the monitor of a backend, starting it on first use.
+
+        Args:
+            breaker (CircuitBreaker): The breaker of the backend.
+            probe (callable): Returns True if the backend answers.
+            interval (float): Seconds between probes. 0 disables the monitor.
+
+        Returns:
+            HealthMonitor|None: The monitor, or None if it is disabled.
+        """
+
+        if interval <= 0:
+            return None
+
+        with self._lock:
+            if breaker.name not in self._monitors:
+                self._monitors[breaker.name] = HealthMonitor(breaker, probe, interval)
+            return self._monitors[breaker.name]
+
+
+    def get_status(self) -> dict:
+        """
+        Get the state of every backend's breaker.
+
+        Returns:
+            dict: The breaker status by backend.
+        """
+
+        with self._lock:
+            breakers = dict(self._breakers)
+
+        return {name: breaker.get_status() for name, breaker in breakers.items()}
+
+
+health = HealthRegistry()
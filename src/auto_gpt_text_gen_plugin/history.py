@@ -0,0 +1,464 @@
+import math
+import threading
+import time
+from .cache import LRUCache, content_hash
+from .log import log
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def normalise_vector(vector:list) -> list|None:
+    """
+    Scale an embedding to unit length, so cosine similarity is a dot product.
+    The vector is a numpy array if numpy is installed.
+
+    Args:
+        vector (list): The embedding.
+
+    Returns:
+        list|None: The unit vector, or None if the embedding is empty or not numeric.
+    """
+
+    try:
+        norm = math.sqrt(sum(value * value for value in vector))
+    except TypeError:
+        return None
+
+    if norm == 0:
+        return None
+
+    if numpy is not None:
+        return numpy.asarray(vector, dtype=numpy.float32) / norm
+
+    return [value / norm for value in vector]
+
+
+class HistoryCompressor:
+    """
+    Shrinks the history Auto-GPT sends before it is turned into a prompt.
+
+    Messages over the token budget keep their head and tail with a note of
+    how much was cut from the middle, and messages that repeat an earlier
+    message word for word are replaced with a short note. Tokens are
+    estimated from the length of the text, since the backend's tokenizer is
+    not available to the prompt engines. Compressed forms are cached by
+    content hash, so each blob is only cut once.
+    """
+
+    CHARS_PER_TOKEN = 4
+    HEAD_FRACTION = 0.7
+    DEDUPE_MIN_CHARS = 200
+    DUPLICATE_NOTE = '[Same as an earlier message, omitted]'
+
+    def __init__(self, max_message_tokens:int = 0, dedupe:bool = False, cache_size:int = 1024) -> None:
+        """
+        Args:
+            max_message_tokens (int): The budget of each history message. 0 disables truncation.
+            dedupe (bool): Whether to replace repeated messages with a note.
+            cache_size (int): The number of compressed messages to keep.
+        """
+
+        self.max_message_tokens = max_message_tokens
+        self.dedupe = dedupe
+        self.compressed = LRUCache(cache_size)
+
+
+    def is_enabled(self) -> bool:
+        """
+        Check whether the compressor changes anything.
+
+        Returns:
+            bool: True if truncation or dedupe is on.
+        """
+
+        return self.max_message_tokens > 0 or self.dedupe
+
+
+    def truncate(self, content:str) -> str:
+        """
+        Cut the middle out of a message that is over the budget.
+
+        Args:
+            content (str): The message content.
+
+        Returns:
+            str: The content, or its head and tail if it is over the budget.
+        """
+
+        max_chars = self.max_message_tokens * self.CHARS_PER_TOKEN
+        if self.max_message_tokens <= 0 or len(content) <= max_chars:
+            return content
+
+        key = content_hash(content)
+        truncated = self.compressed.get(key)
+        if truncated is None:
+            head = int(max_chars * self.HEAD_FRACTION)
+            tail = max_chars - head
+            omitted = len(content) - head - tail
+            truncated = f'{content[:head]}\n[... {omitted} characters omitted ...]\n{content[len(content) - tail:]}'
+            self.compressed.put(key, truncated)
+
+        return truncated
+
+
+    def compress(self, messages:list) -> list:
+        """
+        Compress a history.
+
+        Args:
+            messages (list): The history messages.
+
+        Returns:
+            list: The messages with compressed content. Unchanged messages are passed through.
+        """
+
+        if not self.is_enabled():
+            return messages
+
+        seen = set()
+        compressed = []
+
+        for message in messages:
+            content = message['content']
+            if not isinstance(content, str):
+                compressed.append(message)
+                continue
+
+            if self.dedupe and len(content) >= self.DEDUPE_MIN_CHARS:
+                if content in seen:
+                    compressed.append({**message, 'content': self.DUPLICATE_NOTE})
+                    continue
+                seen.add(content)
+
+            truncated = self.truncate(content)
+            compressed.append(message if truncated is content else {**message, 'content': truncated})
+
+        return compressed
+
+
+class EmbeddingCache:
+    """
+    Unit-length embeddings of messages, computed once per message. The
+    texts that are not cached yet are embedded in one batch. If the backend
+    cannot embed, no more requests are made for a while, so a backend
+    without embeddings is not asked again for every message of every step.
+    """
+
+    RETRY_AFTER = 300
+
+    def __init__(self, embed_many, cache_size:int = 4096) -> None:
+        """
+        Args:
+            embed_many (callable): Returns the embeddings of a list of texts, or None if they cannot be embedded.
+            cache_size (int): The number of embeddings to keep.
+        """
+
+        self.embed_many = embed_many
+        self.vectors = LRUCache(cache_size, 'embedding')
+
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+
+    def is_available(self) -> bool:
+        """
+        Check whether embeddings may be requested.
+
+        Returns:
+            bool: False for RETRY_AFTER seconds after a failed request.
+        """
+
+        with self._lock:
+            return self._failed_at is None or time.monotonic() - self._failed_at >= self.RETRY_AFTER
+
+
+    def get_many(self, contents:list) -> list|None:
+        """
+        Get the unit embeddings of several texts, requesting the uncached ones
+        in one batch.
+
+        Args:
+            contents (list): The texts.
+
+        Returns:
+            list|None: The content hash and unit vector of each text, or None if any text could not be embedded.
+        """
+
+        keys = [content_hash(content) for content in contents]
+        found = {key: self.vectors.get(key) for key in keys}
+        missing = {key: content for key, content in zip(keys, contents) if found[key] is None}
+
+        if len(missing) > 0:
+            if not self.is_available():
+                return None
+
+            embeddings = self.embed_many(list(missing.values()))
+            vectors = [normalise_vector(embedding) for embedding in embeddings] if embeddings is not None and len(embeddings) == len(missing) else None
+            if vectors is None or any(vector is None for vector in vectors):
+                log.debug("Could not embed %s texts, not asking again for %s seconds", len(missing), self.RETRY_AFTER)
+                with self._lock:
+                    self._failed_at = time.monotonic()
+                return None
+
+            for key, vector in zip(missing.keys(), vectors):
+                self.vectors.put(key, vector)
+                found[key] = vector
+
+        return [(key, found[key]) for key in keys]
+
+
+    def get(self, content:str) -> tuple:
+        """
+        Get the unit embedding of a text, from the cache if possible.
+
+        Args:
+            content (str): The text.
+
+        Returns:
+            tuple: The content hash and the unit vector, or None if the embedding failed.
+        """
+
+        vectors = self.get_many([content])
+
+        return vectors[0] if vectors is not None else (content_hash(content), None)
+
+
+    def similarities(self, first:list, second:list):
+        """
+        Get the cosine similarities between two lists of embeddings.
+
+        Args:
+            first (list): The content hash and unit vector of each text on one side.
+            second (list): The content hash and unit vector of each text on the other.
+
+        Returns:
+            numpy.ndarray|list: One row per text of the first list, one column per text of the second.
+        """
+
+        if numpy is not None:
+            return numpy.stack([vector for _, vector in first]) @ numpy.stack([vector for _, vector in second]).T
+
+        return [[sum(a * b for a, b in zip(row, column)) for _, column in second] for _, row in first]
+
+
+class SemanticDeduplicator:
+    """
+    Collapses history messages that say nearly the same thing as an earlier
+    message, such as an agent repeating a thought or rerunning a command.
+
+    Messages are compared by the cosine similarity of their embeddings.
+    Embeddings are cached and requested in one batch for the messages added
+    since the last step, and the similarities of a step are computed as one
+    matrix product when numpy is installed.
+    """
+
+    MIN_CHARS = 50
+    SIMILAR_NOTE = '[Similar to an earlier message, omitted]'
+
+    def __init__(self, embeddings:EmbeddingCache, threshold:float, collapse:bool = True) -> None:
+        """
+        Args:
+            embeddings (EmbeddingCache): The embeddings of the messages.
+            threshold (float): The cosine similarity above which a message counts as a duplicate.
+            collapse (bool): Replace duplicates with a note instead of dropping them.
+        """
+
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.collapse = collapse
+
+
+    def deduplicate(self, messages:list) -> list:
+        """
+        Drop or collapse the messages that are near duplicates of an earlier message.
+
+        Args:
+            messages (list): The history messages.
+
+        Returns:
+            list: The deduplicated messages. If embeddings cannot be computed, the messages are returned unchanged.
+        """
+
+        compared = [index for index, message in enumerate(messages) if isinstance(message['content'], str) and len(message['content']) >= self.MIN_CHARS]
+        if len(compared) < 2:
+            return messages
+
+        vectors = self.embeddings.get_many([messages[index]['content'] for index in compared])
+        if vectors is None:
+            log.debug("Could not embed the history, skipping semantic deduplication")
+            return messages
+
+        similarities = self.embeddings.similarities(vectors, vectors)
+        duplicates = set()
+        kept = []
+
+        for position, index in enumerate(compared):
+            if numpy is not None:
+                duplicate = len(kept) > 0 and similarities[position, kept].max() >= self.threshold
+            else:
+                duplicate = any(similarities[position][earlier] >= self.threshold for earlier in kept)
+
+            if duplicate:
+                duplicates.add(index)
+            else:
+                kept.append(position)
+
+        deduplicated = []
+        for index, message in enumerate(messages):
+            if index not in duplicates:
+                deduplicated.append(message)
+            elif self.collapse:
+                deduplicated.append({**message, 'content': self.SIMILAR_NOTE})
+
+        return deduplicated
+
+
+class HistorySelector:
+    """
+    Picks the history messages to send when the history is over its token
+    budget, instead of cutting it at a fixed position.
+
+    Each message is scored by its recency and by how similar it is to the
+    agent's goals and last command. The best-scoring messages that fit the
+    budget are sent in their original order. With numpy installed, the
+    similarities are computed over a matrix of the cached embeddings that is
+    extended as the history grows.
+    """
+
+    CHARS_PER_TOKEN = 4
+
+    def __init__(self, embeddings:EmbeddingCache|None, max_tokens:int, recency_weight:float = 0.5, half_life:float = 10) -> None:
+        """
+        Args:
+            embeddings (EmbeddingCache|None): The embeddings of the messages. Without them messages are scored by recency alone.
+            max_tokens (int): The token budget of the history.
+            recency_weight (float): The weight of recency in the score, between 0 and 1. Similarity has the rest.
+            half_life (float): The number of messages after which a message's recency score halves.
+
+        Raises:
+            ValueError: If the half-life is not positive.
+        """
+
+        if half_life <= 0:
+            raise ValueError(f'The recency half-life must be positive, got {half_life}')
+
+        self.embeddings = embeddings
+        self.max_tokens = max_tokens
+        self.recency_weight = recency_weight
+        self.half_life = half_life
+
+        self._matrix_keys = []
+        self._matrix = None
+        self._lock = threading.Lock()
+
+
+    def estimate_tokens(self, message:dict) -> int:
+        """
+        Estimate the tokens a message takes in the prompt.
+
+        Args:
+            message (dict): The message.
+
+        Returns:
+            int: The estimated number of tokens.
+        """
+
+        return len(str(message['content'])) // self.CHARS_PER_TOKEN + 1
+
+
+    def get_matrix(self, vectors:list):
+        """
+        Stack message embeddings into a matrix, extending the last matrix
+        when the history only grew since it was built.
+
+        Args:
+            vectors (list): The content hash and unit vector of each message.
+
+        Returns:
+            numpy.ndarray: One row per message.
+        """
+
+        keys = [key for key, _ in vectors]
+
+        with self._lock:
+            cached_keys, matrix = self._matrix_keys, self._matrix
+
+        if matrix is not None and 0 < len(cached_keys) <= len(keys) and keys[:len(cached_keys)] == cached_keys:
+            if len(cached_keys) < len(keys):
+                matrix = numpy.vstack([matrix, numpy.stack([vector for _, vector in vectors[len(cached_keys):]])])
+        else:
+            matrix = numpy.stack([vector for _, vector in vectors])
+
+        with self._lock:
+            self._matrix_keys, self._matrix = keys, matrix
+
+        return matrix
+
+
+    def get_relevance(self, messages:list, queries:list) -> list:
+        """
+        Score each message by its highest similarity to any of the queries.
+
+        Args:
+            messages (list): The history messages.
+            queries (list): The texts the history should be relevant to.
+
+        Returns:
+            list: A score between 0 and 1 for each message. All 0 if the texts cannot be embedded.
+        """
+
+        no_relevance = [0.0] * len(messages)
+        if self.embeddings is None:
+            return no_relevance
+
+        queries = [query for query in queries if query not in ['', None]]
+        if len(queries) == 0:
+            return no_relevance
+
+        # One batch for everything not cached yet, and no request at all while embeddings are failing
+        vectors = self.embeddings.get_many(queries + [str(message['content']) for message in messages])
+        if vectors is None:
+            return no_relevance
+        query_vectors, message_vectors = vectors[:len(queries)], vectors[len(queries):]
+
+        if numpy is not None:
+            similarities = self.get_matrix(message_vectors) @ numpy.stack([vector for _, vector in query_vectors]).T
+            return numpy.clip(similarities.max(axis=1), 0, 1).tolist()
+
+        return [max(0.0, max(row)) for row in self.embeddings.similarities(message_vectors, query_vectors)]
+
+
+    def select(self, messages:list, queries:list) -> list:
+        """
+        Select the history messages that fit the budget.
+
+        Args:
+            messages (list): The history messages, oldest first.
+            queries (list): The texts the history should be relevant to, such as the goals and the last command.
+
+        Returns:
+            list: The selected messages, oldest first.
+        """
+
+        tokens = [self.estimate_tokens(message) for message in messages]
+        if self.max_tokens <= 0 or sum(tokens) <= self.max_tokens:
+            return messages
+
+        relevance = self.get_relevance(messages, queries)
+        count = len(messages)
+        scores = [
+            self.recency_weight * 0.5 ** ((count - 1 - index) / self.half_life) + (1 - self.recency_weight) * relevance[index]
+            for index in range(count)
+        ]
+
+        selected = []
+        budget = self.max_tokens
+        for index in sorted(range(count), key=lambda index: scores[index], reverse=True):
+            if tokens[index] <= budget:
+                selected.append(index)
+                budget -= tokens[index]
+
+        return [messages[index] for index in sorted(selected)]
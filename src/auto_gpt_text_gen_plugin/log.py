@@ -0,0 +1,139 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+from autogpt.logs import logger
+from colorama import Fore
+
+
+class PluginLogger:
+    """
+    Logging for the completion path that costs nothing when debug output is off.
+
+    Messages are only formatted, and payloads only serialised, after checking
+    that debug logging is enabled. Payloads written to the console are sampled
+    and truncated. Full payloads can instead be written to a rotating file by
+    a background thread, off the completion path.
+    """
+
+    PREFIX = f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET}"
+
+    def __init__(self, max_payload_chars:int = 2000, payload_sample_rate:float = 1.0, dump_path:str = None) -> None:
+        """
+        Args:
+            max_payload_chars (int): Payloads logged to the console are truncated to this length. 0 disables truncation.
+            payload_sample_rate (float): The fraction of payloads logged to the console.
+            dump_path (str): The rotating file to write full payloads to. Defaults to none.
+        """
+
+        self.max_payload_chars = max_payload_chars
+        self.payload_sample_rate = payload_sample_rate
+        self.dump_path = dump_path
+
+        self._dump_queue = None
+        if dump_path is not None:
+            self._dump_queue = queue.SimpleQueue()
+            threading.Thread(target=self.write_dumps, name='text-gen-plugin-dump', daemon=True).start()
+
+
+    def is_debug_enabled(self) -> bool:
+        """
+        Check whether Auto-GPT's logger would emit a debug message.
+
+        Returns:
+            bool: True if debug messages are emitted.
+        """
+
+        return getattr(logger, 'logger', logger).isEnabledFor(logging.DEBUG)
+
+
+    def debug(self, message:str, *args) -> None:
+        """
+        Log a debug message, formatting it with %-style arguments only if it will be emitted.
+
+        Args:
+            message (str): The message, with %-style placeholders.
+            args: The values of the placeholders.
+        """
+
+        if not self.is_debug_enabled():
+            return
+
+        logger.debug(f"{self.PREFIX} {message % args if args else message}")
+
+
+    def error(self, message:str, *args) -> None:
+        """
+        Log an error message.
+
+        Args:
+            message (str): The message, with %-style placeholders.
+            args: The values of the placeholders.
+        """
+
+        logger.error(f"{self.PREFIX} {message % args if args else message}")
+
+
+    def debug_payload(self, label:str, payload) -> None:
+        """
+        Log a prompt, request or response. The full payload goes to the dump
+        file if one is configured, a sampled and truncated copy to the console
+        if debug output is on.
+
+        Args:
+            label (str): What the payload is.
+            payload: A string or JSON-serialisable object.
+        """
+
+        if self._dump_queue is not None:
+            self._dump_queue.put((label, list(payload) if isinstance(payload, list) else payload))
+
+        if not self.is_debug_enabled() or random.random() >= self.payload_sample_rate:
+            return
+
+        text = self.format_payload(payload)
+        if self.max_payload_chars > 0 and len(text) > self.max_payload_chars:
+            text = f'{text[:self.max_payload_chars]}... [{len(text) - self.max_payload_chars} more characters]'
+
+        logger.debug(f"{self.PREFIX} {label}:\n{text}\n\n")
+
+
+    def format_payload(self, payload) -> str:
+        """
+        Render a payload as text.
+
+        Args:
+            payload: A string or JSON-serialisable object.
+
+        Returns:
+            str: The payload as text.
+        """
+
+        if isinstance(payload, str):
+            return payload
+
+        try:
+            return json.dumps(payload, indent=4)
+        except (TypeError, ValueError):
+            return str(payload)
+
+
+    def write_dumps(self) -> None:
+        """Write queued payloads to the dump file. Runs on a background thread."""
+
+        handler = logging.handlers.RotatingFileHandler(self.dump_path, maxBytes=10 * 1024 * 1024, backupCount=5, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+
+        while True:
+            label, payload = self._dump_queue.get()
+            handler.emit(logging.makeLogRecord({'msg': f'{label}:\n{self.format_payload(payload)}\n'}))
+
+
+log = PluginLogger(
+    int(os.environ.get('LOCAL_LLM_LOG_MAX_CHARS', '2000')),
+    float(os.environ.get('LOCAL_LLM_LOG_SAMPLE_RATE', '1.0')),
+    os.environ.get('LOCAL_LLM_DUMP_FILE', None) or None,
+)
@@ -0,0 +1,232 @@
+import re
+import threading
+from .cache import LRUCache, content_hash
+
+# Words that do not change what an instruction asks for
+STOP_WORDS = frozenset(['a', 'an', 'the', 'to', 'of', 'and', 'or', 'your', 'you', 'is', 'are', 'be', 'for', 'in', 'on', 'with', 'as', 'it', 'that', 'this', 'so', 'e', 'g'])
+
+# Words that negate an instruction, treated as one word when comparing
+NEGATIONS = frozenset(['no', 'not', 'never', 'without'])
+
+
+class PromptMinifier:
+    """
+    Shrinks the static sections of a monolithic prompt, the part that is
+    sent again on every step of an agent.
+
+    Guidance, constraints, resources and performance evaluation items that
+    repeat an earlier item are dropped. An item repeats another if both have
+    the same words, leaving out filler words and case, so items that only
+    share some words are kept. Section labels are
+    dropped when the section is empty or its text repeats the label, the
+    command list is cut down to call signatures, and blank lines and
+    trailing spaces are removed. Minified prompts are cached by profile and
+    system message, so each agent's prompt is only minified once.
+    """
+
+    CHARS_PER_TOKEN = 4
+
+    def __init__(self, prompt_profile:dict, cache_size:int = 256) -> None:
+        """
+        Args:
+            prompt_profile (dict): The prompt profile, part of the cache key.
+            cache_size (int): The number of minified prompts to keep.
+        """
+
+        self.profile_key = content_hash(prompt_profile)
+        self.minified = LRUCache(cache_size)
+
+        self.chars_before = 0
+        self.chars_after = 0
+        self._lock = threading.Lock()
+
+        self.regex_command = re.compile(r'^(?:\d+\.\s*)?([\w-]+): (.*?), args: (.*)$')
+        self.regex_command_arg = re.compile(r'"([^"]+)":\s*"[^"]*"')
+
+
+    def get_key(self, system_message:str) -> tuple:
+        """
+        Args:
+            system_message (str): The agent's system message.
+
+        Returns:
+            tuple: The cache key of the system message's prompt under this profile.
+        """
+
+        return self.profile_key, content_hash(system_message)
+
+
+    def get(self, system_message:str) -> tuple|None:
+        """
+        Get the minified prompt built for a system message.
+
+        Args:
+            system_message (str): The agent's system message.
+
+        Returns:
+            tuple|None: The minified prompt and the tokens it saves, or None if it has not been built.
+        """
+
+        return self.minified.get(self.get_key(system_message))
+
+
+    def put(self, system_message:str, original:str, minified:str) -> tuple:
+        """
+        Cache the minified prompt of a system message.
+
+        Args:
+            system_message (str): The agent's system message.
+            original (str): The prompt before minifying.
+            minified (str): The minified prompt.
+
+        Returns:
+            tuple: The minified prompt and the tokens it saves, estimated from the characters removed.
+        """
+
+        entry = (minified, (len(original) - len(minified)) // self.CHARS_PER_TOKEN)
+        self.minified.put(self.get_key(system_message), entry)
+
+        with self._lock:
+            self.chars_before += len(original)
+            self.chars_after += len(minified)
+
+        return entry
+
+
+    def get_words(self, item:str) -> frozenset:
+        """
+        Get the words of an instruction that carry its meaning.
+
+        Args:
+            item (str): The instruction.
+
+        Returns:
+            frozenset: The words, lower case, with negations merged and filler words left out.
+        """
+
+        words = re.findall(r"[a-z0-9~']+", str(item).lower())
+
+        return frozenset('not' if word in NEGATIONS else word for word in words if word not in STOP_WORDS)
+
+
+    def dedupe_items(self, lists:list) -> list:
+        """
+        Drop the items that repeat an earlier item, in the same list or an
+        earlier one. Only items with the same words are dropped, since an
+        item with fewer words can mean something else, such as "Delete
+        files" after "Never delete files without asking".
+
+        Args:
+            lists (list): The lists of instructions, in prompt order.
+
+        Returns:
+            list: The lists without the repeated items.
+        """
+
+        seen = set()
+        deduped = []
+
+        for items in lists:
+            kept = []
+            for item in items:
+                words = self.get_words(item)
+                if len(words) > 0 and words in seen:
+                    continue
+                seen.add(words)
+                kept.append(item)
+            deduped.append(kept)
+
+        return deduped
+
+
+    def compact_commands(self, command_list:str) -> str:
+        """
+        Rewrite a numbered command list as call signatures. Descriptions are
+        kept only if they say more than the command's name and
+        arguments.
+
+        Args:
+            command_list (str): The command list, one command per line.
+
+        Returns:
+            str: The commands, one signature per line. Lines that are not commands are kept as they are.
+        """
+
+        lines = []
+
+        for line in command_list.splitlines():
+            match = self.regex_command.match(line.strip())
+            if match is None:
+                if line.strip() != '':
+                    lines.append(line)
+                continue
+
+            name, description, args = match.groups()
+            args = self.regex_command_arg.findall(args)
+            signature = f"{name}({', '.join(args)})"
+            if not self.get_words(description) <= self.get_words(' '.join([name.replace('_', ' ')] + args)):
+                signature += f': {description}'
+            lines.append(signature)
+
+        return ''.join(f'{line}\n' for line in lines)
+
+
+    def is_redundant_label(self, label:str, body:str) -> bool:
+        """
+        Check whether a section's label can be left out.
+
+        Args:
+            label (str): The label.
+            body (str): The section's text after the label.
+
+        Returns:
+            bool: True if the section is empty or its text repeats the label.
+        """
+
+        text = ' '.join(label.split()).lower()
+
+        return body.strip() == '' or (text != '' and text in ' '.join(body.split()).lower())
+
+
+    def compact_sections(self, sections:dict) -> dict:
+        """
+        Remove blank lines and trailing spaces from the sections of a prompt,
+        including the blank lines between them.
+
+        Args:
+            sections (dict): The text of each section, in prompt order.
+
+        Returns:
+            dict: The compacted sections.
+        """
+
+        compacted = {}
+        ends_line = True
+
+        for name, text in sections.items():
+            text = re.sub(r'[ \t]+\n', '\n', text)
+            text = re.sub(r'\n{2,}', '\n', text)
+            if ends_line:
+                text = text.lstrip('\n')
+            compacted[name] = text
+            if text != '':
+                ends_line = text.endswith('\n')
+
+        return compacted
+
+
+    def get_metrics(self) -> dict:
+        """
+        Get the size of the prompts before and after minifying.
+
+        Returns:
+            dict: The characters of every prompt built, before and after minifying, the estimated tokens that saves, and the cache's counters.
+        """
+
+        with self._lock:
+            return {
+                'chars_before': self.chars_before,
+                'chars_after': self.chars_after,
+                'tokens_saved': (self.chars_before - self.chars_after) // self.CHARS_PER_TOKEN,
+                'cache': self.minified.get_metrics(),
+            }
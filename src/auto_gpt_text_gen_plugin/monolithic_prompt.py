@@ -1,18 +1,33 @@
 import json
 import re
 import yaml
-from autogpt.logs import logger
 from colorama import Fore, Style
-from .prompt_engine import PromptEngine
+from .grammar import compile_response_format
+from .log import log
+from .minify import PromptMinifier
+from .prompt_engine import PromptEngine, RequestContext, ResponseParseError
+from .telemetry import telemetry
 
 class MonolithicPrompt(PromptEngine):
 
+    capabilities = frozenset([
+        PromptEngine.CAPABILITY_CACHEABLE_PREFIX,
+        PromptEngine.CAPABILITY_STREAMING_PARSE,
+        PromptEngine.CAPABILITY_GRAMMAR,
+    ])
+
     def __init__(self, prompt_profile) -> None:
         """Initializes the MonolithicPrompt class."""
 
         super().__init__()
         self.prompt_profile = prompt_profile
 
+        # Constants
+        self.DEFAULT_RESPONSE_FIELDS = ['plan_summary', 'reasoning', 'next_steps', 'considerations', 'tts_msg', 'command_name', 'args']
+
+        # Shrink the sections sent on every step, if the profile asks for it
+        self.minifier = PromptMinifier(prompt_profile) if self.get_profile_attribute('minify_prompt').lower() == 'true' else None
+
 
     def reshape_message(self, messages:list) -> str:
         """
@@ -25,50 +40,217 @@ class MonolithicPrompt(PromptEngine):
             str: String representation of the messages.
         """
 
-        self.original_system_msg = messages[0]['content']
-
-        # Prime the variables
-        message_string = ''
-
-        send_as_name = self.get_user_name()
-        if send_as_name not in ['', None, 'None'] and len(send_as_name) > 0:
-            send_as_name += ': '
-        elif send_as_name == None:
-            send_as_name = ''
+        context = RequestContext.from_messages(messages)
+        send_as_name = self.get_send_as_name()
         
-        if not self.is_ai_system_prompt(self.original_system_msg):
-            logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} The system message is not an agent prompt, returning original message\n\n")
+        if not self.is_ai_system_prompt(context.system_message):
+            log.debug("The system message is not an agent prompt, returning original message\n\n")
             return self.messages_to_conversation(messages, send_as_name)
         else:
-            logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} The system message is an agent prompt, continuing\n\n")
-
-        # Rebuild prompt
-        message_string += send_as_name
-        message_string += self.get_ai_profile()
-        message_string += self.get_ai_constraints()
-        message_string += self.get_commands()
-        message_string += self.get_ai_resources()
-        message_string += self.get_ai_critique()
-        message_string += self.get_response_format()
-        message_string = self.get_profile_attribute('prescript') + message_string
+            log.debug("The system message is an agent prompt, continuing\n\n")
+
+        # Rebuild prompt, joining the parts once at the end
+        if self.minifier is not None:
+            prefix, tokens_saved = self.get_minified_prefix(context, send_as_name)
+            telemetry.increment('minified_tokens_saved', tokens_saved)
+        else:
+            prefix = self.build_prompt_prefix(context, send_as_name)
+        parts = [prefix]
 
         end_strip = self.get_end_strip()
-        history = self.messages_to_conversation(messages[1:-end_strip], send_as_name)
+        history_messages = self.select_history(self.compress_history(messages[1:len(messages) - end_strip]))
+        history = self.messages_to_conversation(history_messages, send_as_name)
         if history not in ['', None, 'None'] and len(history) > 0:
-            message_string += self.get_profile_attribute('history_start') + '\n\n'
-            message_string += history
-            message_string += self.get_profile_attribute('history_end') + '\n\n'
+            parts += [self.get_profile_attribute('history_start'), '\n\n', history, self.get_profile_attribute('history_end'), '\n\n']
         else:
-            message_string += self.get_profile_attribute('history_none') + '\n\n'
+            parts += [self.get_profile_attribute('history_none'), '\n\n']
 
         postscript = self.get_profile_attribute('postscript')
         if postscript not in ['', None, 'None'] and len(postscript) > 0:
-            message_string += send_as_name
-            message_string += postscript
+            parts += [send_as_name, postscript]
 
-        return message_string
+        return ''.join(parts)
     
 
+    def get_send_as_name(self) -> str:
+        """
+        Get the attribution of the user's turns.
+
+        Returns:
+            str: The name followed by a colon, or an empty string.
+        """
+
+        send_as_name = self.get_user_name()
+        if send_as_name not in ['', None, 'None'] and len(send_as_name) > 0:
+            send_as_name += ': '
+        elif send_as_name == None:
+            send_as_name = ''
+
+        return send_as_name
+
+
+    def build_prompt_prefix(self, context:RequestContext, send_as_name:str) -> str:
+        """
+        Build the part of an agent prompt that comes before the history.
+
+        Args:
+            context (RequestContext): The request.
+            send_as_name (str): The attribution of the user's turns.
+
+        Returns:
+            str: The prompt prefix.
+        """
+
+        if self.minifier is not None:
+            return self.get_minified_prefix(context, send_as_name)[0]
+
+        return ''.join(self.get_prompt_sections(context, send_as_name).values())
+
+
+    def get_prompt_sections(self, context:RequestContext, send_as_name:str) -> dict:
+        """
+        Build the sections of an agent prompt that come before the history.
+
+        Args:
+            context (RequestContext): The request.
+            send_as_name (str): The attribution of the user's turns.
+
+        Returns:
+            dict: The text of each section, in prompt order.
+        """
+
+        return {
+            'prescript': self.get_profile_attribute('prescript') + send_as_name,
+            'ai_profile': self.get_ai_profile(context),
+            'constraints': self.get_ai_constraints(),
+            'commands': self.get_commands(context),
+            'resources': self.get_ai_resources(),
+            'performance_eval': self.get_ai_critique(),
+            'response_format': self.get_response_format(),
+        }
+
+
+    def get_minified_sections(self, context:RequestContext, send_as_name:str) -> dict:
+        """
+        Build the sections that come before the history with repeated
+        guidance and redundant labels left out and the commands as
+        signatures. Uses the profile's strings like get_prompt_sections().
+
+        Args:
+            context (RequestContext): The request.
+            send_as_name (str): The attribution of the user's turns.
+
+        Returns:
+            dict: The text of each section, in prompt order.
+        """
+
+        guidance, constraints, resources, performance_eval = self.minifier.dedupe_items([
+            self.get_profile_list('general_guidance', 'strings'),
+            self.get_profile_list('constraints', 'strings'),
+            self.get_profile_list('resources', 'strings'),
+            self.get_profile_list('performance_eval', 'strings'),
+        ])
+
+        ai_profile = ''.join([
+            self.get_profile_attribute('lead_in', 'strings'),
+            self.get_agent_name() + ', ',
+            self.get_agent_role(),
+            self.get_profile_list_as_line('general_guidance', 'strings', guidance),
+            self.get_profile_attribute('os_prompt', 'strings'),
+            self.extract_from_original(self.regex_os, context),
+            self.get_profile_attribute('goal_label', 'strings'),
+            self.get_profile_list_as_line('goals', 'strings'),
+            self.get_agent_goals(),
+        ])
+
+        response_format = ''.join([
+            self.get_profile_attribute('response_format_pre_prompt', 'strings'),
+            self.get_profile_attribute_as_raw('response_format'),
+            self.get_profile_attribute('response_format_post_prompt', 'strings'),
+        ])
+
+        sections = {
+            'prescript': ('', self.get_profile_attribute('prescript') + send_as_name),
+            'ai_profile': ('', ai_profile),
+            'constraints': ('constraints_label', self.get_profile_numbered_list('constraints', 'strings', constraints)),
+            'commands': ('commands_label', self.minifier.compact_commands(self.get_command_list(context))),
+            'resources': ('resources_label', self.get_profile_numbered_list('resources', 'strings', resources)),
+            'performance_eval': ('performance_eval_label', self.get_profile_numbered_list('performance_eval', 'strings', performance_eval)),
+            'response_format': ('response_format_label', response_format),
+        }
+
+        labelled = {}
+        for name, (label_attribute, body) in sections.items():
+            label = self.get_profile_attribute(label_attribute, 'strings') if label_attribute != '' else ''
+            labelled[name] = ('' if self.minifier.is_redundant_label(label, body) else label) + body
+
+        return self.minifier.compact_sections(labelled)
+
+
+    def get_minified_prefix(self, context:RequestContext, send_as_name:str) -> tuple:
+        """
+        Get the minified part of an agent prompt that comes before the
+        history, building it once per system message.
+
+        Args:
+            context (RequestContext): The request.
+            send_as_name (str): The attribution of the user's turns.
+
+        Returns:
+            tuple: The minified prefix and the tokens minifying saves.
+        """
+
+        cached = self.minifier.get(context.system_message)
+        if cached is None:
+            original = ''.join(self.get_prompt_sections(context, send_as_name).values())
+            minified = ''.join(self.get_minified_sections(context, send_as_name).values())
+            cached = self.minifier.put(context.system_message, original, minified)
+
+        return cached
+
+
+    def get_prompt_prefix(self, messages:list) -> str|None:
+        """
+        Get the prompt up to the history, which only changes with the system message.
+
+        Args:
+            messages (list): The messages the prompt is built from.
+
+        Returns:
+            str|None: The prefix, or None if the messages are not an agent prompt.
+        """
+
+        if len(messages) == 0 or not self.is_ai_system_prompt(messages[0]['content']):
+            return None
+
+        prefix = self.build_prompt_prefix(RequestContext.from_messages(messages), self.get_send_as_name())
+
+        # Only hand out prefixes that end on a line, so tokens do not merge across the boundary
+        return prefix[:prefix.rfind('\n') + 1] or None
+
+
+    def get_stopping_strings(self, messages:list) -> list:
+        """
+        Stop generating when the model closes the template or starts writing history.
+
+        Args:
+            messages (list): The messages the prompt is built from.
+
+        Returns:
+            list: The stopping strings.
+        """
+
+        if len(messages) == 0 or not self.is_ai_system_prompt(messages[0]['content']):
+            return []
+
+        stopping_strings = ['--END TEMPLATE--']
+        history_start = self.get_profile_attribute('history_start')
+        if history_start not in ['', None, 'None']:
+            stopping_strings.append(history_start)
+
+        return stopping_strings
+
+
     def reshape_response(self, message:str) -> str:
         """
         Convert the API response to a dictionary, then convert thoughts->plan to a YAML list
@@ -81,15 +263,48 @@ class MonolithicPrompt(PromptEngine):
             str: The response as a dictionary, or the original message if it cannot be converted.
         """
 
-        message_str = message.strip()
+        try:
+            return self.parse_response(message, strict=False)
+        except ResponseParseError as e:
+            log.error("Could not reshape the response to the Auto-GPT format, returning original message: %s\n\n", e)
+            return message
+
+
+    def parse_response(self, message:str, strict:bool = True) -> str:
+        """
+        Convert the API response to the Auto-GPT format.
+
+        Args:
+            message (str): The response from the API.
+            strict (bool): Whether every field of the response format must be present.
+
+        Returns:
+            str: The response as an Auto-GPT JSON string.
+
+        Raises:
+            ResponseParseError: If the response cannot be converted.
+        """
+
+        message_str = self.truncate_response(message).strip()
+
+        # Constrained output takes the fast path straight to the YAML parser
+        if self.is_grammar_enabled() and self.get_response_grammar().validate(message_str):
+            try:
+                with telemetry.span('yaml_load'):
+                    message_data = yaml.safe_load(message_str)
+            except yaml.YAMLError as e:
+                log.debug("Response matched the grammar but is not valid YAML, cleaning it up: %s", e)
+            else:
+                with telemetry.span('convert_response'):
+                    return self.simple_response_to_autogpt_response(message_data)
 
         # If the message has a start template tag, remove it and everything before it
-        if '--START TEMPLATE--' in message:
-            message_str = message[message.find('--START TEMPLATE--')+len('--START TEMPLATE--'):]
+        if '--START TEMPLATE--' in message_str:
+            message_str = message_str[message_str.find('--START TEMPLATE--')+len('--START TEMPLATE--'):]
 
         # If the message has an end template tag, remove it and everything after it
-        if '--END TEMPLATE--' in message:
-            message_str = message_str[:message.find('--END TEMPLATE--')]
+        if '--END TEMPLATE--' in message_str:
+            message_str = message_str[:message_str.find('--END TEMPLATE--')]
 
         # If \n is double-escaped, fix it.
         if '\\n' in message_str:
@@ -108,30 +323,30 @@ class MonolithicPrompt(PromptEngine):
             if '\n' + keyword not in message_str:
                 message_str = message_str.replace(keyword, '\n' + keyword)
 
-        # If the list between next_steps: and considerations: is a numbered list, change it to a YAML list string
-        next_steps_num_pattern = r"(next_steps:\n)(1\..*?)(?=considerations:)"
-        next_step_num_matches = re.search(next_steps_num_pattern, message_str, re.DOTALL)
-        if next_step_num_matches:
-            next_step_list = next_step_num_matches.group(2).strip()
-            if next_step_list.startswith('1.'):
-                next_steps_bulleted_list = re.sub(r'\d+\.\s', ' - ', next_step_list)
-                next_steps_bulleted_list = re.sub(r'(?<=\w)(?=-)', '\n', next_steps_bulleted_list)
-                message_str = re.sub(next_steps_num_pattern, f'next_steps:\n{next_steps_bulleted_list}\n', message_str, flags=re.DOTALL)
+        # If the list between next_steps: and considerations: is a numbered list, change it to a YAML list string.
+        # The list is found with plain string searches, which stay linear on runaway outputs.
+        list_start = message_str.find('next_steps:\n1.')
+        list_end = message_str.find('considerations:', list_start) if list_start >= 0 else -1
+        if list_end >= 0:
+            next_step_list = message_str[list_start + len('next_steps:\n'):list_end].strip()
+            next_steps_bulleted_list = re.sub(r'\d+\.\s', ' - ', next_step_list)
+            next_steps_bulleted_list = re.sub(r'(?<=\w)(?=-)', '\n', next_steps_bulleted_list)
+            message_str = f'{message_str[:list_start]}next_steps:\n{next_steps_bulleted_list}\n{message_str[list_end:]}'
         
         # If it actually is a YAML list, but it is a stupid list, fix it.
-        next_step_bullet_pattern = r"(next_steps:\n)(-.*?)(?=\n|$)"
-        next_step_bullet_matches = re.search(next_step_bullet_pattern, message_str, re.DOTALL)
-        if next_step_bullet_matches:
-            bulleted_list = next_step_bullet_matches.group(2).strip()
-            if bulleted_list.startswith('-'):
-                # Insert newline before every `-` that is preceded by a `.`, except for the first bullet point
-                yaml_list = bulleted_list[0] + re.sub(r'(?<=\.)(?= -)', '\n', bulleted_list[1:])
-                message_str = re.sub(next_step_bullet_pattern, f'next_steps:\n{yaml_list}\n', message_str, flags=re.DOTALL)
+        list_start = message_str.find('next_steps:\n-')
+        if list_start >= 0:
+            list_end = message_str.find('\n', list_start + len('next_steps:\n'))
+            list_end = len(message_str) if list_end < 0 else list_end
+            bulleted_list = message_str[list_start + len('next_steps:\n'):list_end].strip()
+            # Insert newline before every `-` that is preceded by a `.`, except for the first bullet point
+            yaml_list = bulleted_list[0] + re.sub(r'(?<=\.)(?= -)', '\n', bulleted_list[1:])
+            message_str = f'{message_str[:list_start]}next_steps:\n{yaml_list}\n{message_str[list_end:]}'
 
 
         ## Spacing fixing...
-        # Remove space before the newline 
-        message_str = re.sub(r'\s*\n', '\n', message_str)
+        # Remove space before the newline. Each whitespace run is matched once, up to its last new line.
+        message_str = re.sub(r'\s+', self.collapse_line_break, message_str)
         # Look for "plan_summary:" at the start of the message_str
         if not message_str.startswith('plan_summary:'):
             # Does it exist anywhere?
@@ -143,12 +358,134 @@ class MonolithicPrompt(PromptEngine):
                 message_str = 'plan_summary:\n' + message_str
 
         try:
-            logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Attempting to convert the response to a dictionary: {message_str}\n\n")
-            message_data = yaml.safe_load(message_str)
-            logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Converted the YAML response to a dictionary\n\n")
-            converted_obj = self.simple_response_to_autogpt_response(message_data)
+            log.debug_payload("Attempting to convert the response to a dictionary", message_str)
+            with telemetry.span('yaml_load'):
+                message_data = yaml.safe_load(message_str)
+            log.debug("Converted the YAML response to a dictionary\n\n")
         except Exception as e:
-            logger.error(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Could not reshape the response to the Auto-GPT format, returning original message: {e}\n\n")
-            return message
+            raise ResponseParseError(f'Response is not valid YAML: {e}') from e
+
+        if strict:
+            if not isinstance(message_data, dict):
+                raise ResponseParseError('Response is not a YAML mapping')
+            missing_fields = [field for field in self.get_response_fields() if field not in message_data]
+            if len(missing_fields) > 0:
+                raise ResponseParseError(f'Response is missing fields: {", ".join(missing_fields)}')
+
+        with telemetry.span('convert_response'):
+            return self.simple_response_to_autogpt_response(message_data)
+
+
+    def collapse_line_break(self, match:re.Match) -> str:
+        """
+        Replace the part of a whitespace run up to its last new line with a
+        single new line, keeping the indentation after it.
+
+        Args:
+            match (re.Match): The whitespace run.
+
+        Returns:
+            str: The replacement.
+        """
+
+        whitespace = match.group(0)
+        last_newline = whitespace.rfind('\n')
+
+        return whitespace if last_newline < 0 else '\n' + whitespace[last_newline + 1:]
+
+
+    def is_grammar_enabled(self) -> bool:
+        """
+        Check whether the profile asks for grammar-constrained responses.
+
+        Returns:
+            bool: True if constrained decoding is enabled.
+        """
+
+        return self.get_profile_attribute('use_grammar').lower() == 'true'
+
+
+    def get_response_grammar(self):
+        """
+        Get the compiled grammar of the profile's response format.
+
+        Returns:
+            ResponseGrammar: The compiled grammar.
+        """
+
+        return compile_response_format(self.get_profile_attribute_as_raw('response_format'))
+
+
+    def get_grammar(self, messages:list) -> str|None:
+        """
+        Get the GBNF grammar for the response to an agent prompt. Other prompts,
+        such as summaries, are left unconstrained.
+
+        Args:
+            messages (list): The messages the prompt is built from.
+
+        Returns:
+            str|None: The GBNF grammar, or None if the response is unconstrained.
+        """
+
+        if not self.is_grammar_enabled() or len(messages) == 0 or not self.is_ai_system_prompt(messages[0]['content']):
+            return None
+
+        return self.get_response_grammar().to_gbnf()
+
+
+    def get_response_fields(self) -> list:
+        """
+        Get the top-level field names of the profile's response format.
+
+        Returns:
+            list: The field names, in the order the model is asked to write them.
+        """
+
+        response_format = self.get_profile_attribute_as_raw('response_format').replace('\\n', '\n')
+        fields = re.findall(r'^(\w+):', response_format, re.MULTILINE)
+
+        return fields if len(fields) > 0 else self.DEFAULT_RESPONSE_FIELDS
+
+
+    def get_missing_fields(self, message:str) -> list:
+        """
+        Get the response format fields that a response does not contain,
+        accepting the plain language labels the model sometimes writes.
+
+        Args:
+            message (str): The response from the API.
+
+        Returns:
+            list: The missing field names.
+        """
+
+        lowered = message.lower()
+
+        return [field for field in self.get_response_fields()
+                if f'{field}:' not in lowered and f"{field.replace('_', ' ')}:" not in lowered]
+
+
+    def get_repair_prompt(self, prompt:str, message:str) -> str|None:
+        """
+        Build a continuation prompt that re-opens the response at the first field
+        the model did not write, so only the unfinished fields are generated.
+
+        Args:
+            prompt (str): The prompt that produced the response.
+            message (str): The malformed response.
+
+        Returns:
+            str|None: The continuation prompt, or None if no fields are missing.
+        """
+
+        missing_fields = self.get_missing_fields(message)
+        if len(missing_fields) == 0:
+            return None
+
+        # Drop a trailing partial line, the model was cut off in the middle of it
+        partial = message.rstrip()
+        if '\n' in partial and not message.endswith('\n'):
+            partial = partial[:partial.rfind('\n')]
 
-        return converted_obj
\ No newline at end of file
+        return f'{prompt}{partial}\n{missing_fields[0]}:'
@@ -0,0 +1,275 @@
+import argparse
+import json
+import sys
+from .monolithic_prompt import MonolithicPrompt
+from .prompt_engine import RequestContext
+from .recorder import read_traffic
+from .text_gen_plugin import TextGenPluginController
+
+CHARS_PER_TOKEN = 4
+
+# The sections of a monolithic prompt, in the order they are sent
+SECTIONS = ['prescript', 'ai_profile', 'constraints', 'commands', 'resources', 'performance_eval', 'response_format', 'history', 'postscript']
+
+# Sections that only change with the system message, so they are paid on every step of an agent
+STATIC_SECTIONS = ['prescript', 'ai_profile', 'constraints', 'commands', 'resources', 'performance_eval', 'response_format']
+
+# An Auto-GPT step with one earlier command in its history
+SAMPLE_MESSAGES = [
+    {
+        'role': 'system',
+        'content': 'You are Researcher-GPT, an AI designed to research local language models and write a short report about them.\n'
+            'Your decisions must always be made independently without seeking user assistance. Play to your strengths as an LLM and pursue simple strategies with no legal complications.\n\n'
+            'The OS you are running on is: Ubuntu 22.04.2 LTS\n\n'
+            'GOALS:\n\n'
+            '1. Find the three most popular open source language models\n'
+            '2. Compare their licences and context sizes\n'
+            '3. Write the comparison to report.md\n\n\n'
+            'Constraints:\n'
+            '1. ~4000 word limit for short term memory. Your short term memory is short, so immediately save important information to files.\n'
+            '2. If you are unsure how you previously did something or want to recall past events, thinking about similar events will help you remember.\n'
+            '3. No user assistance\n'
+            '4. Exclusively use the commands listed in double quotes e.g. "command name"\n\n'
+            'Commands:\n'
+            '1. append_to_file: Append to file, args: "filename": "<filename>", "text": "<text>"\n'
+            '2. delete_file: Delete file, args: "filename": "<filename>"\n'
+            '3. list_files: List Files in Directory, args: "directory": "<directory>"\n'
+            '4. read_file: Read a file, args: "filename": "<filename>"\n'
+            '5. write_to_file: Write to file, args: "filename": "<filename>", "text": "<text>"\n'
+            '6. google: Google Search, args: "query": "<query>"\n'
+            '7. browse_website: Browse Website, args: "url": "<url>", "question": "<what_you_want_to_find_on_website>"\n'
+            '8. get_text_summary: Get text summary, args: "url": "<url>", "question": "<question>"\n'
+            '9. task_complete: Task Complete (Shutdown), args: "reason": "<reason>"\n\n'
+            'Resources:\n'
+            '1. Internet access for searches and information gathering.\n'
+            '2. Long Term memory management.\n'
+            '3. GPT-3.5 powered Agents for delegation of simple tasks.\n'
+            '4. File output.\n\n'
+            'Performance Evaluation:\n'
+            '1. Continuously review and analyze your actions to ensure you are performing to the best of your abilities.\n'
+            '2. Constructively self-criticize your big-picture behavior constantly.\n'
+            '3. Reflect on past decisions and strategies to refine your approach.\n'
+            '4. Every command has a cost, so be smart and efficient. Aim to complete tasks in the least number of steps.\n'
+            '5. Write all code to a file.\n\n'
+            'You should only respond in JSON format as described below \n'
+            'Response Format: \n'
+            '{\n    "thoughts": {\n        "text": "thought",\n        "reasoning": "reasoning",\n'
+            '        "plan": "- short bulleted\\n- list that conveys\\n- long-term plan",\n'
+            '        "criticism": "constructive self-criticism",\n        "speak": "thoughts summary to say to user"\n    },\n'
+            '    "command": {\n        "name": "command name",\n        "args": {\n            "arg name": "value"\n        }\n    }\n}\n'
+            'Ensure the response can be parsed by Python json.loads',
+    },
+    {'role': 'system', 'content': 'The current time and date is Mon Jul 10 12:00:00 2023'},
+    {'role': 'user', 'content': 'Determine which next command to use, and respond using the format specified above:'},
+    {
+        'role': 'assistant',
+        'content': 'plan_summary: Search for popular open source language models\n'
+            'reasoning: I need a list of candidate models before comparing them\n'
+            'next_steps:\n - Search the web\n - Pick the top three\n - Compare licences\n'
+            'considerations: The search results may be out of date\n'
+            'tts_msg: Searching for popular open source models\n'
+            'command_name: google\n'
+            'args:\n - name: query\n   value: most popular open source language models\n',
+    },
+    {'role': 'system', 'content': 'Command google returned: [{"title": "Top open source LLMs", "href": "https://example.com/llms", "body": "LLaMA, Falcon and MPT are the most downloaded models."}]'},
+    {'role': 'user', 'content': 'Determine which next command to use, and respond using the format specified above:'},
+]
+
+
+def estimate_tokens(text:str) -> int:
+    """
+    Estimate the length of a text in tokens from its length in characters,
+    for when no backend is available to count it.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The estimated length in tokens.
+    """
+
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def render_sections(prompt_profile:dict, messages:list = None) -> dict:
+    """
+    Render a monolithic prompt and split it into its sections. Joined in
+    order, the sections are exactly the prompt sent to the model, minified
+    if the profile sets `minify_prompt`.
+
+    Args:
+        prompt_profile (dict): The prompt profile.
+        messages (list): The Auto-GPT step to render. Defaults to SAMPLE_MESSAGES.
+
+    Returns:
+        dict: The text of each section, by name.
+    """
+
+    messages = messages if messages is not None else SAMPLE_MESSAGES
+    engine = MonolithicPrompt(prompt_profile)
+
+    if len(messages) == 0 or not engine.is_ai_system_prompt(messages[0]['content']):
+        raise ValueError('The messages are not an Auto-GPT agent step')
+
+    context = RequestContext.from_messages(messages)
+    send_as_name = engine.get_send_as_name()
+
+    if engine.minifier is not None:
+        sections = engine.get_minified_sections(context, send_as_name)
+    else:
+        sections = engine.get_prompt_sections(context, send_as_name)
+    prefix = ''.join(sections.values())
+
+    postscript = engine.get_profile_attribute('postscript')
+    postscript = send_as_name + postscript if postscript not in ['', None, 'None'] and len(postscript) > 0 else ''
+
+    # The history is whatever the engine put between the prefix and the postscript
+    prompt = engine.reshape_message(messages)
+    sections['history'] = prompt[len(prefix):len(prompt) - len(postscript)]
+    sections['postscript'] = postscript
+
+    return sections
+
+
+def analyze_profile(prompt_profile:dict, messages:list = None, count_tokens = None) -> dict:
+    """
+    Measure what each section of a monolithic prompt costs.
+
+    Args:
+        prompt_profile (dict): The prompt profile.
+        messages (list): The Auto-GPT step to render. Defaults to SAMPLE_MESSAGES.
+        count_tokens (callable): Returns the length of a text in tokens. Defaults to estimate_tokens.
+
+    Returns:
+        dict: The characters and tokens of each section, and the totals of the static sections and the whole prompt.
+    """
+
+    count_tokens = count_tokens or estimate_tokens
+    sections = render_sections(prompt_profile, messages)
+
+    report = {'sections': {}}
+    for name in SECTIONS:
+        text = sections[name]
+        report['sections'][name] = {'chars': len(text), 'tokens': count_tokens(text) if len(text) > 0 else 0}
+
+    # Tokens can merge across section boundaries, so totals are counted on the joined text
+    static = ''.join(sections[name] for name in STATIC_SECTIONS)
+    prompt = ''.join(sections[name] for name in SECTIONS)
+    report['static'] = {'chars': len(static), 'tokens': count_tokens(static)}
+    report['total'] = {'chars': len(prompt), 'tokens': count_tokens(prompt)}
+
+    return report
+
+
+def diff_reports(old:dict, new:dict) -> dict:
+    """
+    Compare the token costs of two profiles.
+
+    Args:
+        old (dict): The report of the first profile, from analyze_profile.
+        new (dict): The report of the second profile.
+
+    Returns:
+        dict: The tokens of each section and total in both profiles, and the change.
+    """
+
+    rows = {name: (old['sections'][name], new['sections'][name]) for name in SECTIONS}
+    rows['static'] = (old['static'], new['static'])
+    rows['total'] = (old['total'], new['total'])
+
+    return {
+        name: {'old': before['tokens'], 'new': after['tokens'], 'change': after['tokens'] - before['tokens']}
+        for name, (before, after) in rows.items()
+    }
+
+
+def load_messages(path:str) -> list:
+    """
+    Load the first agent step from a traffic log recorded with
+    LOCAL_LLM_RECORD_FILE, or any JSONL file of objects with a `messages` list.
+
+    Args:
+        path (str): The log.
+
+    Returns:
+        list: The messages of the step.
+    """
+
+    engine = MonolithicPrompt({})
+    for exchange in read_traffic(path):
+        messages = exchange['messages']
+        if len(messages) > 0 and engine.is_ai_system_prompt(messages[0]['content']):
+            return messages
+
+    raise ValueError(f'No agent step found in {path}')
+
+
+def main(argv:list = None) -> int:
+    """Print the token cost of each section of one profile, or the difference between two or made by minifying."""
+
+    parser = argparse.ArgumentParser(description='Measure the token cost of each section of a monolithic prompt profile.')
+    parser.add_argument('profiles', nargs='+', help='The prompt profile to measure, or two profiles to compare.')
+    parser.add_argument('--messages', default=None, help='A traffic log to take the agent step from. Defaults to a built-in sample step.')
+    parser.add_argument('--base-url', default=None, help='Count tokens with this backend\'s tokenizer instead of estimating them.')
+    parser.add_argument('--backend', default=None, help='The API the backend speaks: textgen, openai or llamacpp.')
+    parser.add_argument('--model', default=None, help='The model whose tokenizer to use. Defaults to the first model listed.')
+    parser.add_argument('--minify', action='store_true', help='Compare one profile with its minified prompt.')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+    args = parser.parse_args(argv)
+
+    if len(args.profiles) > 2:
+        parser.error('Give one profile to measure or two to compare')
+    if args.minify and len(args.profiles) != 1:
+        parser.error('--minify compares one profile with its minified prompt')
+
+    profiles = []
+    for path in args.profiles:
+        prompt_profile = TextGenPluginController.load_prompt_config(path)
+        if not isinstance(prompt_profile, dict) or prompt_profile.get('template_type', 'monolithic') != 'monolithic':
+            parser.error(f'{path} is not a monolithic prompt profile')
+        profiles.append(prompt_profile)
+
+    labels = list(args.profiles)
+    if args.minify:
+        profiles = [{**profiles[0], 'minify_prompt': False}, {**profiles[0], 'minify_prompt': True}]
+        labels = [args.profiles[0], f'{args.profiles[0]} minified']
+
+    messages = load_messages(args.messages) if args.messages is not None else None
+
+    count_tokens = None
+    if args.base_url is not None:
+        from .client import Client
+        client = Client(args.base_url, profiles[0], args.model, backend=args.backend)
+        count_tokens = client.calculate_token_length
+
+    reports = [analyze_profile(prompt_profile, messages, count_tokens) for prompt_profile in profiles]
+    unit = 'tokens' if count_tokens is not None else 'tokens (estimated)'
+
+    if len(reports) == 1:
+        report = reports[0]
+        if args.json:
+            print(json.dumps(report, indent=4))
+            return 0
+
+        print(f'{"Section":<20}{"chars":>8}{unit:>22}')
+        for name in SECTIONS:
+            print(f"{name:<20}{report['sections'][name]['chars']:>8}{report['sections'][name]['tokens']:>22}")
+        for name in ['static', 'total']:
+            print(f"{name:<20}{report[name]['chars']:>8}{report[name]['tokens']:>22}")
+        return 0
+
+    diff = diff_reports(*reports)
+    if args.json:
+        print(json.dumps(diff, indent=4))
+        return 0
+
+    print(f'{unit}: {labels[0]} -> {labels[1]}')
+    print(f'{"Section":<20}{"old":>8}{"new":>8}{"change":>8}')
+    for name, row in diff.items():
+        print(f"{name:<20}{row['old']:>8}{row['new']:>8}{row['change']:>+8}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
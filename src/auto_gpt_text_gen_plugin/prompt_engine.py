@@ -1,13 +1,89 @@
+import copy
 import json
+import os
 import re
+import threading
+from typing import NamedTuple
 from autogpt.config import Config
 from autogpt.config.ai_config import AIConfig
-from autogpt.logs import logger
 from autogpt.prompts.generator import PromptGenerator
 from colorama import Fore, Style
+from .history import EmbeddingCache, HistoryCompressor, HistorySelector, SemanticDeduplicator
+from .log import log
+
+
+class ResponseParseError(Exception):
+    """Raised when a model response cannot be converted to the Auto-GPT format."""
+
+
+# Normalised message contents by original content, emptied once they hold more than NORMALISED_CACHE_CHARS characters
+NORMALISED_CACHE_CHARS = 4000000
+_normalised_messages = {}
+_normalised_chars = 0
+_normalised_lock = threading.Lock()
+
+
+def normalise_message(content:str) -> str:
+    """
+    Flatten new lines and runs of whitespace in a message into single spaces.
+    Histories resend the same messages every step, so results are cached by
+    content. The cache is bounded by the characters it holds rather than by
+    its number of entries, since one entry can be a whole command output.
+
+    Args:
+        content (str): The message content.
+
+    Returns:
+        str: The normalised content.
+    """
+
+    global _normalised_chars
+
+    normalised = _normalised_messages.get(content)
+    if normalised is None:
+        normalised = ' '.join(content.split())
+        with _normalised_lock:
+            if _normalised_chars + len(content) + len(normalised) > NORMALISED_CACHE_CHARS:
+                _normalised_messages.clear()
+                _normalised_chars = 0
+            _normalised_messages[content] = normalised
+            _normalised_chars += len(content) + len(normalised)
+
+    return normalised
+
+
+class RequestContext(NamedTuple):
+    """
+    The inputs of one request that prompt building needs. Engines pass it
+    along instead of keeping per-request state on the instance, so one engine
+    can serve concurrent completions.
+    """
+
+    messages: tuple
+    system_message: str
+
+    @classmethod
+    def from_messages(cls, messages:list) -> 'RequestContext':
+        """
+        Args:
+            messages (list): The messages of the request.
+
+        Returns:
+            RequestContext: The context.
+        """
+
+        return cls(tuple(messages), str(messages[0]['content']) if len(messages) > 0 else '')
+
 
 class PromptEngine:
 
+    # Capabilities an engine can declare, so the client can take its faster paths
+    CAPABILITY_CACHEABLE_PREFIX = 'cacheable_prefix'
+    CAPABILITY_STREAMING_PARSE = 'streaming_parse'
+    CAPABILITY_GRAMMAR = 'grammar'
+
+    capabilities = frozenset()
+
     def __init__(self):
 
         # Constants
@@ -37,6 +113,9 @@ class PromptEngine:
             "command_args": []
         }
 
+        # Responses longer than this are cut before parsing, 0 for no limit
+        self.MAX_RESPONSE_CHARS = int(os.environ.get('LOCAL_LLM_MAX_RESPONSE_CHARS', '20000'))
+
         # Pull-in from Auto-GPT
         self.prompt_generator = PromptGenerator()
         self.config = Config()
@@ -44,7 +123,10 @@ class PromptEngine:
 
         # Variables
         self.prompt_profile = {}
-        self.original_system_msg = ''
+        self.history_compressor = None
+        self.history_deduplicator = None
+        self.history_selector = None
+        self.embeddings = None
 
         # Regular expressions
         self.regex_os = r'The OS you are running on is:(.*?)\n\nGOALS'
@@ -63,18 +145,18 @@ class PromptEngine:
             dict: The converted response.
         """
 
-        response = self.RESPONSE_OBJECT.copy()
+        response = copy.deepcopy(self.RESPONSE_OBJECT)
 
         try:
-            logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Converting from simple format: {json.dumps(simple_response, indent=4)}\n\n")
+            log.debug_payload("Converting from simple format", simple_response)
 
             if 'plan_summary' in simple_response:
                 response['thoughts']['text'] = simple_response['plan_summary']
-                logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Converted to Auto-GPT format: plan_summary -> {json.dumps(response['thoughts']['text'], indent=4)}\n\n")
+                log.debug("Converted to Auto-GPT format: plan_summary -> %s\n\n", response['thoughts']['text'])
 
             if 'reasoning' in simple_response:
                 response['thoughts']['reasoning'] = simple_response['reasoning']
-                logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Converted to Auto-GPT format: reasoning -> {json.dumps(response['thoughts']['reasoning'], indent=4)}\n\n")
+                log.debug("Converted to Auto-GPT format: reasoning -> %s\n\n", response['thoughts']['reasoning'])
 
             if 'next_steps' in simple_response:
                 actions = simple_response['next_steps']
@@ -85,7 +167,7 @@ class PromptEngine:
                 elif isinstance(actions, dict):
                     actions = self.dict_to_yaml_string(actions)
                 response['thoughts']['plan'] = actions
-                logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Converted to Auto-GPT format: next_steps -> {response['thoughts']['plan']}\n\n")
+                log.debug("Converted to Auto-GPT format: next_steps -> %s\n\n", response['thoughts']['plan'])
 
             if 'considerations' in simple_response:
                 considerations = simple_response['considerations']
@@ -96,26 +178,26 @@ class PromptEngine:
                 elif isinstance(considerations, dict):
                     considerations = self.dict_to_yaml_string(considerations)
                 response['thoughts']['criticism'] = considerations
-                logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Converted to Auto-GPT format: considerations -> {response['thoughts']['criticism']}\n\n")
+                log.debug("Converted to Auto-GPT format: considerations -> %s\n\n", response['thoughts']['criticism'])
 
             if 'tts_msg' in simple_response:
                 response['thoughts']['speak'] = simple_response['tts_msg']
-                logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Converted to Auto-GPT format: tts_msg -> {json.dumps(response['thoughts']['speak'], indent=4)}\n\n")
+                log.debug("Converted to Auto-GPT format: tts_msg -> %s\n\n", response['thoughts']['speak'])
 
             if 'command_name' in simple_response:
                 response['command']['name'] = simple_response['command_name']
-                logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Converted to Auto-GPT format: command_name -> {response['command']['name']}\n\n")
+                log.debug("Converted to Auto-GPT format: command_name -> %s\n\n", response['command']['name'])
 
             # args are objects of name: value pairs
             if 'args' in simple_response:
-                for arg in simple_response['args']:
+                for arg in simple_response['args'] or []:
                     arg_name = arg['name']
                     arg_value = arg['value']
                     response['command']['args'][arg_name] = arg_value
-                logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Converted to Auto-GPT format: args -> {json.dumps(response['command']['args'], indent=4)}\n\n")
+                log.debug("Converted to Auto-GPT format: args -> %s\n\n", response['command']['args'])
 
         except Exception as e:
-            logger.error(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Error converting simple response to Auto-GPT response: {e}")
+            log.error("Error converting simple response to Auto-GPT response: %s", e)
             response['thoughts']['text'] = json.dumps(simple_response, indent=4)
 
         return json.dumps(response)
@@ -135,14 +217,9 @@ class PromptEngine:
         response = ''
 
         try:
-            string = string.strip()
-            string_list = string.split('-')
-            for string_item in string_list:
-                string_item = string_item.replace('-', '')
-                string_item = string_item.strip()
-                response += f"\n - {string_item}"
+            response = ''.join([f"\n - {string_item.strip()}" for string_item in string.strip().split('-')])
         except Exception as e:
-            logger.error(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Error converting string to YAML: {e}")
+            log.error("Error converting string to YAML: %s", e)
 
         return response
 
@@ -158,10 +235,7 @@ class PromptEngine:
             bool: True if the prompt is a RP prompt, False otherwise.
         """
 
-        prompt = self.strip_newlines(prompt)
-        prompt = self.remove_whitespace(prompt)
-
-        return prompt.startswith('You are')
+        return normalise_message(str(prompt)).startswith('You are')
 
 
     def remove_whitespace(self, text:str) -> str:
@@ -215,6 +289,136 @@ class PromptEngine:
         """
 
         return {}
+
+
+    def parse_response(self, message:str, strict:bool = True) -> str:
+        """
+        Convert the API response to the Auto-GPT format, raising instead of
+        passing the original message back when it cannot be converted.
+
+        Args:
+            message (str): The response from the API.
+            strict (bool): Whether every field of the response format must be present.
+
+        Returns:
+            str: The converted response.
+
+        Raises:
+            ResponseParseError: If the response cannot be converted.
+        """
+
+        return self.reshape_response(message)
+
+
+    def get_grammar(self, messages:list) -> str|None:
+        """
+        Get the grammar to constrain the model's response to, for backends that
+        support constrained decoding.
+
+        Args:
+            messages (list): The messages the prompt is built from.
+
+        Returns:
+            str|None: The GBNF grammar, or None if the response is unconstrained.
+        """
+
+        return None
+
+
+    def supports(self, capability:str) -> bool:
+        """
+        Check whether the engine declares a capability.
+
+        Args:
+            capability (str): One of the CAPABILITY_* constants.
+
+        Returns:
+            bool: True if the engine declares the capability.
+        """
+
+        return capability in self.capabilities
+
+
+    def get_prompt_prefix(self, messages:list) -> str|None:
+        """
+        Get the leading part of the prompt that depends only on the system
+        message, so work on it can be cached across steps. Engines that
+        declare CAPABILITY_CACHEABLE_PREFIX implement this.
+
+        Args:
+            messages (list): The messages the prompt is built from.
+
+        Returns:
+            str|None: The prefix of reshape_message(messages), ending on a new line, or None.
+        """
+
+        return None
+
+
+    def get_stopping_strings(self, messages:list) -> list:
+        """
+        Get the strings that mark the end of a response while it is generated,
+        so the backend can stop there instead of running to max_tokens. They are
+        sent with every request, whatever the engine's capabilities.
+
+        Args:
+            messages (list): The messages the prompt is built from.
+
+        Returns:
+            list: The stopping strings.
+        """
+
+        return []
+
+
+    def get_missing_fields(self, message:str) -> list:
+        """
+        Get the response format fields that a response does not contain.
+
+        Args:
+            message (str): The response from the API.
+
+        Returns:
+            list: The missing field names.
+        """
+
+        return []
+
+
+    def get_repair_prompt(self, prompt:str, message:str) -> str|None:
+        """
+        Build a continuation prompt that asks the model to finish a malformed response.
+        The continuation prompt must start with the original prompt.
+
+        Args:
+            prompt (str): The prompt that produced the response.
+            message (str): The malformed response.
+
+        Returns:
+            str|None: The continuation prompt, or None if the response cannot be repaired.
+        """
+
+        return None
+
+
+    def error_response(self, error:str) -> str:
+        """
+        Build a well-formed Auto-GPT response describing an error, so the agent
+        can carry on instead of failing to parse an error string.
+
+        Args:
+            error (str): The error to report.
+
+        Returns:
+            str: The error as an Auto-GPT JSON response.
+        """
+
+        # The empty command the engine returns when the model names none, as Auto-GPT has no command that does nothing
+        response = copy.deepcopy(self.RESPONSE_OBJECT)
+        response['thoughts']['text'] = f'Error: {error}'
+        response['thoughts']['speak'] = 'An error occurred while generating a response.'
+
+        return json.dumps(response)
     
 
     def get_user_name(self) -> str:
@@ -311,26 +515,23 @@ class PromptEngine:
             list: The agent's goals.
         """
 
-        goals_list = ''
-        for i, goal in enumerate(self.ai_config.ai_goals):
-            goals_list += f"{i+1}. {goal.strip()}\n"
+        goals_list = ''.join([f"{i+1}. {goal.strip()}\n" for i, goal in enumerate(self.ai_config.ai_goals)])
 
-        return str(goals_list).replace('\\n', '\n')
+        return goals_list.replace('\\n', '\n')
     
 
-    def get_profile_list_as_line(self, attribute:str, container:str = '') -> str:
+    def get_profile_list(self, attribute:str, container:str = '') -> list:
         """
-        Get a list from the profile.
+        Get the items of a list from the profile.
 
         Args:
             attribute (str): The attribute to get.
             container (str, optional): The container to put the list in. Defaults to None.
 
         Returns:
-            str: The list as a string.
+            list: The items, or an empty list if the profile does not have the attribute.
         """
 
-        response = ''
         list_items = []
 
         if container == '' and attribute in self.prompt_profile:
@@ -338,43 +539,57 @@ class PromptEngine:
         elif container in self.prompt_profile and attribute in self.prompt_profile[container]:
             list_items = self.prompt_profile[container][attribute]
 
-        for item in list_items:
-            response += item + ' '
+        return list(list_items)
 
-        return str(response).replace('\\n', '\n')
+
+    def get_profile_list_as_line(self, attribute:str, container:str = '', list_items:list = None) -> str:
+        """
+        Get a list from the profile.
+
+        Args:
+            attribute (str): The attribute to get.
+            container (str, optional): The container to put the list in. Defaults to None.
+            list_items (list, optional): The items to use instead of the profile's.
+
+        Returns:
+            str: The list as a string.
+        """
+
+        if list_items is None:
+            list_items = self.get_profile_list(attribute, container)
+
+        response = ''.join([f'{item} ' for item in list_items])
+
+        return response.replace('\\n', '\n')
     
 
-    def get_profile_numbered_list(self, attribute:str, container:str = '') -> str:
+    def get_profile_numbered_list(self, attribute:str, container:str = '', list_items:list = None) -> str:
         """
         Get a numbered list from the profile.
         
         Args:
             attribute (str): The attribute to get.
             container (str, optional): The container to put the list in. Defaults to None.
+            list_items (list, optional): The items to use instead of the profile's.
             
         Returns:
             str: The list as a string.
         """
 
-        response = ''
-        list_items = []
+        if list_items is None:
+            list_items = self.get_profile_list(attribute, container)
 
-        if container == '' and attribute in self.prompt_profile:
-            list_items = self.prompt_profile[attribute]
-        elif container in self.prompt_profile and attribute in self.prompt_profile[container]:
-            list_items = self.prompt_profile[container][attribute]
-
-        for i, item in enumerate(list_items):
-            response += f'{i + 1}. {item}\n'
+        response = ''.join([f'{i + 1}. {item}\n' for i, item in enumerate(list_items)])
 
-        return str(response).replace('\\n', '\n')
+        return response.replace('\\n', '\n')
 
-    def extract_from_original(self, regex:str) -> str:
+    def extract_from_original(self, regex:str, context:RequestContext) -> str:
         """
         Extract a string from the original system message.
         
         Args:
             regex (str): The regular expression to use.
+            context (RequestContext): The request.
             
         Returns:
             str: The extracted string.
@@ -382,7 +597,7 @@ class PromptEngine:
 
         response = ''
 
-        match = re.search(regex, self.original_system_msg, re.DOTALL)
+        match = re.search(regex, context.system_message, re.DOTALL)
         if match is not None:
             response = match.group(1).strip()
             response = self.remove_whitespace(response)        
@@ -401,22 +616,14 @@ class PromptEngine:
             str: The numbered list.
         """
 
-        response = ''
-
         # Remove extra whitespace and new lines.
-        text = self.remove_whitespace(text)
-        text = text.replace('\n', ' ')
+        text = normalise_message(text)
 
         # Split the string on the number and period.
         response_list = re.split(self.regex_split_commands, text)
         
         # Combine the list into a string with new lines between each item.
-        for i, item in enumerate(response_list):
-            clean_item = self.remove_whitespace(item)
-            if clean_item != '':
-                response += f'{i}. {item}\n'
-
-        return str(response)
+        return ''.join([f'{i}. {item}\n' for i, item in enumerate(response_list) if not item.isspace() and item != ''])
     
 
     def list_to_yaml_string(self, old_list:list) -> str:
@@ -430,13 +637,8 @@ class PromptEngine:
             str: The YAML list string.
         """
 
-        response = ''
-
         # Combine the list into a string where each item starts with a dash and a space
-        for item in old_list:
-            response += f' - {item}\n'
-
-        return response
+        return ''.join([f' - {item}\n' for item in old_list])
     
 
     def dict_to_yaml_string(self, old_dict:dict) -> str:
@@ -451,14 +653,9 @@ class PromptEngine:
             str: The YAML list string.
         """
 
-        response = ''
-
         # Combine the dictionary into a string where each item starts with a dash and a space
         # Each item is the key and value concatinated with a colon
-        for key, value in old_dict.items():
-            response += f' - {key}: {value}\n'
-
-        return response
+        return ''.join([f' - {key}: {value}\n' for key, value in old_dict.items()])
     
 
     def get_as_json(self, attribute:str, container:str = '') -> str:
@@ -499,9 +696,12 @@ class PromptEngine:
         return str(text).replace('\n', ' ')
     
 
-    def get_command_list(self) -> str:
+    def get_command_list(self, context:RequestContext) -> str:
         """
         Get the command list from the system message.
+
+        Args:
+            context (RequestContext): The request.
         
         Returns:
             str: The command list.
@@ -509,15 +709,18 @@ class PromptEngine:
 
         response = ''
 
-        commands = self.extract_from_original(self.regex_commands)
+        commands = self.extract_from_original(self.regex_commands, context)
         response = self.string_to_numbered_list(commands)
 
         return str(response)
     
 
-    def get_ai_profile(self) -> str:
+    def get_ai_profile(self, context:RequestContext) -> str:
         """
         Build the AI profile string
+
+        Args:
+            context (RequestContext): The request.
         
         Returns:
             str: The AI profile string.
@@ -530,7 +733,7 @@ class PromptEngine:
         response += self.get_agent_role()
         response += self.get_profile_list_as_line('general_guidance', 'strings')
         response += self.get_profile_attribute('os_prompt', 'strings')
-        response += self.extract_from_original(self.regex_os)
+        response += self.extract_from_original(self.regex_os, context)
         response += self.get_profile_attribute('goal_label', 'strings')
         response += self.get_profile_list_as_line('goals', 'strings')
         response += self.get_agent_goals()
@@ -554,9 +757,12 @@ class PromptEngine:
         return str(response)
     
 
-    def get_commands(self) -> str:
+    def get_commands(self, context:RequestContext) -> str:
         """
         Build the commands string
+
+        Args:
+            context (RequestContext): The request.
         
         Returns:
             str: The commands string.
@@ -565,7 +771,7 @@ class PromptEngine:
         response = ''
 
         response += self.get_profile_attribute('commands_label', 'strings')
-        response += self.get_command_list()
+        response += self.get_command_list(context)
 
         return str(response)
     
@@ -638,6 +844,89 @@ class PromptEngine:
         return str(response)
 
 
+    def set_embedding_function(self, embedding_function) -> None:
+        """
+        Give the engine a way to embed text, for the history stages that compare messages by meaning.
+
+        Args:
+            embedding_function (callable): Returns the embeddings of a list of texts, or None if they cannot be embedded.
+        """
+
+        self.embeddings = EmbeddingCache(embedding_function)
+        self.history_deduplicator = None
+        self.history_selector = None
+
+
+    def compress_history(self, messages:list) -> list:
+        """
+        Truncate oversized history messages and collapse repeated ones, as
+        configured by the profile's `history_message_tokens` and `history_dedupe`.
+        If the profile sets `history_similarity_threshold` and the engine can
+        embed text, near-duplicate messages are collapsed too.
+
+        Args:
+            messages (list): The history messages.
+
+        Returns:
+            list: The compressed messages.
+        """
+
+        if self.history_compressor is None:
+            profile = self.prompt_profile if isinstance(self.prompt_profile, dict) else {}
+            self.history_compressor = HistoryCompressor(
+                int(profile.get('history_message_tokens', None) or 0),
+                str(profile.get('history_dedupe', 'false')).lower() == 'true',
+            )
+
+        messages = self.history_compressor.compress(messages)
+
+        if self.history_deduplicator is None and self.embeddings is not None:
+            profile = self.prompt_profile if isinstance(self.prompt_profile, dict) else {}
+            threshold = float(profile.get('history_similarity_threshold', None) or 0)
+            if threshold > 0:
+                self.history_deduplicator = SemanticDeduplicator(
+                    self.embeddings,
+                    threshold,
+                    str(profile.get('history_similarity_mode', 'collapse')).lower() != 'drop',
+                )
+
+        if self.history_deduplicator is not None:
+            messages = self.history_deduplicator.deduplicate(messages)
+
+        return messages
+
+
+    def select_history(self, messages:list) -> list:
+        """
+        Fit the history into the profile's `history_tokens` budget, keeping the
+        messages that are most recent and most related to the agent's goals
+        and last command. `history_recency_weight` and
+        `history_recency_half_life` tune the balance.
+
+        Args:
+            messages (list): The history messages, oldest first.
+
+        Returns:
+            list: The selected messages, oldest first.
+        """
+
+        if self.history_selector is None:
+            profile = self.prompt_profile if isinstance(self.prompt_profile, dict) else {}
+            arguments = [self.embeddings, int(profile.get('history_tokens', None) or 0), float(profile.get('history_recency_weight', 0.5))]
+            try:
+                self.history_selector = HistorySelector(*arguments, float(profile.get('history_recency_half_life', 10)))
+            except ValueError as e:
+                log.error("Invalid history_recency_half_life, using 10: %s", e)
+                self.history_selector = HistorySelector(*arguments, 10)
+
+        if self.history_selector.max_tokens <= 0:
+            return messages
+
+        last_command = next((message['content'] for message in reversed(messages) if message.get('role') == 'assistant'), None)
+
+        return self.history_selector.select(messages, [self.get_agent_goals(), last_command])
+
+
     def messages_to_conversation(self, messages:list, attribution:str = '') -> str:
         """
         Convert a list of messages to a conversation.
@@ -650,14 +939,7 @@ class PromptEngine:
             str: The conversation.
         """
 
-        response = ''
-
-        for message in messages:
-            clean_message = self.strip_newlines(message['content'])
-            clean_message = self.remove_whitespace(clean_message)
-            response += attribution + clean_message + '\n\n'
-
-        return str(response)
+        return ''.join([f"{attribution}{normalise_message(str(message['content']))}\n\n" for message in messages])
     
 
     def match_prop(self, srctext, regexp) -> str:
@@ -686,6 +968,56 @@ class PromptEngine:
         return response
     
 
+    def truncate_response(self, message:str) -> str:
+        """
+        Cut a runaway response down to MAX_RESPONSE_CHARS before it is parsed.
+        The start is kept, since that is where the response format begins, and
+        the cut is moved back to the last complete line if there is one.
+
+        Args:
+            message (str): The response from the API.
+
+        Returns:
+            str: The response, truncated if it is over the limit.
+        """
+
+        if self.MAX_RESPONSE_CHARS <= 0 or len(message) <= self.MAX_RESPONSE_CHARS:
+            return message
+
+        truncated = message[:self.MAX_RESPONSE_CHARS]
+        last_newline = truncated.rfind('\n')
+        if last_newline > 0:
+            truncated = truncated[:last_newline]
+
+        log.debug("Truncated a %s character response to %s characters before parsing", len(message), len(truncated))
+
+        return truncated
+
+
+    def extract_json_string(self, text:str, key:str) -> str:
+        """
+        Extract the string value of a key from JSON-like text in one pass.
+        The value runs to the first unescaped quote that matches its opening
+        quote, or to the end of the text if it is never closed.
+
+        Args:
+            text (str): The text to search.
+            key (str): The key.
+
+        Returns:
+            str: The value, or an empty string if the key is not found.
+        """
+
+        match = re.search(r"[\"']" + re.escape(key) + r"[\"'] ?: ?([\"'])", text)
+        if match is None:
+            return ''
+
+        quote = match.group(1)
+        value = re.compile(f'[^{quote}\\\\]*(?:\\\\.[^{quote}\\\\]*)*', re.DOTALL).match(text, match.end())
+
+        return value.group(0)
+
+
     def recover_json_response(self, message:str) -> dict:
         """
         Recover a JSON response from a message.
@@ -697,13 +1029,16 @@ class PromptEngine:
             str: The JSON response.
         """
 
-        response = self.RESPONSE_OBJECT.copy()
+        response = copy.deepcopy(self.RESPONSE_OBJECT)
+
+        # Normalise once, then read each value in a single pass
+        message = self.remove_whitespace(self.truncate_response(str(message)))
 
-        response['thoughts']['text'] = self.match_prop(message, r"[\"']text[\"']\s*:\s*[\"']((?:[^\"\\]|\\.)*)[\"']")
-        response['thoughts']['reasoning'] = self.match_prop(message, r"[\"']reasoning[\"']\s*:\s*[\"']((?:[^\"\\]|\\.)*)[\"']")
-        response['thoughts']['plan'] = self.match_prop(message, r"[\"']plan[\"']\s*:\s*[\"']((?:[^\"\\]|\\.)*)[\"']")
-        response['thoughts']['criticism'] = self.match_prop(message, r"[\"']criticism[\"']\s*:\s*[\"']((?:[^\"\\]|\\.)*)[\"']")
-        response['thoughts']['speak'] = self.match_prop(message, r"[\"']speak[\"']\s*:\s*[\"']((?:[^\"\\]|\\.)*)[\"']")
-        response['command']['name'] = self.match_prop(message, r"[\"']name[\"']\s*:\s*[\"']((?:[^\"\\]|\\.)*)[\"']")
+        response['thoughts']['text'] = self.extract_json_string(message, 'text')
+        response['thoughts']['reasoning'] = self.extract_json_string(message, 'reasoning')
+        response['thoughts']['plan'] = self.extract_json_string(message, 'plan')
+        response['thoughts']['criticism'] = self.extract_json_string(message, 'criticism')
+        response['thoughts']['speak'] = self.extract_json_string(message, 'speak')
+        response['command']['name'] = self.extract_json_string(message, 'name')
         
         return response
\ No newline at end of file
@@ -0,0 +1,109 @@
+import atexit
+import gzip
+import io
+import json
+import threading
+import time
+
+
+def open_traffic(path:str, mode:str = 'r'):
+    """
+    Open a traffic log as text, compressed according to its extension:
+    .gz for gzip, .zst for zstandard (requires the zstandard package),
+    anything else is plain JSONL.
+
+    Args:
+        path (str): The path of the log.
+        mode (str): 'r' to read, 'a' to append.
+
+    Returns:
+        file: A text stream.
+    """
+
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError('Reading or writing .zst traffic logs requires the zstandard package') from e
+        if mode == 'r':
+            return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True), encoding='utf-8')
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, 'ab'), closefd=True), encoding='utf-8')
+
+    return open(path, mode, encoding='utf-8')
+
+
+def read_traffic(path:str):
+    """
+    Read the exchanges from a traffic log.
+
+    Args:
+        path (str): The path of the log.
+
+    Yields:
+        dict: Each recorded exchange.
+    """
+
+    with open_traffic(path, 'r') as f:
+        for line in f:
+            if line.strip() != '':
+                yield json.loads(line)
+
+
+class TrafficRecorder:
+    """
+    Records each completion the plugin makes, so real agent sessions can be
+    replayed offline against new versions of the prompt engines.
+    """
+
+    def __init__(self, path:str) -> None:
+        """
+        Args:
+            path (str): The traffic log to append to. See open_traffic for the supported formats.
+        """
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open_traffic(path, 'a')
+        atexit.register(self.close)
+
+
+    def record(self, messages:list, prompt:str, parameters:dict, output:str, response:str, parsed:bool) -> None:
+        """
+        Append one exchange to the log.
+
+        Args:
+            messages (list): The messages Auto-GPT sent.
+            prompt (str): The reshaped prompt sent to the model.
+            parameters (dict): The sampling parameters of the request.
+            output (str): The raw text the model generated.
+            response (str): The response returned to Auto-GPT.
+            parsed (bool): Whether the output converted cleanly to the Auto-GPT format.
+        """
+
+        line = json.dumps({
+            'time': time.time(),
+            'messages': messages,
+            'prompt': prompt,
+            'parameters': parameters,
+            'output': output,
+            'response': response,
+            'parsed': parsed,
+        })
+
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + '\n')
+            self._file.flush()
+
+
+    def close(self) -> None:
+        """Close the log."""
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
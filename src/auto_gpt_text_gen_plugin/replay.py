@@ -0,0 +1,97 @@
+import argparse
+import json
+import sys
+import time
+import yaml
+from .engines import engines
+from .prompt_engine import ResponseParseError
+from .recorder import read_traffic
+
+
+def replay(traffic:list, prompt_profile:dict) -> dict:
+    """
+    Run recorded exchanges through the current prompt engine without a backend,
+    measuring how often the recorded outputs parse and the CPU time spent
+    reshaping prompts and parsing outputs.
+
+    Args:
+        traffic (list): The recorded exchanges.
+        prompt_profile (dict): The prompt profile to build the engine from.
+
+    Returns:
+        dict: The replay report.
+    """
+
+    engine = engines.create(prompt_profile)
+
+    report = {
+        'exchanges': 0,
+        'parsed': 0,
+        'recorded_parsed': 0,
+        'newly_parsed': 0,
+        'newly_failed': 0,
+        'prompts_changed': 0,
+        'reshape_cpu_seconds': 0.0,
+        'parse_cpu_seconds': 0.0,
+    }
+
+    for exchange in traffic:
+        report['exchanges'] += 1
+
+        start = time.process_time()
+        prompt = engine.reshape_message(exchange['messages'])
+        report['reshape_cpu_seconds'] += time.process_time() - start
+
+        if prompt != exchange['prompt']:
+            report['prompts_changed'] += 1
+
+        start = time.process_time()
+        try:
+            engine.parse_response(exchange['output'])
+            parsed = True
+        except ResponseParseError:
+            parsed = False
+        report['parse_cpu_seconds'] += time.process_time() - start
+
+        report['parsed'] += int(parsed)
+        report['recorded_parsed'] += int(exchange['parsed'])
+        report['newly_parsed'] += int(parsed and not exchange['parsed'])
+        report['newly_failed'] += int(exchange['parsed'] and not parsed)
+
+    exchanges = max(report['exchanges'], 1)
+    report['parse_success_rate'] = report['parsed'] / exchanges
+    report['recorded_parse_success_rate'] = report['recorded_parsed'] / exchanges
+
+    return report
+
+
+def main(argv:list = None) -> int:
+    """Replay a traffic log and print the report."""
+
+    parser = argparse.ArgumentParser(description='Replay recorded Auto-GPT-Text-Gen-Plugin traffic against the current prompt engines.')
+    parser.add_argument('traffic', help='The traffic log recorded with LOCAL_LLM_RECORD_FILE.')
+    parser.add_argument('--profile', required=True, help='The prompt profile to build the prompt engine from.')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+    args = parser.parse_args(argv)
+
+    with open(args.profile, 'r') as f:
+        prompt_profile = yaml.safe_load(f)
+
+    report = replay(list(read_traffic(args.traffic)), prompt_profile)
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print(f"Exchanges:          {report['exchanges']}")
+        print(f"Parse success:      {report['parse_success_rate']:.1%} (recorded {report['recorded_parse_success_rate']:.1%})")
+        print(f"Newly parsed:       {report['newly_parsed']}")
+        print(f"Newly failed:       {report['newly_failed']}")
+        print(f"Prompts changed:    {report['prompts_changed']}")
+        print(f"Reshape CPU time:   {report['reshape_cpu_seconds'] * 1000:.1f} ms")
+        print(f"Parse CPU time:     {report['parse_cpu_seconds'] * 1000:.1f} ms")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
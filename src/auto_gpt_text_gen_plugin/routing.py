@@ -0,0 +1,71 @@
+import re
+from .log import log
+
+TASK_AGENT_STEP = 'agent_step'
+TASK_MEMORY_QUERY = 'memory_query'
+TASK_SUMMARISATION = 'summarisation'
+TASK_OTHER = 'other'
+
+# Phrases that identify Auto-GPT's utility prompts. Memory queries are
+# checked first, since they are summaries focused on a question.
+DEFAULT_TASK_PATTERNS = {
+    TASK_MEMORY_QUERY: [r'answer the question', r'\bquestion:'],
+    TASK_SUMMARISATION: [r'running summary', r'concise summary', r'\bsummari[sz]e\b'],
+}
+
+
+class TaskRouter:
+    """
+    Sorts prompts into task classes, so each class can be sent to its own
+    backend, model and sampling parameters.
+
+    Agent steps are recognised by the prompt engine. Other prompts are
+    matched against phrases from Auto-GPT's summarisation and memory
+    prompts. Only the start of each message is searched, because the
+    instructions come before the text being processed.
+    """
+
+    CLASSIFY_CHARS = 500
+
+    def __init__(self, prompt_manager, routes:dict = None) -> None:
+        """
+        Args:
+            prompt_manager (PromptEngine): The engine that recognises agent prompts.
+            routes (dict): The profile's `routes` section. A route's `match` list replaces the default phrases of its class.
+        """
+
+        self.prompt_manager = prompt_manager
+
+        patterns = dict(DEFAULT_TASK_PATTERNS)
+        for task, route in (routes or {}).items():
+            if isinstance(route, dict) and 'match' in route:
+                patterns[task] = route['match']
+
+        self.patterns = []
+        for task, task_patterns in patterns.items():
+            try:
+                self.patterns.append((task, re.compile('|'.join(f'(?:{pattern})' for pattern in task_patterns), re.IGNORECASE)))
+            except re.error as e:
+                log.error("Invalid match pattern for the %s route: %s", task, e)
+
+
+    def classify(self, messages:list) -> str:
+        """
+        Work out which task a prompt is for.
+
+        Args:
+            messages (list): The messages of the prompt.
+
+        Returns:
+            str: The task class.
+        """
+
+        if len(messages) > 0 and self.prompt_manager.is_ai_system_prompt(messages[0]['content']):
+            return TASK_AGENT_STEP
+
+        heads = [str(message['content'])[:self.CLASSIFY_CHARS] for message in messages]
+        for task, pattern in self.patterns:
+            if any(pattern.search(head) is not None for head in heads):
+                return task
+
+        return TASK_OTHER
@@ -0,0 +1,37 @@
+import os
+
+# Sampling parameter name: (environment variable, type, default)
+SAMPLING_PARAMETERS = {
+    'seed': ('LOCAL_LLM_SEED', int, -1),
+    'top_p': ('LOCAL_LLM_TOP_P', float, 0.4),
+    'top_k': ('LOCAL_LLM_TOP_K', int, 50),
+    'repetition_penalty': ('LOCAL_LLM_REPETITION_PENALTY', float, 1.19),
+    'no_repeat_ngram_size': ('LOCAL_LLM_NO_REPEAT_NGRAM_SIZE', int, 0),
+}
+
+
+def load_sampling_parameters(prompt_profile:dict = None) -> dict:
+    """
+    Resolve the sampling parameters sent with every completion. Environment
+    variables take precedence over the profile's `sampling` section, which
+    takes precedence over the defaults.
+
+    Args:
+        prompt_profile (dict): The loaded prompt profile.
+
+    Returns:
+        dict: The sampling parameters.
+    """
+
+    profile_sampling = {}
+    if isinstance(prompt_profile, dict) and isinstance(prompt_profile.get('sampling'), dict):
+        profile_sampling = prompt_profile['sampling']
+
+    parameters = {}
+    for name, (env_var, cast, default) in SAMPLING_PARAMETERS.items():
+        value = os.environ.get(env_var, None)
+        if value in ['', None]:
+            value = profile_sampling.get(name, default)
+        parameters[name] = cast(value)
+
+    return parameters
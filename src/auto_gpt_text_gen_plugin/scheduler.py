@@ -0,0 +1,229 @@
+import contextlib
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from .deadline import time_remaining
+from .errors import DeadlineExceededError
+
+# The scheduler, priority class, agent and backend of the slot the current context holds, or None outside one
+_slot = contextvars.ContextVar('slot', default=None)
+
+
+def current_slot() -> tuple|None:
+    """
+    Get the scheduler slot the current request runs in, so work done for the
+    request can take spare slots of the same scheduler.
+
+    Returns:
+        tuple|None: The scheduler, priority class, agent and backend, or None outside a slot.
+    """
+
+    return _slot.get()
+
+
+def current_priority() -> int|None:
+    """
+    Get the priority class of the scheduler slot the current request runs in,
+    so it can be passed on to a shared scheduler such as the gateway's.
+
+    Returns:
+        int|None: The priority class, or None outside a slot.
+    """
+
+    slot = _slot.get()
+
+    return slot[1] if slot is not None else None
+
+
+class RequestScheduler:
+    """
+    Orders requests to the backends by priority class, limits how many run
+    against each backend at once and shares each class fairly between agents.
+
+    Requests of a higher priority class always go first. Within a class, an
+    agent's request is ordered by how many requests of that class the agent
+    has already had served, so one busy agent cannot starve the others. An
+    agent that was idle restarts from the class's current position rather than
+    from its old count, so it cannot starve the others either.
+    """
+
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_EMBEDDING = 1
+    PRIORITY_BACKGROUND = 2
+
+    PRIORITY_NAMES = {
+        PRIORITY_INTERACTIVE: 'interactive',
+        PRIORITY_EMBEDDING: 'embedding',
+        PRIORITY_BACKGROUND: 'background',
+    }
+
+    def __init__(self, max_concurrency:int = 1, backend_limits:dict = None) -> None:
+        """
+        Args:
+            max_concurrency (int): The number of requests allowed to run against a backend at once.
+            backend_limits (dict): Per-backend overrides of max_concurrency.
+        """
+
+        self.max_concurrency = max(1, max_concurrency)
+        self.backend_limits = backend_limits or {}
+
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._queues = {}
+        self._active = {}
+        self._served = {}
+        self._clock = {priority: 0 for priority in self.PRIORITY_NAMES}
+        self._waiting = {priority: 0 for priority in self.PRIORITY_NAMES}
+        self._wait_stats = {priority: {'count': 0, 'total': 0.0, 'max': 0.0} for priority in self.PRIORITY_NAMES}
+
+
+    def get_limit(self, backend:str) -> int:
+        """
+        Get the concurrency limit of a backend.
+
+        Args:
+            backend (str): The backend's name.
+
+        Returns:
+            int: The number of requests allowed to run at once.
+        """
+
+        return max(1, int(self.backend_limits.get(backend, self.max_concurrency)))
+
+
+    @contextlib.contextmanager
+    def slot(self, priority:int, agent_id = None, backend:str = 'default'):
+        """
+        Wait for a turn to run a request against a backend. The wait ends
+        with the current deadline, and the request then leaves the queue.
+
+        Args:
+            priority (int): The priority class of the request.
+            agent_id: The agent making the request. Defaults to the calling thread.
+            backend (str): The backend the request runs against.
+
+        Raises:
+            DeadlineExceededError: If the deadline passes before the request's turn.
+        """
+
+        if agent_id is None:
+            agent_id = threading.get_ident()
+
+        enqueued = time.monotonic()
+
+        with self._condition:
+            served = max(self._served.get((priority, agent_id), 0), self._clock[priority])
+            self._served[(priority, agent_id)] = served + 1
+            ticket = (priority, served, next(self._sequence))
+
+            queue = self._queues.setdefault(backend, [])
+            heapq.heappush(queue, ticket)
+            self._waiting[priority] += 1
+
+            try:
+                while queue[0] != ticket or self._active.get(backend, 0) >= self.get_limit(backend):
+                    remaining = time_remaining()
+                    if remaining == 0.0:
+                        raise DeadlineExceededError(f'The deadline passed while waiting for a turn on {backend}')
+                    self._condition.wait(remaining)
+            except BaseException:
+                queue.remove(ticket)
+                heapq.heapify(queue)
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+                raise
+
+            heapq.heappop(queue)
+            self._clock[priority] = max(self._clock[priority], served)
+            self._waiting[priority] -= 1
+            self._active[backend] = self._active.get(backend, 0) + 1
+            self.record_wait(priority, time.monotonic() - enqueued)
+
+            # The next request in line may fit within the limit too
+            self._condition.notify_all()
+
+        token = _slot.set((self, priority, agent_id, backend))
+        try:
+            yield
+        finally:
+            _slot.reset(token)
+            self.release(backend)
+
+
+    def acquire_spare(self, backend:str = 'default') -> bool:
+        """
+        Take a slot on a backend without waiting, for extra work of a request
+        that already holds a slot, such as more candidate completions. A
+        spare slot is only granted while no request is queued for the
+        backend, so it never delays another agent. Give it back with release.
+
+        Args:
+            backend (str): The backend the work runs against.
+
+        Returns:
+            bool: True if a slot was taken.
+        """
+
+        with self._condition:
+            if len(self._queues.get(backend, [])) > 0 or self._active.get(backend, 0) >= self.get_limit(backend):
+                return False
+            self._active[backend] = self._active.get(backend, 0) + 1
+
+        return True
+
+
+    def release(self, backend:str = 'default') -> None:
+        """
+        Give back a slot on a backend and wake the requests waiting for one.
+
+        Args:
+            backend (str): The backend the slot was taken on.
+        """
+
+        with self._condition:
+            self._active[backend] -= 1
+            self._condition.notify_all()
+
+
+    def record_wait(self, priority:int, wait:float) -> None:
+        """
+        Record how long a request waited for its turn. Called with the lock held.
+
+        Args:
+            priority (int): The priority class of the request.
+            wait (float): The wait in seconds.
+        """
+
+        stats = self._wait_stats[priority]
+        stats['count'] += 1
+        stats['total'] += wait
+        stats['max'] = max(stats['max'], wait)
+
+
+    def get_metrics(self) -> dict:
+        """
+        Get the queue depth and wait time of each priority class and the
+        number of running requests of each backend.
+
+        Returns:
+            dict: The metrics.
+        """
+
+        with self._condition:
+            classes = {}
+            for priority, name in self.PRIORITY_NAMES.items():
+                stats = self._wait_stats[priority]
+                classes[name] = {
+                    'queue_depth': self._waiting[priority],
+                    'served': stats['count'],
+                    'wait_seconds_total': stats['total'],
+                    'wait_seconds_avg': stats['total'] / stats['count'] if stats['count'] > 0 else 0.0,
+                    'wait_seconds_max': stats['max'],
+                }
+
+            return {
+                'classes': classes,
+                'active': dict(self._active),
+            }
@@ -0,0 +1,251 @@
+import atexit
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+
+
+class Telemetry:
+    """
+    Timing spans and counters for the completion path.
+
+    Span durations and counters are always aggregated in memory, which costs a
+    clock read and a dictionary update. Individual spans are also written to a
+    JSONL trace file when one is configured, and the aggregates can be written
+    out in the Prometheus text format. Both files are written by a background
+    thread, in batches, so the completion path never waits on the disk.
+    """
+
+    # Seconds between writes of the trace and metrics files
+    FLUSH_INTERVAL = 1.0
+    # Spans buffered before the trace is written early
+    FLUSH_SPANS = 256
+
+    def __init__(self, trace_path:str = None, metrics_path:str = None) -> None:
+        """
+        Args:
+            trace_path (str): The JSONL file to append spans to. Defaults to no trace.
+            metrics_path (str): The file to write Prometheus metrics to. Defaults to none.
+        """
+
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+
+        self._lock = threading.Lock()
+        self._spans = {}
+        self._counters = {}
+        self._gauges = {}
+        self._trace_id = contextvars.ContextVar('trace_id', default=None)
+
+        self._pending = []
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        if self.enabled:
+            threading.Thread(target=self.write_periodically, name='text-gen-plugin-telemetry', daemon=True).start()
+            atexit.register(self.close)
+
+
+    @property
+    def enabled(self) -> bool:
+        """
+        Whether spans or metrics are exported anywhere.
+        """
+
+        return self.trace_path is not None or self.metrics_path is not None
+
+
+    @contextlib.contextmanager
+    def trace(self):
+        """
+        Group the spans of one completion under a shared trace id.
+        """
+
+        token = self._trace_id.set(uuid.uuid4().hex)
+        try:
+            yield
+        finally:
+            self._trace_id.reset(token)
+
+
+    @contextlib.contextmanager
+    def span(self, name:str, **attributes):
+        """
+        Time a phase of the completion path.
+
+        Args:
+            name (str): The phase's name.
+            attributes: Extra fields to write to the trace.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, time.perf_counter() - start, **attributes)
+
+
+    def record_span(self, name:str, duration:float, **attributes) -> None:
+        """
+        Record the duration of a phase that was timed elsewhere.
+
+        Args:
+            name (str): The phase's name.
+            duration (float): The duration in seconds.
+            attributes: Extra fields to write to the trace.
+        """
+
+        line = None
+        if self.trace_path is not None:
+            line = json.dumps({
+                'trace_id': self._trace_id.get(),
+                'span': name,
+                'end': time.time(),
+                'duration': duration,
+                **attributes,
+            })
+
+        with self._lock:
+            stats = self._spans.setdefault(name, {'count': 0, 'sum': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['sum'] += duration
+            stats['max'] = max(stats['max'], duration)
+            if line is not None:
+                self._pending.append(line)
+                if len(self._pending) >= self.FLUSH_SPANS:
+                    self._wake.set()
+
+
+    def increment(self, name:str, value:float = 1) -> None:
+        """
+        Add to a counter.
+
+        Args:
+            name (str): The counter's name.
+            value (float): The amount to add.
+        """
+
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+
+    def set_gauge(self, name:str, value:float) -> None:
+        """
+        Set a gauge to its latest value.
+
+        Args:
+            name (str): The gauge's name.
+            value (float): The value.
+        """
+
+        with self._lock:
+            self._gauges[name] = value
+
+
+    def get_metrics(self) -> dict:
+        """
+        Get the aggregated spans, counters and gauges.
+
+        Returns:
+            dict: The metrics.
+        """
+
+        with self._lock:
+            return {
+                'spans': {name: dict(stats) for name, stats in self._spans.items()},
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+            }
+
+
+    def to_prometheus(self) -> str:
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics.
+        """
+
+        metrics = self.get_metrics()
+        lines = []
+
+        lines.append('# TYPE text_gen_plugin_span_seconds summary')
+        for name, stats in sorted(metrics['spans'].items()):
+            lines.append(f'text_gen_plugin_span_seconds_count{{span="{name}"}} {stats["count"]}')
+            lines.append(f'text_gen_plugin_span_seconds_sum{{span="{name}"}} {stats["sum"]:.6f}')
+        lines.append('# TYPE text_gen_plugin_span_seconds_max gauge')
+        for name, stats in sorted(metrics['spans'].items()):
+            lines.append(f'text_gen_plugin_span_seconds_max{{span="{name}"}} {stats["max"]:.6f}')
+
+        for name, value in sorted(metrics['counters'].items()):
+            lines.append(f'# TYPE text_gen_plugin_{name}_total counter')
+            lines.append(f'text_gen_plugin_{name}_total {value}')
+
+        for name, value in sorted(metrics['gauges'].items()):
+            lines.append(f'# TYPE text_gen_plugin_{name} gauge')
+            lines.append(f'text_gen_plugin_{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+    def write_periodically(self) -> None:
+        """
+        Write the buffered spans and the metrics every FLUSH_INTERVAL seconds,
+        or sooner when enough spans are buffered. Runs on the background thread.
+        """
+
+        while True:
+            self._wake.wait(self.FLUSH_INTERVAL)
+            self._wake.clear()
+            self.close()
+
+
+    def flush(self) -> None:
+        """
+        Append the buffered spans to the trace file and write the metrics file.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                lines, self._pending = self._pending, []
+
+            if lines and self.trace_path is not None:
+                with open(self.trace_path, 'a') as f:
+                    f.write('\n'.join(lines) + '\n')
+
+            self.write_metrics()
+
+
+    def close(self) -> None:
+        """
+        Flush, ignoring files that cannot be written, as this runs where no
+        caller could handle the error. The next flush retries the metrics.
+        """
+
+        try:
+            self.flush()
+        except OSError:
+            pass
+
+
+    def write_metrics(self) -> None:
+        """
+        Write the Prometheus metrics to the configured file, replacing it
+        atomically so a collector never reads a partial file.
+        """
+
+        if self.metrics_path is None:
+            return
+
+        temp_path = f'{self.metrics_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, self.metrics_path)
+
+
+telemetry = Telemetry(
+    os.environ.get('LOCAL_LLM_TRACE_FILE', None) or None,
+    os.environ.get('LOCAL_LLM_METRICS_FILE', None) or None,
+)
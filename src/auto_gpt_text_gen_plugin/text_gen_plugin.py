@@ -1,8 +1,15 @@
 import os
 import yaml
-from autogpt.logs import logger
 from colorama import Fore, Style
 from .client import Client
+from .deadline import deadline
+from .errors import DeadlineExceededError
+from .health import health
+from .log import log
+from .routing import TASK_AGENT_STEP, TaskRouter
+from .sampling import load_sampling_parameters
+from .scheduler import RequestScheduler
+from .telemetry import telemetry
 
 
 class TextGenPluginController():
@@ -23,13 +30,29 @@ class TextGenPluginController():
         prompt_config = self.load_prompt_config(prompt_profile_path)
         self.api = Client(base_url, prompt_config, model)
 
+        # Sampling parameters are resolved once, not on every request
+        self.sampling_parameters = load_sampling_parameters(prompt_config)
 
-    def load_prompt_config(self, path) -> dict|list|str|None:
+        # Send each class of prompt to its own backend, model and sampling parameters
+        routes = prompt_config.get('routes', None) if isinstance(prompt_config, dict) else None
+        self.router = TaskRouter(self.api.prompt_manager, routes)
+        self.routes = self.load_routes(prompt_config, routes)
+
+        # Order requests from agents sharing this process
+        self.scheduler = RequestScheduler(int(os.environ.get('LOCAL_LLM_MAX_CONCURRENCY', '1')))
+
+        # How long a completion or embedding may take, including its wait for a turn. 0 for no limit
+        self.REQUEST_TIMEOUT = float(os.environ.get('LOCAL_LLM_REQUEST_TIMEOUT', '0'))
+
+
+    @staticmethod
+    def load_prompt_config(path) -> dict|list|str|None:
         """
-        Load the prompt from the defined file.
+        Load the prompt from the defined file. Static, so tools can load a
+        profile the same way without a backend.
 
         Args:
-            prompt_profile (str): The path to the prompt profile.
+            path (str): The path to the prompt profile.
 
         Returns:
             dict|list|str|None: The loaded prompt profile.
@@ -39,14 +62,77 @@ class TextGenPluginController():
         try:
             with open(path, 'r') as f:
                 response = yaml.load(f, Loader=yaml.FullLoader)
-            logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Loaded prompt profile:\n{response}\n\n")
+            log.debug_payload("Loaded prompt profile", response)
         except Exception as e:
-            logger.debug(f"{Fore.LIGHTRED_EX}Auto-GPT-Text-Gen-Plugin:{Fore.RESET} Error {e}, no prompt profile loaded\n\n")
+            log.debug("Error %s, no prompt profile loaded\n\n", e)
             
         return response
         
     
-    def handle_chat_completion(self, messages, temperature, max_tokens) -> str:
+    def load_routes(self, prompt_config:dict, routes:dict = None) -> dict:
+        """
+        Create a client for each route in the profile. Routes default to the
+        main backend and model, and their `sampling` section is laid over
+        the profile's. A route to another server without a `model` uses the
+        model that server reports.
+
+        Args:
+            prompt_config (dict): The loaded prompt profile.
+            routes (dict): The profile's `routes` section, by task class.
+
+        Returns:
+            dict: The client and sampling parameters of each routed task class.
+
+        Raises:
+            ValueError: If a route's server does not report a model and the route sets none.
+        """
+
+        loaded = {}
+
+        for task, route in (routes or {}).items():
+            if not isinstance(route, dict):
+                log.error("Ignoring the %s route, it must be a mapping", task)
+                continue
+
+            route_config = dict(prompt_config)
+            route_config['sampling'] = {**(prompt_config.get('sampling', None) or {}), **(route.get('sampling', None) or {})}
+
+            base_url = route.get('base_url', self.api.base_url)
+            model = route.get('model', self.api.model if base_url == self.api.base_url else None)
+            context_size = route.get('context_size', None)
+            backend = route.get('backend', self.api.backend.name)
+
+            # The main model is already loaded, so only load what another backend or model needs
+            if base_url == self.api.base_url and model == self.api.model:
+                client = Client(base_url, route_config, model, context_size or self.api.context_size, backend)
+            else:
+                client = Client(base_url, route_config, model, backend=backend)
+                if context_size is not None:
+                    client.context_size = context_size
+                if client.model is None:
+                    raise ValueError(f"The {task} route's server {base_url} did not report its model, set the route's model")
+
+            loaded[task] = (client, load_sampling_parameters(route_config))
+            log.debug("Routing %s prompts to %s on %s with a context of %s", task, client.model, client.base_url, client.context_size)
+
+        return loaded
+
+
+    def get_route(self, task:str) -> tuple:
+        """
+        Get the client and sampling parameters for a task class.
+
+        Args:
+            task (str): The task class.
+
+        Returns:
+            tuple: The client and sampling parameters. Task classes without a route use the main client.
+        """
+
+        return self.routes.get(task, (self.api, self.sampling_parameters))
+
+
+    def handle_chat_completion(self, messages, temperature, max_tokens, agent_id = None, timeout = None) -> str:
         """
         This method cllls the chat_completion method of whatever API is loaded
         
@@ -54,35 +140,90 @@ class TextGenPluginController():
             messages (list): The messages to be used as context.
             temperature (float): The temperature to use for the completion.
             max_tokens (int): The maximum number of tokens to generate.
+            agent_id: The agent making the request. Defaults to the calling thread.
+            timeout (float): Seconds the completion may take. Defaults to LOCAL_LLM_REQUEST_TIMEOUT.
             
         Returns:
             str: The resulting response.
         """
 
-        parameters = {
-            'seed': int(os.environ.get('MY_ENV_VAR', '-1')),
-            'top_p': float(os.environ.get('LOCAL_LLM_TOP_P', '0.4')),
-            'top_k': int(os.environ.get('LOCAL_LLM_TOP_K', '50')),
-            'repetition_penalty': float(os.environ.get('LOCAL_LLM_REPETITION_PENALTY', '1.19')),
-            'no_repeat_ngram_size': int(os.environ.get('LOCAL_LLM_NO_REPEAT_NGRAM_SIZE', '0'))
-        }
-        
-        return self.api.create_chat_completion(messages, temperature, max_tokens, parameters)
+        task = self.router.classify(messages)
+        client, parameters = self.get_route(task)
+        parameters = dict(parameters)
+
+        # Agent steps are interactive, other prompts such as summaries run in the background
+        if task == TASK_AGENT_STEP:
+            priority = RequestScheduler.PRIORITY_INTERACTIVE
+        else:
+            priority = RequestScheduler.PRIORITY_BACKGROUND
+
+        with deadline(timeout if timeout is not None else self.REQUEST_TIMEOUT):
+            try:
+                with self.scheduler.slot(priority, agent_id, client.base_url):
+                    return client.create_chat_completion(messages, temperature, max_tokens, parameters)
+            except DeadlineExceededError as e:
+                log.debug("Error: %s", e)
+                telemetry.increment('deadlines_exceeded')
+                return client.prompt_manager.error_response(str(e))
     
     
-    def handle_get_embedding(self, text) -> list:
+    def handle_get_embedding(self, text, agent_id = None, timeout = None) -> list:
         """
         This method cllls the get_embedding method of whatever API is loaded
         
         Args:
             text (str): The text to be converted to embedding.
+            agent_id: The agent making the request. Defaults to the calling thread.
+            timeout (float): Seconds the request may take. Defaults to LOCAL_LLM_REQUEST_TIMEOUT.
             
         Returns:
             list: The resulting embedding.
         """
 
-        return self.api.get_embedding(text)
+        with deadline(timeout if timeout is not None else self.REQUEST_TIMEOUT):
+            try:
+                with self.scheduler.slot(RequestScheduler.PRIORITY_EMBEDDING, agent_id, self.api.base_url):
+                    return self.api.get_embedding(text)
+            except DeadlineExceededError as e:
+                log.debug("Error: %s", e)
+                telemetry.increment('deadlines_exceeded')
+                return ["Error"]
+
 
+    def get_scheduler_metrics(self) -> dict:
+        """
+        Get the queue depth and wait time metrics of the request scheduler.
 
+        Returns:
+            dict: The metrics.
+        """
+
+        return self.scheduler.get_metrics()
+
+
+    def get_health(self) -> dict:
+        """
+        Get the circuit breaker state of each backend.
+
+        Returns:
+            dict: The state, consecutive failures and trips of each backend's breaker.
+        """
+
+        return health.get_status()
+
+
+    def get_telemetry(self, output_format:str = 'json') -> dict|str:
+        """
+        Get the timing spans and counters of the completion path.
+
+        Args:
+            output_format (str): 'json' for a dictionary, 'prometheus' for the Prometheus text format.
+
+        Returns:
+            dict|str: The metrics.
+        """
 
+        if output_format == 'prometheus':
+            return telemetry.to_prometheus()
 
+        return telemetry.get_metrics()
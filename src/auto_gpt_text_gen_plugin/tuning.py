@@ -0,0 +1,210 @@
+import argparse
+import itertools
+import json
+import re
+import sys
+import yaml
+from .client import Client, TextGenAPIError
+from .prompt_engine import ResponseParseError
+from .recorder import read_traffic
+from .sampling import SAMPLING_PARAMETERS, load_sampling_parameters
+
+DEFAULT_GRID = {
+    'top_p': [0.1, 0.4, 0.7],
+    'top_k': [20, 50],
+    'repetition_penalty': [1.0, 1.1, 1.19],
+}
+
+
+def parameter_grid(grid:dict) -> list:
+    """
+    Expand a grid of candidate values into every combination.
+
+    Args:
+        grid (dict): Parameter names and the values to try for each.
+
+    Returns:
+        list: One dictionary per combination.
+    """
+
+    names = list(grid.keys())
+
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def score_parameters(client:Client, conversations:list, parameters:dict, temperature:float, max_tokens:int) -> dict:
+    """
+    Run every conversation with one set of sampling parameters and measure how
+    often the model produced a valid command and how many tokens it took.
+
+    Args:
+        client (Client): The client to generate with.
+        conversations (list): Lists of messages to send.
+        parameters (dict): The sampling parameters.
+        temperature (float): The temperature.
+        max_tokens (int): The generation budget per conversation.
+
+    Returns:
+        dict: The parameters and their score.
+    """
+
+    engine = client.prompt_manager
+    parsed = 0
+    tokens = 0
+
+    for messages in conversations:
+        model_properties = client.get_engine_properties(messages, dict(parameters))
+
+        try:
+            output = client.generate(engine.reshape_message(messages), temperature, max_tokens, model_properties)
+        except TextGenAPIError:
+            continue
+
+        tokens += client.calculate_token_length(output)
+        try:
+            engine.parse_response(output)
+            parsed += 1
+        except ResponseParseError:
+            pass
+
+    return {
+        'parameters': parameters,
+        'parsed': parsed,
+        'parse_success_rate': parsed / max(len(conversations), 1),
+        'generated_tokens': tokens,
+        'tokens_per_valid_response': tokens / parsed if parsed > 0 else None,
+    }
+
+
+def tune(client:Client, conversations:list, grid:dict, temperature:float = 0.0, max_tokens:int = 300) -> list:
+    """
+    Sweep the sampling parameters of a grid against a backend.
+
+    Parameters not in the grid keep the values resolved for the profile.
+    Results are ranked by parse success, then by the fewest generated tokens
+    per valid response.
+
+    Args:
+        client (Client): The client to generate with.
+        conversations (list): Lists of messages to send.
+        grid (dict): Parameter names and the values to try for each.
+        temperature (float): The temperature.
+        max_tokens (int): The generation budget per conversation.
+
+    Returns:
+        list: The scored parameter sets, best first.
+    """
+
+    base_parameters = load_sampling_parameters(client.prompt_profile)
+
+    results = [
+        score_parameters(client, conversations, {**base_parameters, **candidate}, temperature, max_tokens)
+        for candidate in parameter_grid(grid)
+    ]
+
+    results.sort(key=lambda result: (
+        -result['parse_success_rate'],
+        result['tokens_per_valid_response'] if result['tokens_per_valid_response'] is not None else float('inf'),
+    ))
+
+    return results
+
+
+def write_sampling(profile_path:str, parameters:dict) -> None:
+    """
+    Store sampling parameters in the `sampling` section of a profile,
+    replacing any existing section and leaving the rest of the file as is.
+
+    Args:
+        profile_path (str): The prompt profile YAML.
+        parameters (dict): The sampling parameters.
+    """
+
+    with open(profile_path, 'r') as f:
+        text = f.read()
+
+    section = yaml.safe_dump({'sampling': parameters}, sort_keys=False)
+    pattern = re.compile(r'^sampling:[^\n]*\n(?:[ \t]+[^\n]*\n)*', re.MULTILINE)
+
+    if pattern.search(text) is not None:
+        text = pattern.sub(lambda match: section, text, count=1)
+    else:
+        text = text.rstrip('\n') + '\n\n# Sampling parameters tuned with python -m auto_gpt_text_gen_plugin.tuning\n' + section
+
+    with open(profile_path, 'w') as f:
+        f.write(text)
+
+
+def load_conversations(path:str) -> list:
+    """
+    Load the conversations to tune with, from a traffic log recorded with
+    LOCAL_LLM_RECORD_FILE or any JSONL file of objects with a `messages` list.
+
+    Args:
+        path (str): The log.
+
+    Returns:
+        list: Lists of messages.
+    """
+
+    return [exchange['messages'] for exchange in read_traffic(path)]
+
+
+def main(argv:list = None) -> int:
+    """Tune the sampling parameters of one or more profiles and print the results."""
+
+    parser = argparse.ArgumentParser(description='Find the sampling parameters that reach a valid command in the fewest tokens.')
+    parser.add_argument('profiles', nargs='+', help='The prompt profiles to tune.')
+    parser.add_argument('--messages', required=True, help='A traffic log or JSONL file of conversations to tune with.')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000', help='The Text Gen WebUI API, or a stub of it.')
+    parser.add_argument('--model', default=None, help='The model to load. Defaults to the first model listed.')
+    parser.add_argument('--grid', default=None, help='The candidate values as JSON, for example {"top_p": [0.1, 0.4]}.')
+    parser.add_argument('--temperature', type=float, default=0.0, help='The temperature to generate with.')
+    parser.add_argument('--max-tokens', type=int, default=300, help='The generation budget per conversation.')
+    parser.add_argument('--agent-only', action='store_true', help='Only tune with agent steps, skipping summaries and other prompts.')
+    parser.add_argument('--write', action='store_true', help='Store the best parameters in each profile.')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    args = parser.parse_args(argv)
+
+    grid = json.loads(args.grid) if args.grid is not None else DEFAULT_GRID
+    unknown = [name for name in grid if name not in SAMPLING_PARAMETERS]
+    if len(unknown) > 0:
+        parser.error(f'Unknown sampling parameters: {", ".join(unknown)}')
+
+    conversations = load_conversations(args.messages)
+    report = {}
+
+    for profile_path in args.profiles:
+        with open(profile_path, 'r') as f:
+            prompt_profile = yaml.safe_load(f)
+
+        client = Client(args.base_url, prompt_profile, args.model)
+        profile_conversations = conversations
+        if args.agent_only:
+            profile_conversations = [
+                messages for messages in conversations
+                if len(messages) > 0 and client.prompt_manager.is_ai_system_prompt(messages[0]['content'])
+            ]
+
+        results = tune(client, profile_conversations, grid, args.temperature, args.max_tokens)
+        report[profile_path] = results
+
+        if args.write and len(results) > 0 and results[0]['parsed'] > 0:
+            write_sampling(profile_path, results[0]['parameters'])
+
+        if not args.json:
+            print(f'{profile_path} ({len(profile_conversations)} conversations)')
+            for result in results:
+                tokens = result['tokens_per_valid_response']
+                print(f"  parsed {result['parse_success_rate']:6.1%}  tokens/valid {tokens if tokens is None else round(tokens, 1)!s:>8}  {json.dumps(result['parameters'])}")
+            if args.write and len(results) > 0 and results[0]['parsed'] > 0:
+                print(f'  wrote the best parameters to {profile_path}')
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())